@@ -1,13 +1,18 @@
 import sys
 import threading
 import logging
-from multiprocessing import freeze_support, Queue
-import queue
+from multiprocessing import freeze_support
 
-from core import Core
-from ui.main_window import MainWindow
-from llm import LLM
-from web_server import start_web_server, get_local_ip_address
+import startup_profile
+startup_profile.enable_if_requested()  # Has to happen before the imports below to time them
+
+from event_bus import (DoneEvent, EventBus, ProgressEvent, ScreenshotEvent, StatusEvent, StopRequestEvent,
+                       UserRequestEvent)
+from event_stream import conversation_events
+from session_recorder import SessionRecorder
+
+with startup_profile.section('import ui.main_window'):
+    from ui.main_window import MainWindow
 
 
 # Configure logging
@@ -22,7 +27,7 @@ class App:
     |    |  GUI  |                                       |
     |    +-------+                                       |
     |        ^                                           |
-    |        | (via MP Queues)                           |
+    |        | (via EventBus)                            |
     |        v                                           |
     |  +-----------+  (Screenshot + Goal)  +-----------+ |
     |  |           | --------------------> |           | |
@@ -43,59 +48,82 @@ class App:
     """
 
     def __init__(self):
-        self.status_queue = Queue() # Initialize the status_queue here
-        self.core = Core(self.status_queue)
-        self.ui = MainWindow()
-        self._stop_event = threading.Event()
-
-
-        # Create threads to facilitate communication between core and ui through queues
-        self.core_to_ui_connection_thread = threading.Thread(target=self.send_status_from_core_to_ui, daemon=True)
-        self.ui_to_core_connection_thread = threading.Thread(target=self.send_user_request_from_ui_to_core, daemon=True)
-        self.llm = LLM(self.status_queue)
-        start_web_server(user_request_queue=self.ui.user_request_queue)
+        self.event_bus = EventBus()
+        self.core = None
+        with startup_profile.section('MainWindow()'):
+            self.ui = MainWindow(self.event_bus)
+        self._backend_ready = threading.Event()
+
+        # Subscribers are called on the publishing thread as soon as something happens, nothing polls.
+        self.event_bus.subscribe(self.ui.handle_event, (StatusEvent, ScreenshotEvent, ProgressEvent, DoneEvent))
+        self.event_bus.subscribe(conversation_events.handle_event)
+        self.event_bus.subscribe(self.on_user_request, (UserRequestEvent,))
+        self.event_bus.subscribe(self.on_stop_request, (StopRequestEvent,))
+        self.session_recorder = SessionRecorder(self.event_bus)  # Does nothing unless record_sessions is on
+
+        # Core, the LLM and the web server are slow to import and to initialize (the assistant is created over the
+        # network), so they are brought up in the background while the window is already usable.
+        self.backend_initialization_thread = threading.Thread(target=self.initialize_backend, daemon=True)
 
     def run(self) -> None:
-        self.core_to_ui_connection_thread.start()
-        self.ui_to_core_connection_thread.start()
+        self.backend_initialization_thread.start()
 
+        self.ui.after(0, startup_profile.mark, 'window interactive')
         self.ui.mainloop()
-        self._stop_event.set() # Set stop event when UI is closed
-
-    def send_status_from_core_to_ui(self) -> None:
-        while not self._stop_event.is_set():
-            try:
-                status: str = self.core.status_queue.get(timeout=0.1)  # added timeout to avoid blocking when the UI exits.
-                logging.info(f'Sending status: {status}')
-                self.ui.update_message(status)
-            except queue.Empty:
-                continue
-            except Exception as e:
-                 logging.error(f"Error in send_status_from_core_to_ui thread: {e}")
-                 break
-
-    def send_user_request_from_ui_to_core(self) -> None:
-        while not self._stop_event.is_set():
-            try:
-                user_request: str = self.ui.user_request_queue.get(timeout=0.1)  # added timeout to avoid blocking when the UI exits.
-                logging.info(f'Sending user request: {user_request}')
-
-                if user_request == 'stop':
-                    self.core.stop_previous_request()
-                    self._stop_event.set()
-
-                else:
-                    threading.Thread(target=self.core.execute_user_request, args=(user_request,), daemon=True).start()
-            except queue.Empty:
-                continue
-            except Exception as e:
-                 logging.error(f"Error in send_user_request_from_ui_to_core thread: {e}")
-                 break
+
+    def initialize_backend(self) -> None:
+        try:
+            with startup_profile.section('import core'):
+                from core import Core
+            with startup_profile.section('Core()'):
+                self.core = Core(self.event_bus)
+        except Exception as e:
+            logging.error(f"Error initializing core: {e}")
+            self.event_bus.publish(StatusEvent(f'An error occurred during startup. Please fix and restart the app.\nError: {e}'))
+            return
+        finally:
+            self._backend_ready.set()
+
+        try:
+            with startup_profile.section('import web_server'):
+                from web_server import start_web_server
+            start_web_server(event_bus=self.event_bus)
+        except Exception as e:
+            logging.error(f"Error starting web server: {e}")
+
+        try:
+            from screen import Screen
+            Screen.start_capture_service()
+        except Exception as e:
+            logging.error(f"Error starting the background screen capture: {e}")
+
+        startup_profile.mark('backend ready')
+        self.ui.after(0, startup_profile.report)
+
+    def on_user_request(self, event: UserRequestEvent) -> None:
+        logging.info(f'Sending user request: {event.request}')
+        # Published from the Tk thread or a web server thread, neither of which may block on Core.
+        threading.Thread(target=self.execute_user_request, args=(event.request,), daemon=True).start()
+
+    def execute_user_request(self, user_request: str) -> None:
+        self._backend_ready.wait()
+        if not self.core:
+            self.event_bus.publish(StatusEvent('The app did not start correctly, please check the logs and restart.'))
+            return
+        self.core.execute_user_request(user_request)
+
+    def on_stop_request(self, event: StopRequestEvent) -> None:
+        if self.core:
+            self.core.stop_previous_request()
 
     def cleanup(self):
         logging.info("Cleaning up application resources")
-        self.core.cleanup()
-        self.llm.cleanup()
+        if self.core:
+            from screen import Screen
+            Screen.stop_capture_service()
+            self.core.cleanup()
+        conversation_events.close()
+        self.session_recorder.close()
 
 
 if __name__ == '__main__':
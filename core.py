@@ -1,53 +1,106 @@
 import time
-from multiprocessing import Queue
 from typing import Optional, Any
 import logging
 import threading
-import json
 
 from openai import OpenAIError
 
+from event_bus import (EventBus, StatusEvent, ProgressEvent, DoneEvent, RequestStartedEvent, RequestFinishedEvent,
+                       ScreenChangeEvent, StepEvent)
+from hedging import RequestCancelled
 from interpreter import Interpreter
 from llm import LLM
-from settings import Settings
+from model_tiers import (SMALL_TIER, LARGE_TIER, ESCALATION_PARSE_FAILURE, ESCALATION_VALIDATION_FAILURE,
+                         ESCALATION_NO_SCREEN_CHANGE)
+from models.model import Model
+from models.rate_limiter import request_cancel_event
+from retry_policy import (RetryPolicy, MalformedResponseError, CircuitOpenError, ERROR_MESSAGES, SERVER_ERROR,
+                          classify_error, get_circuit_breaker)
+from frame_buffer import DEFAULT_MAX_FRAME_AGE
+from screen_change import SCREEN_CHANGE_THRESHOLD, get_change_signature, signature_difference
+from settings import Settings, SettingsChange
 
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
+# Steps that should visibly change the screen, checked after they run when the verify_actions setting is on.
+# Hotkeys aren't, many (copy, save, switching keyboard layout) rightly leave the screen as it was.
+VERIFIED_ACTIONS = frozenset({'click', 'doubleClick', 'click_element', 'double_click_element', 'click_text',
+                              'click_template', 'open_application'})
+# Steps after which the model already waits for the screen itself
+WAITING_ACTIONS = frozenset({'sleep', 'find_text'})
+DEFAULT_ACTION_VERIFICATION_TIMEOUT = 1.0  # seconds
+OPEN_APPLICATION_VERIFICATION_TIMEOUT = 5.0  # Applications take a while to show a window
+ACTION_VERIFICATION_POLL_INTERVAL = 0.1
+ACTION_VERIFICATION_SETTINGS_KEYS = frozenset({'verify_actions', 'action_verification_timeout'})
+
+
 class Core:
-    def __init__(self, status_queue: Queue):
-        self.status_queue = status_queue
+    def __init__(self, event_bus: EventBus, llm: Optional[LLM] = None, interpreter: Optional[Interpreter] = None,
+                 verify_actions: Optional[bool] = None):
+        """
+        llm and interpreter default to the real ones, replays pass in recorded and virtual stand-ins. verify_actions
+        follows the verify_actions setting unless it's given.
+        """
+        self.event_bus = event_bus
         self._interrupt_event = threading.Event()  # Use an event for interruption
-        self.settings_dict = Settings().get_dict()
+        self.retry_policy = RetryPolicy(max_retries=Model.MAX_RETRIES, rate_limit_delay=Model.RATE_LIMIT_DELAY)
+
+        self.interpreter = interpreter or Interpreter(self.event_bus)
 
-        self.interpreter = Interpreter(self.status_queue)
+        self._verify_actions_override = verify_actions
+        self._load_verification_settings(Settings().get_dict())
+        Settings().subscribe(self._on_settings_changed)
 
-        self.llm = None
+        self.llm = llm
+        if self.llm is not None:
+            return
         try:
-            self.llm = LLM(self.status_queue)
+            self.llm = LLM(self.event_bus)
             logging.info("LLM initialized successfully.")
         except OpenAIError as e:
             error_msg = f'Set your OpenAPI API Key in Settings and Restart the App. Error: {e}'
-            self.status_queue.put(error_msg)
+            self.event_bus.publish(StatusEvent(error_msg))
             logging.error(error_msg)
         except Exception as e:
             error_msg = (f'An error occurred during startup. Please fix and restart the app.\n'
                          f'Error likely in file {Settings().settings_file_path}.\n'
                          f'Error: {e}')
-            self.status_queue.put(error_msg)
+            self.event_bus.publish(StatusEvent(error_msg))
             logging.error(error_msg)
 
-    def execute_user_request(self, user_request: str) -> None:
+    def _on_settings_changed(self, change: SettingsChange) -> None:
+        if change.affects(ACTION_VERIFICATION_SETTINGS_KEYS):
+            self._load_verification_settings(change.settings)
+
+    def _load_verification_settings(self, settings_dict: dict[str, Any]) -> None:
+        self.verify_actions = bool(settings_dict.get('verify_actions', False)) \
+            if self._verify_actions_override is None else self._verify_actions_override
+        self.action_verification_timeout = float(settings_dict.get('action_verification_timeout',
+                                                                   DEFAULT_ACTION_VERIFICATION_TIMEOUT))
+
+    def execute_user_request(self, user_request: str) -> Optional[str]:
         self.stop_previous_request()
         time.sleep(0.1)
-        self.execute(user_request)
+        self.event_bus.publish(RequestStartedEvent(user_request))
+        start_time = time.monotonic()
+        result = None
+        if self.llm:
+            self.llm.begin_request()  # Every round of the request goes to the same model
+        try:
+            result = self.execute(user_request)
+            return result
+        finally:
+            if self.llm:
+                self.llm.end_request()
+            self.event_bus.publish(RequestFinishedEvent(user_request, result, time.monotonic() - start_time))
 
     def stop_previous_request(self) -> None:
          self._interrupt_event.set()  # Set the event to interrupt any execution
 
-    def execute(self, user_request: str, step_num: int = 0) -> Optional[str]:
+    def execute(self, user_request: str, step_num: int = 0, tier: str = SMALL_TIER) -> Optional[str]:
         """
             This function might recurse.
 
@@ -57,102 +110,193 @@ class Core:
                 in the middle of one.
                 Without it the LLM kept looping after finishing the user request.
                 Also, it is needed because the LLM we are using doesn't have a stateful/assistant mode.
+            tier: In tiered model mode, whether this round goes to the small or the large model. Rounds start on the
+                small model and are retried on the large one when its answer can't be parsed or executed, or when
+                executing it didn't change anything on screen.
         """
         self._interrupt_event.clear() # Reset the event flag before each execution
         if not self.llm:
             status = 'Set your OpenAPI API Key in Settings and Restart the App'
-            self.status_queue.put(status)
+            self.event_bus.publish(StatusEvent(status))
             logging.warning(status)
             return status
         if  self._interrupt_event.is_set():
-                self.status_queue.put('Interrupted')
+                self.event_bus.publish(StatusEvent('Interrupted'))
                 logging.info('Execution Interrupted')
                 return 'Interrupted'
 
-        max_retries = 3
-        retries = 0
         instructions: Optional[dict[str, Any]] = None
-        while retries < max_retries:
-            if  self._interrupt_event.is_set():
-                self.status_queue.put('Interrupted')
-                logging.info('Execution Interrupted')
-                return 'Interrupted'
-            try:
-                instructions = self.llm.get_instructions_for_objective(user_request, step_num)
-                if instructions and instructions != {}:
-                   break # break out of the retry loop if instructions are available
-                retries += 1
-                logging.warning(f'LLM returned malformed or empty instructions, retrying {retries}/{max_retries} ')
-                time.sleep(0.1*retries) #add a small backoff.
-            except Exception as e:
-                logging.error(f'Exception fetching instructions from LLM: {e}')
-                retries += 1
-                time.sleep(0.1*retries)
-            if  self._interrupt_event.is_set():
-                self.status_queue.put('Interrupted')
-                logging.info('Execution Interrupted')
-                return 'Interrupted'
 
+        def get_instructions() -> dict[str, Any]:
+            nonlocal tier
+            round_instructions = self.llm.get_instructions_for_objective(user_request, step_num, tier)
+            escalation_reason = self._get_escalation_reason(round_instructions, tier)
+            if escalation_reason:
+                self.llm.tier_stats.record_escalation(escalation_reason)
+                tier = LARGE_TIER
+                round_instructions = self.llm.get_instructions_for_objective(user_request, step_num, tier)
+            if not round_instructions or 'error' in round_instructions:
+                raise MalformedResponseError(f'LLM returned malformed or empty instructions: {round_instructions}')
+            return round_instructions
 
-        if not instructions:
-             try:
-                  llm_response = self.llm.model.send_message_to_llm(user_request)
-                  instructions_str = self.llm.model.convert_llm_response_to_json_instructions(llm_response)
-                  if isinstance(instructions_str, str) and instructions_str != "":
-                      self.status_queue.put(("ai",instructions_str)) # send to both uis
-                      if hasattr(self, 'user_and_ai_responses'):
-                            self.user_and_ai_responses.append(("ai", instructions_str))
-                      return instructions_str
-             except json.JSONDecodeError as e:
-                logging.error(f'JSONDecodeError when parsing instructions: {e}')
-             except Exception as e:
-                  logging.error(f'Exception in execute method - {e}')
-
-             status = 'Failed to fetch valid instructions after multiple retries.'
-             self.status_queue.put(status)
-             logging.error(status)
-             return status
+        try:
+            circuit_breaker = get_circuit_breaker(self.llm.base_url) if self.llm.base_url else None
+            # Stop also reaches requests still queued in the rate limiter.
+            with request_cancel_event(self._interrupt_event):
+                instructions = self.retry_policy.call(get_instructions, circuit_breaker, self._interrupt_event)
+        except RequestCancelled:
+            self.event_bus.publish(StatusEvent('Interrupted'))
+            logging.info('Execution Interrupted')
+            return 'Interrupted'
+        except CircuitOpenError as e:
+            status = f'{ERROR_MESSAGES[SERVER_ERROR]} ({e})'
+            self.event_bus.publish(StatusEvent(status))
+            logging.error(status)
+            return status
+        except Exception as e:
+            error_class = classify_error(e)
+            status = ERROR_MESSAGES.get(error_class, f'Failed to fetch instructions: {e}')
+            self.event_bus.publish(StatusEvent(status))
+            logging.error(f'Giving up fetching instructions ({error_class}): {e}')
+            return status
+
+        if  self._interrupt_event.is_set():
+            self.event_bus.publish(StatusEvent('Interrupted'))
+            logging.info('Execution Interrupted')
+            return 'Interrupted'
+
+        # The screenshot the model just looked at, to tell afterwards whether its steps did anything.
+        watch_for_screen_change = self.llm.is_tiered and tier == SMALL_TIER and bool(instructions.get('steps'))
+        signature_before = self._get_screen_signature(latest=True) if watch_for_screen_change else None
+        plan_aborted = False
 
         try:
-            for step in instructions.get('steps', []): # Ensure 'steps' is a list
+            steps = instructions.get('steps', []) # Ensure 'steps' is a list
+            for step_index, step in enumerate(steps, start=1):
                 if self._interrupt_event.is_set():
-                    self.status_queue.put('Interrupted')
+                    self.event_bus.publish(StatusEvent('Interrupted'))
                     logging.info('Execution Interrupted')
                     return 'Interrupted'
+                justification = step.get('human_readable_justification') if isinstance(step, dict) else None
+                if justification:
+                    self.event_bus.publish(ProgressEvent(justification, step_index, len(steps)))
+                next_step = steps[step_index] if step_index < len(steps) else None
+                verify_step = self.verify_actions and self._should_verify_step(step, next_step)
+                step_signature = self._get_screen_signature(latest=False) if verify_step else None
+                step_start_time = time.monotonic()
                 success = self.interpreter.process_command(step)
+                self.event_bus.publish(StepEvent(step_num, step, success, time.monotonic() - step_start_time))
                 if not success:
                     error_msg = f'Unable to process command step: {step}'
-                    self.status_queue.put(error_msg)
+                    self.event_bus.publish(StatusEvent(error_msg))
                     logging.error(error_msg)
                     return 'Unable to execute the request'
                 if  self._interrupt_event.is_set():
-                    self.status_queue.put('Interrupted')
+                    self.event_bus.publish(StatusEvent('Interrupted'))
                     logging.info('Execution Interrupted')
                     return 'Interrupted'
+                if step_signature and not self._screen_changed(step_num, step_signature, step):
+                    # The rest of the plan was made for a screen that didn't appear, ask again instead.
+                    status = f"{step.get('function')} didn't change the screen, skipping the remaining " \
+                             f'{len(steps) - step_index} steps and planning again'
+                    self.event_bus.publish(StatusEvent(status))
+                    logging.warning(status)
+                    plan_aborted = True
+                    break
 
 
         except Exception as e:
             status = f'Exception Unable to execute the request - {e}'
-            self.status_queue.put(status)
+            self.event_bus.publish(StatusEvent(status))
             logging.error(status)
             return status
 
-        if instructions.get('done'):
+        if instructions.get('done') and not plan_aborted:
             # Communicate Results
-            self.status_queue.put(instructions['done'])
+            self.event_bus.publish(DoneEvent(instructions['done']))
             self.play_ding_on_completion()
             return instructions['done']
         else:
             # if not done, continue to next phase
-            self.status_queue.put('Fetching further instructions based on current state')
-            return self.execute(user_request, step_num + 1)
+            self.event_bus.publish(StatusEvent('Fetching further instructions based on current state'))
+            next_tier = SMALL_TIER
+            if plan_aborted:
+                if self.llm.is_tiered and tier == SMALL_TIER:
+                    self.llm.tier_stats.record_escalation(ESCALATION_NO_SCREEN_CHANGE)
+                    next_tier = LARGE_TIER
+            elif signature_before and not self._screen_changed(step_num, signature_before):
+                self.llm.tier_stats.record_escalation(ESCALATION_NO_SCREEN_CHANGE)
+                next_tier = LARGE_TIER
+            return self.execute(user_request, step_num + 1, next_tier)
+
+    def _get_escalation_reason(self, instructions: Optional[dict[str, Any]], tier: str) -> Optional[str]:
+        """Why a small model round has to be redone on the large model, or None if it doesn't."""
+        if not self.llm.is_tiered or tier != SMALL_TIER:
+            return None
+        if not instructions or 'error' in instructions:
+            return ESCALATION_PARSE_FAILURE
+        problems = self.interpreter.validate_instructions(instructions)
+        if problems:
+            logging.warning(f'Small model instructions failed validation: {problems}')
+            return ESCALATION_VALIDATION_FAILURE
+        return None
+
+    @staticmethod
+    def _should_verify_step(step: Any, next_step: Any) -> bool:
+        """
+        Whether step should visibly change the screen before next_step runs. The last step isn't checked, the next
+        round looks at the screen anyway, and neither is a step the model follows with a wait of its own.
+        """
+        if not isinstance(step, dict) or not isinstance(next_step, dict):
+            return False
+        return step.get('function') in VERIFIED_ACTIONS and next_step.get('function') not in WAITING_ACTIONS
+
+    def _screen_changed(self, step_num: int, signature_before: bytes, step: Optional[dict[str, Any]] = None) -> bool:
+        """
+        Whether the screen changed from signature_before, after step (waiting for it up to its verification timeout)
+        or, when step is None, after the plan of round step_num. Published so recordings can replay the same answer.
+        """
+        if step is not None:
+            changed = self._wait_for_screen_change(signature_before, step)
+        else:
+            signature_after = self._get_screen_signature(latest=False)
+            changed = signature_after is None or \
+                signature_difference(signature_before, signature_after) >= SCREEN_CHANGE_THRESHOLD
+        self.event_bus.publish(ScreenChangeEvent(step_num, step, changed))
+        return changed
+
+    def _wait_for_screen_change(self, signature_before: bytes, step: dict[str, Any]) -> bool:
+        """Whether the screen changed from signature_before within the step's verification timeout."""
+        timeout = OPEN_APPLICATION_VERIFICATION_TIMEOUT if step.get('function') == 'open_application' else \
+            self.action_verification_timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            signature_after = self._get_screen_signature(latest=False, max_age=ACTION_VERIFICATION_POLL_INTERVAL)
+            if signature_after is None or \
+                    signature_difference(signature_before, signature_after) >= SCREEN_CHANGE_THRESHOLD:
+                return True  # Changed, or can't tell, which mustn't abort a plan
+            if time.monotonic() >= deadline:
+                return False
+            if self._interrupt_event.wait(ACTION_VERIFICATION_POLL_INTERVAL):
+                return True  # The step loop stops for the interrupt
+
+    def _get_screen_signature(self, latest: bool, max_age: float = DEFAULT_MAX_FRAME_AGE) -> Optional[bytes]:
+        """Change signature of the last captured frame, or of a fresh screenshot when latest is False."""
+        try:
+            screen = self.interpreter.screen
+            frame = screen.get_latest_frame()[1] if latest else screen.get_frame(max_age).image
+            return get_change_signature(frame) if frame else None
+        except Exception as e:
+            logging.error(f'Error checking for screen changes: {e}')
+            return None
 
     def play_ding_on_completion(self):
         # Play ding sound to signal completion
-        if self.settings_dict.get('play_ding_on_completion'):
+        if Settings().get_dict().get('play_ding_on_completion'):
             print('\a')
 
     def cleanup(self):
+        Settings().unsubscribe(self._on_settings_changed)
         if self.llm:
             self.llm.cleanup()
         logging.info("Core cleanup complete")
\ No newline at end of file
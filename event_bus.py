@@ -0,0 +1,150 @@
+import logging
+import threading
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+if TYPE_CHECKING:
+    from frame_buffer import Frame
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+@dataclass(frozen=True)
+class Event:
+    """Base class for everything published on the EventBus."""
+
+
+@dataclass(frozen=True)
+class StatusEvent(Event):
+    """Something the user should see, e.g. an error or that execution was interrupted."""
+    message: str
+
+
+@dataclass(frozen=True)
+class ScreenshotEvent(Event):
+    """A screenshot was taken and sent to the model. path is only set when screenshots are saved to disk."""
+    message: str
+    path: Optional[str] = None
+    frame: Optional['Frame'] = None
+
+
+@dataclass(frozen=True)
+class ModelCallEvent(Event):
+    """
+    A model answered. request is the message content it was sent, response the raw text of its answer, and
+    model_frame the (capture region, image size) its coordinates refer to.
+    """
+    model_name: str
+    step_num: int
+    request: Any
+    response: str
+    latency: float
+    frame: Optional['Frame'] = None
+    model_frame: Optional[tuple] = None
+
+
+@dataclass(frozen=True)
+class RoundEvent(Event):
+    """
+    Core asked the LLM for a round of instructions. When that failed, error and error_class (see retry_policy) are set
+    instead of instructions.
+    """
+    step_num: int
+    tier: str
+    instructions: Optional[dict[str, Any]]
+    latency: float
+    error: Optional[str] = None
+    error_class: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class StepEvent(Event):
+    """A step of the current plan was executed."""
+    step_num: int
+    step: Any
+    success: bool
+    duration: float
+
+
+@dataclass(frozen=True)
+class ScreenChangeEvent(Event):
+    """
+    Core checked whether the screen changed, after step when it verifies actions, or after the whole plan of round
+    step_num when step is None. changed is what Core went on.
+    """
+    step_num: int
+    step: Any
+    changed: bool
+
+
+@dataclass(frozen=True)
+class RequestStartedEvent(Event):
+    """Core started working on a request."""
+    request: str
+
+
+@dataclass(frozen=True)
+class RequestFinishedEvent(Event):
+    """Core is done with a request, result is what execute() returned."""
+    request: str
+    result: Optional[str]
+    duration: float
+
+
+@dataclass(frozen=True)
+class ProgressEvent(Event):
+    """A step of the current plan is about to run."""
+    message: str
+    step: int
+    total_steps: int
+
+
+@dataclass(frozen=True)
+class DoneEvent(Event):
+    """The AI's final answer for a user request."""
+    message: str
+
+
+@dataclass(frozen=True)
+class UserRequestEvent(Event):
+    """A request typed or spoken into the desktop UI, or submitted from the mobile page."""
+    request: str
+
+
+@dataclass(frozen=True)
+class StopRequestEvent(Event):
+    """The user asked to stop whatever is running."""
+
+
+class EventBus:
+    """
+    In-process publish/subscribe between Core, the UIs, the web server and trace recorders.
+
+    publish() calls every matching subscriber right away on the publishing thread, so there is no polling and no
+    pickling, and nothing wakes up while the app is idle. Subscribers must be quick and must not block, and anything
+    that touches Tk has to hand off to the Tk thread.
+    """
+
+    def __init__(self):
+        self._subscribers: list[tuple[Callable[[Event], None], tuple[type, ...]]] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback: Callable[[Event], None], event_types: Optional[tuple[type, ...]] = None) -> None:
+        """Calls callback for every published event that is an instance of one of event_types (default: all)."""
+        with self._lock:
+            self._subscribers.append((callback, event_types or (Event,)))
+
+    def unsubscribe(self, callback: Callable[[Event], None]) -> None:
+        with self._lock:
+            self._subscribers = [(cb, types) for cb, types in self._subscribers if cb != callback]
+
+    def publish(self, event: Event) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback, event_types in subscribers:
+            if isinstance(event, event_types):
+                try:
+                    callback(event)
+                except Exception as e:
+                    logging.error(f'Error delivering {type(event).__name__} to {callback}: {e}')
@@ -0,0 +1,85 @@
+import json
+import logging
+import threading
+from typing import Any, Optional
+
+from event_bus import DoneEvent, Event, ProgressEvent, ScreenshotEvent, StatusEvent, UserRequestEvent
+from message_store import MessageStore
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+USER_EVENT = 'user'
+AI_EVENT = 'ai'
+STATUS_EVENT = 'status'
+
+
+class EventStream:
+    """
+    Conversation events (user requests, AI replies and status updates) for the mobile view.
+
+    Events are kept in a MessageStore, which gives every event a monotonically increasing id and bounds how many are
+    held in memory. Server-Sent Events clients resume with Last-Event-ID from there, and listeners block on a condition
+    instead of polling.
+    """
+
+    def __init__(self, max_buffered_events: int = 500):
+        self._store = MessageStore(capacity=max_buffered_events)
+        self._condition = threading.Condition()
+
+    @property
+    def last_event_id(self) -> int:
+        return self._store.last_id
+
+    def publish(self, kind: str, text: str) -> int:
+        with self._condition:
+            event = self._store.append(kind, text)
+            self._condition.notify_all()
+            return event['id']
+
+    def handle_event(self, event: Event) -> Optional[int]:
+        """EventBus subscriber that records the events the mobile view shows."""
+        if isinstance(event, UserRequestEvent):
+            return self.publish(USER_EVENT, event.request)
+        if isinstance(event, DoneEvent):
+            return self.publish(AI_EVENT, event.message)
+        if isinstance(event, (StatusEvent, ProgressEvent, ScreenshotEvent)):
+            # Screenshot paths are local to this machine so only the message is useful remotely.
+            return self.publish(STATUS_EVENT, event.message)
+        return None
+
+    def events_since(self, last_event_id: int, limit: Optional[int] = None) -> list[dict[str, Any]]:
+        return self._store.since(last_event_id, limit)
+
+    def events_before(self, before_event_id: int, limit: int) -> list[dict[str, Any]]:
+        return self._store.before(before_event_id, limit)
+
+    def wait_for_events(self, last_event_id: int, timeout: float) -> list[dict[str, Any]]:
+        """Blocks until there are events newer than last_event_id, or the timeout expires."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._store.last_id > last_event_id, timeout=timeout)
+        return self._store.since(last_event_id)
+
+    def get_messages(self, limit: int = 100) -> list[tuple[str, str]]:
+        """The most recent events as (kind, text) tuples, for rendering the page."""
+        return [(event['kind'], event['text']) for event in self._store.recent(limit)]
+
+    def get_messages_and_last_event_id(self, limit: int = 100) -> tuple[list[tuple[str, str]], int]:
+        """
+        get_messages() and the id of the last of them, read together so a page streaming from that id neither misses
+        an event nor shows one twice.
+        """
+        with self._condition:  # Held by publish()
+            return self.get_messages(limit), self._store.last_id
+
+    def close(self) -> None:
+        self._store.close()
+
+
+def format_server_sent_event(event: dict[str, Any]) -> str:
+    data = json.dumps({'text': event['text']})
+    return f"id: {event['id']}\nevent: {event['kind']}\ndata: {data}\n\n"
+
+
+# Shared by the desktop app, which publishes into it, and the web server, which streams out of it.
+conversation_events = EventStream()
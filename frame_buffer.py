@@ -0,0 +1,173 @@
+import io
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Optional
+
+from PIL import Image
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+DEFAULT_RING_SIZE = 4  # A 1080p frame is about 6 MB decoded
+DEFAULT_CAPTURE_INTERVAL = 0.5  # seconds between background captures, 0 turns the background capture off
+DEFAULT_MAX_FRAME_AGE = 1.0  # seconds a buffered frame may be old and still count as the current screen
+
+
+class Frame:
+    """
+    A captured screen image and everything derived from it.
+
+    Encodings and downscaled copies are made once, by whichever consumer asks first, and shared by everyone else: the
+    upload, the UI thumbnail and the live preview read the same cached bytes through read only memoryviews instead of
+    each encoding the frame again or reading it back from disk. Frames are never modified after they're published.
+    """
+
+    def __init__(self, frame_id: int, image: Image.Image, captured_at: float):
+        self.frame_id = frame_id
+        self.image = image
+        self.captured_at = captured_at  # time.monotonic() when the capture started
+        self._derived: dict[tuple, Any] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self.image.size
+
+    @property
+    def capture_region(self) -> Optional[tuple[int, int, int, int]]:
+        return self.image.info.get('capture_region')
+
+    def _get_derived(self, key: tuple, make: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key in self._derived:
+                return self._derived[key]
+        # Made outside the lock so one slow encoding doesn't hold up the others, rarely made twice.
+        value = make()
+        with self._lock:
+            return self._derived.setdefault(key, value)
+
+    def pixels(self) -> memoryview:
+        """Raw pixel data, in the image's mode, row by row."""
+        return memoryview(self._get_derived(('pixels',), self.image.tobytes))
+
+    def resized(self, max_width: Optional[int] = None) -> Image.Image:
+        """The frame scaled down to max_width, or the frame itself if it's no wider than that."""
+        if not max_width or self.image.width <= max_width:
+            return self.image
+
+        def downscale() -> Image.Image:
+            # reduce() is a cheap box filter for the bulk of the downscale, resize() handles the remainder.
+            scaled = self.image
+            factor = scaled.width // max_width
+            if factor > 1:
+                scaled = scaled.reduce(factor)
+            if scaled.width > max_width:
+                scaled = scaled.resize((max_width, round(scaled.height * max_width / scaled.width)),
+                                       Image.Resampling.BOX)
+            return scaled
+
+        return self._get_derived(('resized', max_width), downscale)
+
+    def encode(self, image_format: str = 'PNG', max_width: Optional[int] = None,
+               quality: Optional[int] = None) -> memoryview:
+        """The frame, scaled down to max_width, encoded as image_format. quality only applies to lossy formats."""
+        def make_encoding() -> bytes:
+            image = self.resized(max_width)
+            if image_format == 'JPEG':
+                image = image.convert('RGB')
+            encoded = io.BytesIO()
+            image.save(encoded, format=image_format, **({'quality': quality} if quality else {}))
+            return encoded.getvalue()
+
+        return memoryview(self._get_derived(('encoded', image_format, max_width, quality), make_encoding))
+
+    def thumbnail(self, max_size: tuple[int, int]) -> Image.Image:
+        def make_thumbnail() -> Image.Image:
+            thumbnail = self.resized(max_size[0]).copy()
+            thumbnail.thumbnail(max_size)
+            return thumbnail
+
+        return self._get_derived(('thumbnail', max_size), make_thumbnail)
+
+
+class FrameBuffer:
+    """
+    The latest frame and a small ring of recent ones, kept in memory for every consumer in the process.
+
+    A background thread can keep the buffer filled so a round usually finds a current frame waiting instead of paying
+    for a capture. Frames captured before the last mark_stale() (input was sent, the screen may have changed) are never
+    handed out as current.
+    """
+
+    def __init__(self, size: int = DEFAULT_RING_SIZE):
+        self._frames: deque[Frame] = deque(maxlen=size)
+        self._condition = threading.Condition()
+        self._next_frame_id = 1
+        self._stale_at = 0.0
+        self._capture_thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+
+    def publish(self, image: Image.Image, captured_at: Optional[float] = None) -> Frame:
+        with self._condition:
+            frame = Frame(self._next_frame_id, image, captured_at if captured_at is not None else time.monotonic())
+            self._next_frame_id += 1
+            self._frames.append(frame)
+            self._condition.notify_all()
+        return frame
+
+    def latest(self) -> Optional[Frame]:
+        with self._condition:
+            return self._frames[-1] if self._frames else None
+
+    def recent(self) -> list[Frame]:
+        """Buffered frames, oldest first."""
+        with self._condition:
+            return list(self._frames)
+
+    def get(self, frame_id: int) -> Optional[Frame]:
+        with self._condition:
+            return next((frame for frame in self._frames if frame.frame_id == frame_id), None)
+
+    def wait_for_new_frame(self, last_frame_id: int, timeout: float) -> Optional[Frame]:
+        """Blocks until a frame newer than last_frame_id is published, returns the latest frame either way."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._frames and self._frames[-1].frame_id > last_frame_id,
+                                     timeout=timeout)
+            return self._frames[-1] if self._frames else None
+
+    def mark_stale(self) -> None:
+        """Input was just sent, frames captured before now may no longer show the screen."""
+        with self._condition:
+            self._stale_at = time.monotonic()
+
+    def get_current(self, capture: Callable[[], Frame], max_age: float = DEFAULT_MAX_FRAME_AGE) -> Frame:
+        """The latest frame if it's recent and not stale, otherwise a new one from capture."""
+        with self._condition:
+            frame = self._frames[-1] if self._frames else None
+            stale_at = self._stale_at
+        if frame is not None and frame.captured_at > stale_at and time.monotonic() - frame.captured_at <= max_age:
+            return frame
+        return capture()
+
+    def start(self, capture: Callable[[], Any], interval: float = DEFAULT_CAPTURE_INTERVAL) -> None:
+        """Calls capture every interval seconds on a background thread, until stop()."""
+        if interval <= 0 or (self._capture_thread and self._capture_thread.is_alive()):
+            return
+        self._stop_event.clear()
+
+        def capture_loop():
+            while not self._stop_event.wait(interval):
+                try:
+                    capture()
+                except Exception as e:
+                    logging.error(f'Background screen capture failed: {e}')
+                    self._stop_event.wait(max(interval, 5))  # Don't flood the log if capturing keeps failing
+
+        self._capture_thread = threading.Thread(target=capture_loop, name='frame-capture', daemon=True)
+        self._capture_thread.start()
+        logging.info(f'Capturing the screen in the background every {interval}s')
+
+    def stop(self) -> None:
+        self._stop_event.set()
@@ -0,0 +1,138 @@
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Optional, TypeVar
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+T = TypeVar('T')
+
+DEFAULT_HEDGE_PERCENTILE = 0.9
+DEFAULT_HEDGE_BUDGET = 0.1  # At most this many extra requests per round, on average
+DEFAULT_HEDGE_BURST = 3  # Hedges that can be saved up for a slow spell
+MIN_LATENCY_SAMPLES = 10  # Don't hedge until the percentile means something
+LATENCY_WINDOW = 100
+
+
+class RequestCancelled(Exception):
+    """Raised by a request that was abandoned because its hedge finished first."""
+
+
+class LatencyTracker:
+    """Latencies of the most recent rounds, to tell when a round is running unusually long."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        """None until MIN_LATENCY_SAMPLES rounds have been recorded."""
+        with self._lock:
+            if len(self._latencies) < MIN_LATENCY_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+class HedgeBudget:
+    """
+    Token bucket that caps the extra traffic hedging adds.
+
+    Every round earns `budget` tokens, up to `burst`, and a hedge spends one. With the default of 0.1, hedging adds at
+    most 10% more requests over time, however often rounds stall.
+    """
+
+    def __init__(self, budget: float = DEFAULT_HEDGE_BUDGET, burst: float = DEFAULT_HEDGE_BURST):
+        self.budget = budget
+        self.burst = burst
+        self._tokens = burst
+        self._lock = threading.Lock()
+
+    def earn(self) -> None:
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.budget)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class Hedger:
+    """
+    Runs a request, and if it hasn't finished by the p90 of recent latencies, races a duplicate against it.
+
+    Requests are callables that take a threading.Event and should give up (raising RequestCancelled) soon after it's
+    set. The first valid result wins and the other request is cancelled. If the first result to arrive isn't valid,
+    the other request is still given the chance to finish.
+    """
+
+    def __init__(self, percentile: float = DEFAULT_HEDGE_PERCENTILE, budget: float = DEFAULT_HEDGE_BUDGET):
+        self.percentile = percentile
+        self.latency_tracker = LatencyTracker()
+        self.budget = HedgeBudget(budget)
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='hedged-request')
+        self.hedged_rounds = 0
+        self.hedge_wins = 0
+
+    def run(self, primary: Callable[[threading.Event], T], hedge: Callable[[threading.Event], T],
+            is_valid: Callable[[T], bool]) -> T:
+        start_time = time.monotonic()
+        self.budget.earn()
+
+        primary_cancel = threading.Event()
+        # The requests run on pool threads, give them this thread's context so they keep its priority and cancel event.
+        primary_future = self._executor.submit(contextvars.copy_context().run, primary, primary_cancel)
+        hedge_delay = self.latency_tracker.percentile(self.percentile)
+        done, _ = wait([primary_future], timeout=hedge_delay)
+        if done or hedge_delay is None or not self.budget.try_spend():
+            result = primary_future.result()
+            self.latency_tracker.record(time.monotonic() - start_time)
+            return result
+
+        self.hedged_rounds += 1
+        logging.info(f'Request still running after {hedge_delay:.1f}s (p{int(self.percentile * 100)}), sending a hedge')
+        hedge_cancel = threading.Event()
+        hedge_future = self._executor.submit(contextvars.copy_context().run, hedge, hedge_cancel)
+        cancel_events = {primary_future: primary_cancel, hedge_future: hedge_cancel}
+
+        pending = {primary_future, hedge_future}
+        result, error = None, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    candidate = future.result()
+                except RequestCancelled:
+                    continue
+                except Exception as e:
+                    error = e
+                    continue
+                result = candidate
+                if is_valid(candidate):
+                    for loser in pending:
+                        cancel_events[loser].set()
+                    if future is hedge_future:
+                        self.hedge_wins += 1
+                    latency = time.monotonic() - start_time
+                    self.latency_tracker.record(latency)
+                    logging.info(f"{'Hedge' if future is hedge_future else 'Original request'} won after "
+                                 f'{latency:.1f}s, hedges won {self.hedge_wins}/{self.hedged_rounds}')
+                    return candidate
+
+        if result is None and error is not None:
+            raise error
+        return result
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
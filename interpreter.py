@@ -1,24 +1,153 @@
 import json
-from multiprocessing import Queue
-from time import sleep
-from typing import Any, Union
+from typing import Any, Optional, Union
 import logging
 import platform
 
 import pyautogui
 import subprocess
 import psutil
+from PIL import Image
+
+from event_bus import EventBus, StatusEvent
+from screen import AccessibilityObserver, Screen, TextIndex
+from settings import Settings
+from template_cache import get_template_cache
 
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+DEFAULT_FIND_TEXT_TIMEOUT = 5
+FIND_TEXT_POLL_INTERVAL = 0.5
+
+# The actions the LLM can use, as described in context.txt. Each parameter is a JSON schema, plus 'optional' for
+# parameters that may be null or left out, and 'aliases' for other names older responses use for it.
+_COORDINATE = {'type': 'integer'}
+_MOUSE_BUTTON = {'type': 'string', 'enum': ['left', 'right', 'middle'], 'optional': True}
+_CLICK_LABEL = {'type': 'string', 'optional': True}
+ACTIONS: dict[str, dict[str, dict[str, Any]]] = {
+    'sleep': {'secs': {'type': 'number'}},
+    'click': {'x': _COORDINATE, 'y': _COORDINATE, 'button': _MOUSE_BUTTON, 'label': _CLICK_LABEL},
+    'doubleClick': {'x': _COORDINATE, 'y': _COORDINATE, 'button': _MOUSE_BUTTON, 'label': _CLICK_LABEL},
+    'click_template': {'label': {'type': 'string'}, 'button': _MOUSE_BUTTON},
+    'click_element': {'element_id': {'type': 'integer'}, 'button': _MOUSE_BUTTON},
+    'double_click_element': {'element_id': {'type': 'integer'}, 'button': _MOUSE_BUTTON},
+    'click_text': {'text': {'type': 'string'}, 'occurrence': {'type': 'integer', 'optional': True},
+                   'button': _MOUSE_BUTTON},
+    'find_text': {'text': {'type': 'string'}, 'timeout': {'type': 'number', 'optional': True}},
+    'moveTo': {'x': _COORDINATE, 'y': _COORDINATE, 'duration': {'type': 'number', 'optional': True}},
+    'write': {'text': {'type': 'string', 'aliases': ('string',)}, 'interval': {'type': 'number', 'optional': True}},
+    'press': {'keys': {'type': 'string', 'aliases': ('key',)}, 'presses': {'type': 'integer', 'optional': True},
+              'interval': {'type': 'number', 'optional': True}},
+    'hotkey': {'keys': {'type': 'array', 'items': {'type': 'string'}}},
+    'scroll': {'amount': {'type': 'integer'}},
+    'open_application': {'application_name': {'type': 'string'}},
+    'close_application': {'application_name': {'type': 'string'}},
+}
+_JSON_TYPES = {'integer': (int,), 'number': (int, float), 'string': (str,), 'array': (list,)}
+
+
+def get_instructions_json_schema() -> dict[str, Any]:
+    """
+    JSON schema for LLM responses, generated from ACTIONS, for structured outputs in strict mode.
+
+    Strict mode needs every property listed as required and no additional properties, so optional parameters are
+    nullable instead, and each action gets its own step schema so the parameters match the function.
+    """
+    step_schemas = []
+    for function_name, parameters in ACTIONS.items():
+        parameter_properties = {}
+        for name, spec in parameters.items():
+            schema = {key: value for key, value in spec.items() if key not in ('optional', 'aliases')}
+            if spec.get('optional'):
+                schema['type'] = [schema['type'], 'null']
+                if 'enum' in schema:
+                    schema['enum'] = schema['enum'] + [None]
+            parameter_properties[name] = schema
+        step_schemas.append({
+            'type': 'object',
+            'properties': {
+                'function': {'type': 'string', 'enum': [function_name]},
+                'parameters': {
+                    'type': 'object',
+                    'properties': parameter_properties,
+                    'required': list(parameter_properties),
+                    'additionalProperties': False,
+                },
+                'human_readable_justification': {'type': 'string'},
+            },
+            'required': ['function', 'parameters', 'human_readable_justification'],
+            'additionalProperties': False,
+        })
+
+    return {
+        'type': 'object',
+        'properties': {
+            'steps': {'type': 'array', 'items': {'anyOf': step_schemas}},
+            'done': {'type': ['string', 'null']},
+        },
+        'required': ['steps', 'done'],
+        'additionalProperties': False,
+    }
+
 
 class Interpreter:
-    def __init__(self, status_queue: Queue):
-        # MP Queue to put current status of execution in while processes commands.
+    def __init__(self, event_bus: EventBus, input_backend: Any = pyautogui, screen: Optional[Screen] = None,
+                 remember_click_targets: bool = True):
+        """
+        input_backend sends mouse and keyboard input, pyautogui or something with the same functions (e.g. a virtual
+        backend for replays), and screen is where OCR and template lookups get their frames.
+        """
+        # Event bus to publish the current status of execution on while processing commands.
         # It helps us reflect the current status on the UI.
-        self.status_queue = status_queue
+        self.event_bus = event_bus
+        self.input_backend = input_backend
+        self.screen = screen or Screen()
+        # Remembers what successful clicks looked like, so click_template can find the same targets again.
+        self.template_cache = get_template_cache() if Settings().get_dict().get('template_cache', True) else None
+        self.remember_click_targets = remember_click_targets
+
+    def validate_instructions(self, instructions: dict[str, Any]) -> list[str]:
+        """
+        Checks instructions from the LLM without executing anything.
+        :return: A list of problems, empty when every step can be executed as given.
+        """
+        if not isinstance(instructions, dict):
+            return ['Instructions are not a JSON object']
+        problems = []
+        steps = instructions.get('steps', [])
+        done = instructions.get('done')
+        if not isinstance(steps, list):
+            return [f"'steps' is not a list: {steps!r}"]
+        if done is not None and not isinstance(done, str):
+            problems.append(f"'done' is not a string or null: {done!r}")
+        if not steps and not done:
+            problems.append('No steps and no done message')
+
+        for index, step in enumerate(steps, start=1):
+            if not isinstance(step, dict):
+                problems.append(f'Step {index} is not a JSON object')
+                continue
+            function_name = step.get('function')
+            parameters = step.get('parameters', {})
+            if not isinstance(parameters, dict):
+                problems.append(f"Step {index} ({function_name}) parameters are not a JSON object")
+                continue
+            if function_name not in ACTIONS:
+                if not (isinstance(function_name, str) and hasattr(pyautogui, function_name)):
+                    problems.append(f'Step {index} has unknown function {function_name!r}')
+                continue
+            if function_name == 'hotkey' and 'keys' not in parameters and parameters:
+                continue  # Older responses pass each key as its own parameter
+            for name, spec in ACTIONS[function_name].items():
+                names = (name, *spec.get('aliases', ()))
+                value = next((parameters[n] for n in names if parameters.get(n) not in (None, '')), None)
+                if value is None:
+                    if not spec.get('optional'):
+                        problems.append(f"Step {index} ({function_name}) is missing {' or '.join(names)}")
+                elif isinstance(value, bool) or not isinstance(value, _JSON_TYPES[spec['type']]):
+                    problems.append(f"Step {index} ({function_name}) {name} is not a {spec['type']}: {value!r}")
+        return problems
 
     def process_commands(self, json_commands: list[dict[str, Any]]) -> bool:
         """
@@ -40,15 +169,16 @@ class Interpreter:
         :return: True for successful execution, False for exception while interpreting or executing.
         """
         function_name = json_command.get('function')
-        parameters = json_command.get('parameters', {})
+        # Structured outputs send optional parameters as null, leave them out so the defaults below apply.
+        parameters = {name: value for name, value in (json_command.get('parameters') or {}).items() if value is not None}
         human_readable_justification = json_command.get('human_readable_justification')
 
         if not function_name:
             logging.error(f"Missing 'function' key in JSON command: {json_command}")
             return False
 
+        # Core publishes the justification as progress, so it's only logged here.
         logging.info(f'Now performing - {function_name} - {parameters} - {human_readable_justification}')
-        self.status_queue.put(human_readable_justification)
 
         try:
             self.execute_function(function_name, parameters)
@@ -58,6 +188,9 @@ class Interpreter:
             logging.exception(f'Exception details:')  # Log the full traceback
             logging.error(f'This was the json we received from the LLM: {json.dumps(json_command, indent=2)}')
             return False
+        finally:
+            # Buffered frames from before the step may not show the screen any more.
+            Screen.frame_buffer.mark_stale()
 
     def execute_function(self, function_name: str, parameters: dict[str, Any]) -> None:
         """
@@ -68,27 +201,37 @@ class Interpreter:
 
         # Warm up pyautogui, but make it conditional on the OS.
         if platform.system() == "Darwin":  # Check for macOS
-            pyautogui.press("command", interval=0.2)
+            self.input_backend.press("command", interval=0.2)
 
         if function_name == "sleep" and parameters.get("secs"):
             self._execute_sleep(parameters.get("secs"))
-        elif hasattr(pyautogui, function_name):
+        elif hasattr(self.input_backend, function_name):
             self._execute_pyautogui_function(function_name, parameters)
+        elif function_name in ("click_element", "double_click_element") and parameters.get("element_id") is not None:
+            self._execute_click_element(parameters, clicks=2 if function_name == "double_click_element" else 1)
+        elif function_name == "click_template" and parameters.get("label"):
+            self._execute_click_template(parameters)
+        elif function_name == "click_text" and parameters.get("text"):
+            self._execute_click_text(parameters)
+        elif function_name == "find_text" and parameters.get("text"):
+            self._execute_find_text(parameters)
         elif function_name == "open_application" and parameters.get("application_name"):
             self._execute_open_application(parameters.get("application_name"))
+            self._forget_foreground_application()
         elif function_name == "close_application" and parameters.get("application_name"):
             self._execute_close_application(parameters.get("application_name"))
+            self._forget_foreground_application()
         else:
             logging.warning(f'No such function {function_name} in our interface\'s interpreter')
 
     def _execute_sleep(self, secs: Union[int, float]):
         """Executes a sleep command"""
-        sleep(secs)
+        self.input_backend.sleep(secs)
 
     def _execute_pyautogui_function(self, function_name: str, parameters: dict[str, Any]) -> None:
         """Executes a pyautogui function with specific parameter handling"""
 
-        function_to_call = getattr(pyautogui, function_name)
+        function_to_call = getattr(self.input_backend, function_name)
 
         try:
             if function_name == 'write' and ('string' in parameters or 'text' in parameters):
@@ -126,26 +269,124 @@ class Interpreter:
         function_to_call(keys_to_press, presses=presses, interval=interval)
 
     def _execute_hotkey(self, function_to_call, parameters):
-        function_to_call(list(parameters.values()))
+        keys = parameters.get('keys')
+        if not isinstance(keys, list):
+            keys = list(parameters.values())
+        function_to_call(*keys)
 
     def _execute_scroll(self, function_to_call, parameters):
         amount = parameters.get('amount', 100)
         function_to_call(amount)
 
     def _execute_move_to(self, function_to_call, parameters):
-        x, y = parameters.get('x'), parameters.get('y')
+        x, y = Screen.model_to_screen(parameters.get('x'), parameters.get('y'))
         duration = parameters.get('duration', 0.2)
         function_to_call(x, y, duration=duration)
 
     def _execute_click(self, function_to_call, parameters):
-        x, y = parameters.get('x'), parameters.get('y')
+        x, y = Screen.model_to_screen(parameters.get('x'), parameters.get('y'))
         button = parameters.get('button', 'left')
+        frame = self._capture_for_template(parameters.get('label'))
         function_to_call(x=x, y=y, button=button)
+        self._remember_click_target(frame, parameters.get('label'), x, y)
 
     def _execute_double_click(self, function_to_call, parameters):
-        x, y = parameters.get('x'), parameters.get('y')
+        x, y = Screen.model_to_screen(parameters.get('x'), parameters.get('y'))
         button = parameters.get('button', 'left')
+        frame = self._capture_for_template(parameters.get('label'))
         function_to_call(x=x, y=y, button=button, clicks=2)
+        self._remember_click_target(frame, parameters.get('label'), x, y)
+
+    def _execute_click_element(self, parameters, clicks: int):
+        """Clicks the center of an element from the last accessibility snapshot sent to the LLM"""
+        element = AccessibilityObserver.get_element(parameters.get('element_id'))
+        if element is None:
+            raise ValueError(f"No element with id {parameters.get('element_id')} in the last accessibility snapshot")
+        left, top, width, height = element['box']
+        x, y = left + width // 2, top + height // 2
+        frame = self._capture_for_template(element.get('name'))
+        self.input_backend.click(x=x, y=y, button=parameters.get('button', 'left'), clicks=clicks)
+        if frame is not None:
+            frame_left, frame_top = Screen.screen_to_frame(frame, left, top)
+            frame_right, frame_bottom = Screen.screen_to_frame(frame, left + width, top + height)
+            frame_box = [frame_left, frame_top, frame_right - frame_left, frame_bottom - frame_top]
+            self._remember_click_target(frame, element.get('name'), x, y, frame_box)
+
+    def _execute_click_template(self, parameters):
+        """Clicks a target remembered from an earlier labelled click in the same application"""
+        label = parameters.get('label')
+        if self.template_cache is None:
+            raise ValueError('The template cache is turned off in settings')
+        app = self.template_cache.get_application()
+        frame = self.screen.get_frame().image
+        point = self.template_cache.locate(app, label, frame)
+        if point is None:
+            raise ValueError(f'No remembered target {label!r} on screen in {app}')
+        x, y = Screen.frame_to_screen(frame, *point)
+        self.input_backend.click(x=x, y=y, button=parameters.get('button', 'left'))
+
+    def _forget_foreground_application(self) -> None:
+        """The next template lookup or save checks which application is in front again"""
+        if self.template_cache is not None:
+            self.template_cache.forget_application()
+
+    def _capture_for_template(self, label: Optional[str]) -> Optional[Image.Image]:
+        """The screen before a labelled click, while the target still looks like it will next time"""
+        if self.template_cache is None or not self.remember_click_targets or not label:
+            return None
+        try:
+            return self.screen.get_frame().image
+        except Exception as e:
+            logging.error(f'Error capturing the click target for {label!r}: {e}')
+            return None
+
+    def _remember_click_target(self, frame: Optional[Image.Image], label: Optional[str], x: float, y: float,
+                               frame_box: Optional[list[float]] = None) -> None:
+        """Saves the target of a successful click, at screen coordinates x, y and with bounds in frame pixels"""
+        if self.template_cache is None or not self.remember_click_targets or frame is None or not label:
+            return
+        try:
+            self.template_cache.save(self.template_cache.get_application(), label, frame,
+                                     Screen.screen_to_frame(frame, x, y), frame_box)
+        except Exception as e:
+            logging.error(f'Error saving the click target for {label!r}: {e}')
+
+    def _find_text_on_screen(self, text: str) -> tuple[Image.Image, TextIndex, list[dict[str, Any]]]:
+        frame = self.screen.get_frame(max_age=FIND_TEXT_POLL_INTERVAL).image
+        index = TextIndex.for_frame(frame)
+        return frame, index, index.find(text)
+
+    def _execute_click_text(self, parameters):
+        """Clicks visible text, found with OCR on a fresh screenshot"""
+        text = parameters.get('text')
+        frame, index, matches = self._find_text_on_screen(text)
+        if not matches:
+            raise ValueError(f"Text {text!r} is not on screen")
+
+        # Among matches about as good as the best, the model counts occurrences in reading order.
+        best_score = matches[0]['score']
+        candidates = sorted((match for match in matches if match['score'] >= best_score - 0.05),
+                            key=lambda match: (match['box'][1], match['box'][0]))
+        match = candidates[min(max(parameters.get('occurrence', 1), 1), len(candidates)) - 1]
+        left, top, width, height = match['box']
+        x, y = index.to_screen_coordinates(left + width / 2, top + height / 2)
+        logging.info(f"Clicking {match['text']!r} at ({x}, {y}), match {match['score']:.2f}")
+        self.input_backend.click(x=x, y=y, button=parameters.get('button', 'left'))
+        self._remember_click_target(frame, text, x, y, match['box'])
+
+    def _execute_find_text(self, parameters):
+        """Waits for text to appear on screen, failing the step if it doesn't within the timeout"""
+        text = parameters.get('text')
+        # Counted in polls rather than against the clock, so a virtual input backend's sleep() speeds it up too.
+        polls = max(1, round(parameters.get('timeout', DEFAULT_FIND_TEXT_TIMEOUT) / FIND_TEXT_POLL_INTERVAL))
+        for poll in range(polls + 1):
+            _, _, matches = self._find_text_on_screen(text)
+            if matches:
+                logging.info(f"Found {matches[0]['text']!r} at {matches[0]['box']}")
+                return
+            if poll < polls:
+                self.input_backend.sleep(FIND_TEXT_POLL_INTERVAL)
+        raise ValueError(f"Text {text!r} did not appear on screen")
 
     def _execute_open_application(self, application_name: str):
          """Opens an application using subprocess.Popen"""
@@ -154,10 +395,10 @@ class Interpreter:
               subprocess.Popen(application_name)
          except FileNotFoundError:
               logging.error(f"Application not found: {application_name}")
-              self.status_queue.put(f"Application not found: {application_name}")
+              self.event_bus.publish(StatusEvent(f"Application not found: {application_name}"))
          except Exception as e:
               logging.error(f"Error opening application: {application_name}. Error {e}")
-              self.status_queue.put(f"Error opening application: {application_name}")
+              self.event_bus.publish(StatusEvent(f"Error opening application: {application_name}"))
 
     def _execute_close_application(self, application_name: str):
         """Closes an application using psutil"""
@@ -171,7 +412,8 @@ class Interpreter:
                     break
              else:
                logging.warning(f'No application found with name {application_name}')
-               self.status_queue.put(f'No application found with name {application_name}')
+               self.event_bus.publish(StatusEvent(f'No application found with name {application_name}'))
         except Exception as e:
              logging.error(f"Error closing application: {application_name}. Error: {e}")
-             self.status_queue.put(f"Error closing application: {application_name}")
\ No newline at end of file
+             self.event_bus.publish(StatusEvent(f"Error closing application: {application_name}"))
+
@@ -1,18 +1,31 @@
 from pathlib import Path
-from typing import Any
+from typing import Any, Optional
 import logging
 
 from models.factory import ModelFactory
-from local_info import *
-from models.gpt4o import GPT4o
+from models.rate_limiter import request_priority, BACKGROUND_PRIORITY
+import local_info
+from models.gpt4o import GPT4o, CANCELLED_RUN_TIMEOUT
+from model_tiers import (TierStats, SMALL_TIER, LARGE_TIER, TIERED_MODEL_MODE, DEFAULT_SMALL_MODEL_NAME,
+                         DEFAULT_LARGE_MODEL_NAME)
+from request_classifier import classify_request, TEXT_ONLY
+from hedging import Hedger, DEFAULT_HEDGE_BUDGET
+from retry_policy import classify_error
 from screen import Screen
-from settings import Settings
-from multiprocessing import Queue
+from settings import Settings, SettingsChange
+from event_bus import EventBus, RoundEvent
 import threading
+import time
 
 
 DEFAULT_MODEL_NAME = 'gpt-4o'
 
+# Settings the model, or the context it's created with, depends on. Changing anything else doesn't need a new model.
+MODEL_SETTINGS_KEYS = frozenset({
+    'model', 'base_url', 'api_key', 'default_browser', 'custom_llm_instructions', 'number_of_screenshots',
+    'model_mode', 'small_model', 'large_model', 'hedge_base_url', 'structured_outputs'
+})
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -57,23 +70,102 @@ class LLM:
         to be communicated to the user if it's present.
     """
 
-    def __init__(self, status_queue: Queue):
-        self.status_queue = status_queue
+    def __init__(self, event_bus: EventBus):
+        self.event_bus = event_bus
         self.model = None
+        # In tiered mode self.model is the small model, and the large one is created the first time a round escalates.
+        self.large_model = None
+        self.tier_stats = TierStats()
+        # Duplicates of the current models for hedged requests, by model name. Each has its own assistant thread,
+        # since a thread can only have one active run.
+        self.hedge_models = {}
+        self.hedger = None
         self.settings_dict: dict[str, str] = {}
         self.model_name = None
         self.base_url = None
         self.api_key = None
+        # A rebuilt model is only swapped in while no request is active, begin_request() to end_request(), so every
+        # round of a request goes to the same assistant thread and sees the rounds before it.
+        self._request_lock = threading.Lock()
+        self._active_requests = 0
+        # Held while a round is using the model
+        self._round_lock = threading.Lock()
+        self._pending_model_lock = threading.Lock()
+        self._pending_model = None
+        self._model_generation = 0
         self._load_settings()
         self._create_model()
-        threading.Thread(target=self._wait_for_settings_change, daemon=True).start()
-
-
-    def _wait_for_settings_change(self):
+        self.hedger = Hedger(budget=float(self.settings_dict.get('hedge_budget', DEFAULT_HEDGE_BUDGET)))
+        Settings().subscribe(self._on_settings_changed)
+
+    def _on_settings_changed(self, change: SettingsChange) -> None:
+        self.settings_dict = change.settings
+        if self.hedger:
+            self.hedger.budget.budget = float(self.settings_dict.get('hedge_budget', DEFAULT_HEDGE_BUDGET))
+        if not change.affects(MODEL_SETTINGS_KEYS):
+            logging.info(f'Settings {sorted(change.changed_keys)} changed, the model does not need to be rebuilt.')
+            return
+
+        with self._pending_model_lock:
+            self._model_generation += 1
+            generation = self._model_generation
+        # Creating a model makes network calls, so it's built in the background while the current one keeps serving.
+        threading.Thread(target=self._rebuild_model, args=(generation,), daemon=True).start()
+
+    def _rebuild_model(self, generation: int) -> None:
+        try:
+            logging.info("Rebuilding model after a settings change.")
+            model_name, base_url, api_key = self.get_settings_values()
+            context = self.read_context_txt_file()
+            with request_priority(BACKGROUND_PRIORITY):
+                new_model = ModelFactory.create_model(model_name, base_url, api_key, context, self.event_bus)
+        except Exception as e:
+            logging.error(f'Error rebuilding model, keeping the current one: {e}')
+            return
 
-         Settings().wait_for_settings_change()
-         self._load_settings()
-         self._create_model()
+        with self._pending_model_lock:
+            if generation == self._model_generation:
+                stale_model, self._pending_model = self._pending_model, new_model
+            else:
+                # A newer settings change came in while this model was being built.
+                stale_model = new_model
+        if stale_model:
+            threading.Thread(target=stale_model.cleanup, daemon=True).start()
+
+        # Swap right away if no request is running, otherwise it happens when the running one ends.
+        with self._request_lock:
+            if not self._active_requests:
+                self._swap_in_pending_model()
+
+    def begin_request(self) -> None:
+        """The rounds until end_request() belong to one request, the model isn't swapped under them."""
+        with self._request_lock:
+            if not self._active_requests:
+                self._swap_in_pending_model()
+            self._active_requests += 1
+
+    def end_request(self) -> None:
+        with self._request_lock:
+            self._active_requests -= 1
+            if not self._active_requests:
+                self._swap_in_pending_model()
+
+    def _swap_in_pending_model(self) -> None:
+        """Makes the pending model current. Must be called with _request_lock held and no request active."""
+        with self._pending_model_lock:
+            new_model, self._pending_model = self._pending_model, None
+        if not new_model:
+            return
+
+        old_models = [self.model, self.large_model, *self.hedge_models.values()]
+        self.model = new_model
+        self.large_model = None  # Recreated with the new settings on the next escalation
+        self.hedge_models = {}
+        self.model_name, self.base_url, self.api_key = new_model.model_name, new_model.base_url, new_model.api_key
+        logging.info(f"Swapped in rebuilt model: {self.model_name}")
+        for old_model in old_models:
+            if old_model:
+                threading.Thread(target=old_model.cleanup, daemon=True).start()
 
     def _load_settings(self):
         """Load settings and set class attributes."""
@@ -99,18 +191,21 @@ class LLM:
         try:
             logging.info("Creating model.")
             context = self.read_context_txt_file()
-            self.model = ModelFactory.create_model(self.model_name, self.base_url, self.api_key, context, self.status_queue)
+            self.model = ModelFactory.create_model(self.model_name, self.base_url, self.api_key, context, self.event_bus)
             logging.info(f"Model created successfully: {self.model_name}")
 
         except Exception as e:
             logging.error(f'Error creating model: {e}')
             raise
 
-    def get_settings_values(self) -> tuple[str, str, str]:
-        model_name = self.settings_dict.get('model')
-        if not model_name:
-            model_name = DEFAULT_MODEL_NAME
-        base_url = self.settings_dict.get('base_url', '').strip('/')
+    @property
+    def is_tiered(self) -> bool:
+        return self.settings_dict.get('model_mode') == TIERED_MODEL_MODE
+
+    @staticmethod
+    def normalize_base_url(base_url: str) -> str:
+        """An OpenAI compatible API's URL as the client expects it, ending in /v1."""
+        base_url = base_url.strip('/')
         if not base_url:
             base_url = 'https://api.openai.com/v1'
 
@@ -119,6 +214,16 @@ class LLM:
 
         if not base_url.endswith('/v1'):
             base_url = base_url + '/v1'
+        return base_url
+
+    def get_settings_values(self) -> tuple[str, str, str]:
+        if self.is_tiered:
+            model_name = self.settings_dict.get('small_model') or DEFAULT_SMALL_MODEL_NAME
+        else:
+            model_name = self.settings_dict.get('model')
+        if not model_name:
+            model_name = DEFAULT_MODEL_NAME
+        base_url = self.normalize_base_url(self.settings_dict.get('base_url', ''))
 
         api_key = self.settings_dict.get('api_key')
         return model_name, base_url, api_key
@@ -166,9 +271,13 @@ class LLM:
 
 
         )
-        context += f' Locally installed apps are {",".join(locally_installed_apps)}.'
-        context += f' OS is {operating_system}.'
-        context += f' Primary screen size is {Screen().get_size()}.\n'
+        context += f' Locally installed apps are {",".join(local_info.get_locally_installed_apps())}.'
+        context += f' OS is {local_info.operating_system}.'
+        monitor_count = len(Screen.get_monitors())
+        context += f' Screen size is {Screen().get_size()}.'
+        if monitor_count > 1:
+            context += f' There are {monitor_count} monitors.'
+        context += '\n'
 
         if 'default_browser' in self.settings_dict and self.settings_dict['default_browser']:
             context += f'\nDefault browser is {self.settings_dict["default_browser"]}.'
@@ -180,25 +289,160 @@ class LLM:
 
         return context
 
-    def get_instructions_for_objective(self, original_user_request: str, step_num: int = 0) -> dict[str, Any]:
-        if not self.model:
+    def get_instructions_for_objective(self, original_user_request: str, step_num: int = 0,
+                                       tier: str = SMALL_TIER) -> dict[str, Any]:
+        """tier only matters in tiered mode, where it picks the small or the large model for this round."""
+        start_time = time.monotonic()
+        try:
+            instructions = self._get_round_instructions(original_user_request, step_num, tier)
+        except Exception as e:
+            self.event_bus.publish(RoundEvent(step_num, tier, None, time.monotonic() - start_time, str(e),
+                                              classify_error(e)))
+            raise
+        self.event_bus.publish(RoundEvent(step_num, tier, instructions, time.monotonic() - start_time))
+        return instructions
+
+    def _get_round_instructions(self, original_user_request: str, step_num: int, tier: str) -> dict[str, Any]:
+        # A round asked for outside of a request is a request of its own.
+        self.begin_request()
+        try:
+            with self._round_lock:
+                if not self.is_tiered:
+                    return self._get_instructions_for_objective(self.model, original_user_request, step_num)
+
+                model = self._get_large_model() if tier == LARGE_TIER else self.model
+                start_time = time.monotonic()
+                instructions = self._get_instructions_for_objective(model, original_user_request, step_num)
+                self.tier_stats.record_round(tier, time.monotonic() - start_time)
+                return instructions
+        finally:
+            self.end_request()
+
+    def _get_large_model(self):
+        """The large model for escalated rounds, created on first use. Must be called with _round_lock held."""
+        if not self.large_model:
+            large_model_name = self.settings_dict.get('large_model') or DEFAULT_LARGE_MODEL_NAME
+            try:
+                logging.info(f"Creating large model {large_model_name} for escalated rounds")
+                context = self.read_context_txt_file()
+                self.large_model = ModelFactory.create_model(large_model_name, self.base_url, self.api_key, context,
+                                                             self.event_bus)
+            except Exception as e:
+                logging.error(f'Error creating large model, staying on the small one: {e}')
+                return self.model
+        return self.large_model
+
+    def _get_instructions_for_objective(self, model, original_user_request: str, step_num: int = 0) -> dict[str, Any]:
+        if not model:
              logging.error("Model is not initialized")
              return {} # or raise an exception if that is more suitable
-        logging.info(f"Getting instructions from the model {self.model_name}")
+        logging.info(f"Getting instructions from the model {model.model_name}")
         try:
-            if self.model_name == "mistral-large":
-                 return self.model.get_instructions_for_objective(original_user_request, step_num)
+            text_only_instructions = self._get_text_only_instructions(model, original_user_request, step_num)
+            if text_only_instructions:
+                return text_only_instructions
+
+            if model.model_name == "mistral-large":
+                 return self._call_model(model, original_user_request, step_num)
             else:
-                if 'number_of_screenshots' in self.settings_dict and int(self.settings_dict['number_of_screenshots']) > 0 and isinstance(self.model, GPT4o):
-                    return self.model.get_instructions_for_objective(original_user_request, step_num)
+                if 'number_of_screenshots' in self.settings_dict and int(self.settings_dict['number_of_screenshots']) > 0 and isinstance(model, GPT4o):
+                    return self._call_model(model, original_user_request, step_num)
                 else:
-                    return self.model.get_instructions_for_objective(original_user_request, step_num)
+                    return self._call_model(model, original_user_request, step_num)
         except Exception as e:
 
             logging.error(f"Error in get_instructions_for_objective: {e}")
-            return {}
+            raise  # Core's retry policy decides what to do based on the kind of error
+
+    def _call_model(self, model, original_user_request: str, step_num: int) -> dict[str, Any]:
+        """
+        Gets instructions from model, hedged when hedge_requests is on: if the round runs past the p90 of recent
+        rounds, the same request goes to a duplicate model (at hedge_base_url if set) and the first valid answer wins.
+
+        Only a request's first round is hedged. The hedge asks on a new, empty thread, which has none of the rounds
+        before it, and when it wins its answer is added to model's thread so the next rounds see it there.
+        """
+        if not self.settings_dict.get('hedge_requests') or not self.hedger or step_num > 0:
+            return model.get_instructions_for_objective(original_user_request, step_num)
+
+        # Captured, uploaded and formatted once: the hedge asks about the very screenshot the original request sent.
+        prepared = model.prepare_request(original_user_request, step_num)
+        primary_finished = threading.Event()
+        hedge_answers = []
+
+        def primary(cancel_event):
+            try:
+                return model.send_prepared_request(prepared, cancel_event)
+            finally:
+                primary_finished.set()
+
+        def hedge(cancel_event):
+            hedge_model = self._get_hedge_model(model)
+            if not hedge_model:
+                return {}
+            hedge_model.reset_thread()
+            instructions = hedge_model.send_prepared_request(prepared, cancel_event)
+            hedge_answers.append(instructions)
+            return instructions
+
+        instructions = self.hedger.run(primary, hedge, is_valid=lambda instructions: bool(instructions) and
+                                       'error' not in instructions)
+        if hedge_answers and instructions is hedge_answers[0]:
+            # model's thread has the request without an answer, its run was cancelled
+            primary_finished.wait(CANCELLED_RUN_TIMEOUT)
+            model.add_answer(instructions)
+        return instructions
+
+    def _get_hedge_model(self, model):
+        """A second instance of model for hedged requests, created on first use."""
+        hedge_model = self.hedge_models.get(model.model_name)
+        if hedge_model:
+            return hedge_model
+        hedge_base_url = self.settings_dict.get('hedge_base_url', '').strip('/')
+        hedge_base_url = self.normalize_base_url(hedge_base_url) if hedge_base_url else model.base_url
+        try:
+            logging.info(f"Creating hedge model {model.model_name} at {hedge_base_url}")
+            hedge_model = ModelFactory.create_model(model.model_name, hedge_base_url, model.api_key, model.context,
+                                                    self.event_bus)
+        except Exception as e:
+            logging.error(f'Error creating hedge model: {e}')
+            return None
+        self.hedge_models[model.model_name] = hedge_model
+        return hedge_model
+
+    def _get_text_only_instructions(self, model, original_user_request: str, step_num: int) -> Optional[dict[str, Any]]:
+        """
+        Answers knowledge questions without capturing and uploading a screenshot. Returns None when the request needs
+        the screen after all, in which case the caller escalates to the vision path.
+        """
+        if not self.settings_dict.get('text_only_fast_path', True):
+            return None
+        if classify_request(original_user_request, step_num) != TEXT_ONLY:
+            return None
+
+        logging.info("Request looks like a question, trying the text-only fast path")
+        try:
+            instructions = model.get_text_only_instructions(original_user_request, step_num)
+        except Exception as e:
+            logging.error(f"Error in text-only fast path, escalating to vision: {e}")
+            return None
+
+        # A usable answer is a done message with no steps. Steps mean the model wants to act on the screen.
+        if isinstance(instructions, dict) and instructions.get('done') and not instructions.get('steps'):
+            return instructions
+        if instructions is not None:
+            logging.info("Text-only answer needs the screen, escalating to vision")
+        return None
 
     def cleanup(self):
+         Settings().unsubscribe(self._on_settings_changed)
+         if self.hedger:
+            self.hedger.shutdown()
+         for hedge_model in self.hedge_models.values():
+            hedge_model.cleanup()
+         if self.large_model:
+            logging.info(f"Cleaning up model {self.large_model.model_name}")
+            self.large_model.cleanup()
          if self.model:
 
             logging.info(f"Cleaning up model {self.model_name}")
@@ -1,36 +1,50 @@
 import os
 import platform
 import logging
-import psutil
+from functools import lru_cache
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 """
-List the apps the user has locally, default browsers, etc. 
+List the apps the user has locally, default browsers, etc.
+Nothing here runs at import time, the lookups happen (once) when they are first needed.
 """
 
-locally_installed_apps: list[str] = []
 operating_system: str = platform.platform()
 
-if platform.system() == "Darwin": # Check if it is macOS
+
+@lru_cache(maxsize=None)
+def get_locally_installed_apps() -> tuple[str, ...]:
+    if platform.system() != "Darwin": # Check if it is macOS
+        logging.info('Not on macOS, cannot list apps.')
+        return ("Unknown",)
     try:
-      locally_installed_apps = [app for app in os.listdir('/Applications') if app.endswith('.app')]
+      locally_installed_apps = tuple(app for app in os.listdir('/Applications') if app.endswith('.app'))
       logging.info(f'Successfully listed {len(locally_installed_apps)} apps.')
+      return locally_installed_apps
     except FileNotFoundError as e:
       logging.warning(f'Applications folder not found. Error: {e}')
-      locally_installed_apps = ["Unknown"]
     except PermissionError as e:
         logging.warning(f'Permission error when reading the applications folder. Error: {e}')
-        locally_installed_apps = ["Unknown"]
     except Exception as e:
         logging.error(f'An unexpected error has occurred when reading the applications folder. Error: {e}')
-        locally_installed_apps = ["Unknown"]
-else:
-    logging.info('Not on macOS, cannot list apps.')
-    locally_installed_apps = ["Unknown"]
-
-try:
-    running_processes = [p.info["name"] for p in psutil.process_iter(['pid', 'name'])]
-except Exception as e:
-     logging.error(f'Could not obtain the running processes {e}')
-     running_processes = []
\ No newline at end of file
+    return ("Unknown",)
+
+
+def get_running_processes() -> list[str]:
+    import psutil
+    try:
+        return [p.info["name"] for p in psutil.process_iter(['pid', 'name'])]
+    except Exception as e:
+         logging.error(f'Could not obtain the running processes {e}')
+         return []
+
+
+def __getattr__(name: str):
+    # Backwards compatible module attributes, computed lazily on first access.
+    if name == 'locally_installed_apps':
+        return list(get_locally_installed_apps())
+    if name == 'running_processes':
+        return get_running_processes()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from typing import Any, Optional
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class MessageStore:
+    """
+    Bounded conversation log.
+
+    The newest `capacity` messages are kept in a ring buffer. Every message gets a monotonically increasing id starting
+    at 1, and messages pushed out of the ring buffer are spilled to JSON-lines segment files on disk so older history
+    can still be paged through. Because ids are contiguous, a message's segment file and line are computed from its id
+    and no index has to be kept.
+    """
+
+    def __init__(self, capacity: int = 500, segment_size: int = 1000, spill_directory: Optional[str] = None):
+        self.capacity = capacity
+        self.segment_size = segment_size
+        self._spill_directory = spill_directory
+        self._created_spill_directory = False
+        self._messages: deque[dict[str, Any]] = deque()
+        self._last_id = 0
+        self._spilled_up_to_id = 0
+        self._lock = threading.RLock()
+
+    @property
+    def last_id(self) -> int:
+        return self._last_id
+
+    def append(self, kind: str, text: str) -> dict[str, Any]:
+        with self._lock:
+            self._last_id += 1
+            message = {'id': self._last_id, 'kind': kind, 'text': text}
+            self._messages.append(message)
+            while len(self._messages) > self.capacity:
+                self._spill(self._messages.popleft())
+            return message
+
+    def since(self, since_id: int, limit: Optional[int] = None) -> list[dict[str, Any]]:
+        """Messages with an id greater than since_id, oldest first."""
+        with self._lock:
+            end_id = self._last_id if limit is None else min(self._last_id, since_id + limit)
+            return self._range(since_id + 1, end_id)
+
+    def before(self, before_id: int, limit: int) -> list[dict[str, Any]]:
+        """Up to `limit` messages with an id lower than before_id, oldest first."""
+        with self._lock:
+            end_id = min(before_id - 1, self._last_id)
+            return self._range(max(1, end_id - limit + 1), end_id)
+
+    def recent(self, limit: int) -> list[dict[str, Any]]:
+        with self._lock:
+            return list(self._messages)[-limit:]
+
+    def close(self) -> None:
+        """Deletes the spilled history."""
+        with self._lock:
+            if self._created_spill_directory and self._spill_directory:
+                shutil.rmtree(self._spill_directory, ignore_errors=True)
+                self._spill_directory = None
+                self._created_spill_directory = False
+
+    def _range(self, start_id: int, end_id: int) -> list[dict[str, Any]]:
+        start_id = max(start_id, 1)
+        if end_id < start_id:
+            return []
+        messages = []
+        if start_id <= self._spilled_up_to_id:
+            messages.extend(self._read_spilled(start_id, min(end_id, self._spilled_up_to_id)))
+        first_in_memory_id = self._spilled_up_to_id + 1
+        for message in self._messages:
+            if message['id'] > end_id:
+                break
+            if message['id'] >= max(start_id, first_in_memory_id):
+                messages.append(message)
+        return messages
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self._spill_directory, f'segment_{segment:06d}.jsonl')
+
+    def _spill(self, message: dict[str, Any]) -> None:
+        if message['id'] != self._spilled_up_to_id + 1:
+            return  # An earlier message failed to spill, and the segment files can only hold contiguous history.
+        try:
+            if not self._spill_directory:
+                self._spill_directory = tempfile.mkdtemp(prefix='open-interface-conversation-')
+                self._created_spill_directory = True
+            os.makedirs(self._spill_directory, exist_ok=True)
+            segment = (message['id'] - 1) // self.segment_size
+            with open(self._segment_path(segment), 'a', encoding='utf-8') as file:
+                file.write(json.dumps(message) + '\n')
+            self._spilled_up_to_id = message['id']
+        except OSError as e:
+            # Losing old history is better than losing new messages. What was spilled before stays readable.
+            logging.error(f'Error spilling conversation history to disk, older messages will be dropped: {e}')
+
+    def _read_spilled(self, start_id: int, end_id: int) -> list[dict[str, Any]]:
+        messages = []
+        for segment in range((start_id - 1) // self.segment_size, (end_id - 1) // self.segment_size + 1):
+            first_id_in_segment = segment * self.segment_size + 1
+            try:
+                with open(self._segment_path(segment), 'r', encoding='utf-8') as file:
+                    for line_number, line in enumerate(file):
+                        message_id = first_id_in_segment + line_number
+                        if message_id > end_id:
+                            break
+                        if message_id >= start_id:
+                            messages.append(json.loads(line))
+            except (OSError, TypeError, json.JSONDecodeError) as e:
+                logging.error(f'Error reading spilled conversation history: {e}')
+        return messages
@@ -0,0 +1,69 @@
+import logging
+import threading
+from collections import Counter
+from typing import Any
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+SMALL_TIER = 'small'
+LARGE_TIER = 'large'
+
+SINGLE_MODEL_MODE = 'single'
+TIERED_MODEL_MODE = 'tiered'
+
+DEFAULT_SMALL_MODEL_NAME = 'gpt-4o-mini'
+DEFAULT_LARGE_MODEL_NAME = 'gpt-4o'
+
+# Why a round was handed to the large model
+ESCALATION_PARSE_FAILURE = 'parse_failure'
+ESCALATION_VALIDATION_FAILURE = 'validation_failure'
+ESCALATION_NO_SCREEN_CHANGE = 'no_screen_change'
+
+STATS_LOG_INTERVAL = 20  # Log a summary every this many rounds
+
+
+class TierStats:
+    """
+    Round counts, latencies and escalation reasons per model tier, to see whether the small model is pulling its weight.
+
+    Latencies are kept as a running total and an exponential moving average, the EWMA reacts to a slow endpoint within
+    a few rounds while the total gives the long run mean.
+    """
+
+    def __init__(self, smoothing: float = 0.2):
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self._rounds: Counter[str] = Counter()
+        self._total_latency: Counter[str] = Counter()
+        self._latency_ewma: dict[str, float] = {}
+        self._escalations: Counter[str] = Counter()
+
+    def record_round(self, tier: str, latency: float) -> None:
+        with self._lock:
+            self._rounds[tier] += 1
+            self._total_latency[tier] += latency
+            previous = self._latency_ewma.get(tier)
+            self._latency_ewma[tier] = latency if previous is None else (
+                self.smoothing * latency + (1 - self.smoothing) * previous)
+            total_rounds = sum(self._rounds.values())
+        logging.info(f'{tier} model round took {latency:.2f}s')
+        if total_rounds % STATS_LOG_INTERVAL == 0:
+            logging.info(f'Model tier stats: {self.snapshot()}')
+
+    def record_escalation(self, reason: str) -> None:
+        with self._lock:
+            self._escalations[reason] += 1
+        logging.info(f'Escalating round to the large model: {reason}')
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            small_rounds = self._rounds[SMALL_TIER]
+            escalations = sum(self._escalations.values())
+            return {
+                'rounds': dict(self._rounds),
+                'mean_latency': {tier: self._total_latency[tier] / count for tier, count in self._rounds.items() if count},
+                'recent_latency': dict(self._latency_ewma),
+                'escalations': dict(self._escalations),
+                'escalation_rate': escalations / small_rounds if small_rounds else 0.0,
+            }
@@ -1,26 +1,55 @@
 import json
+import threading
 import time
-from typing import Any
+from dataclasses import dataclass
+from typing import Any, Optional, Union
 import logging
 from pathlib import Path
-from multiprocessing import Queue
 
+from event_bus import EventBus, ModelCallEvent, ScreenshotEvent, StatusEvent
+from frame_buffer import Frame
+from hedging import RequestCancelled
+from retry_policy import RunFailedError
+from interpreter import get_instructions_json_schema
 from models.model import Model
-from openai import OpenAIError # type: ignore
+from models.rate_limiter import request_priority, BACKGROUND_PRIORITY
+from openai import BadRequestError, OpenAIError # type: ignore
 from openai.types.beta.threads.message import Message # type: ignore
-from screen import Screen
+from screen import Screen, AccessibilityObserver
+from settings import Settings
+from template_cache import get_template_cache
 import tkinter as tk
 
 
-# TODO
-# [ ] Function calling with assistants api - https://platform.openai.com/docs/assistants/tools/function-calling/quickstart
-
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+SCREENSHOT_OBSERVATION = 'screenshot'
+ACCESSIBILITY_OBSERVATION = 'accessibility'
+DEFAULT_ACCESSIBILITY_THUMBNAIL_WIDTH = 512  # 0 sends the element list alone
+MAX_REMEMBERED_TARGETS = 30
+CANCELLED_RUN_TIMEOUT = 10  # seconds a cancelled run gets to stop before a hedge's answer is added after it
+FINISHED_RUN_STATUSES = frozenset({'completed', 'cancelled', 'failed', 'expired', 'incomplete'})
+
+
+@dataclass(frozen=True)
+class PreparedRequest:
+    """
+    A round's request, formatted once and sent as is to the model and to its hedge. file_id is the screenshot as
+    uploaded to base_url, png is kept to upload it again to a hedge at another endpoint.
+    """
+    step_num: int
+    formatted_user_request: list[dict[str, Any]]
+    base_url: str
+    frame: Optional[Frame] = None
+    model_frame: Optional[tuple] = None
+    png: Optional[memoryview] = None
+    file_id: Optional[str] = None
+
+
 class GPT4o(Model):
-    def __init__(self, model_name, base_url, api_key, context, status_queue: Queue):
-        super().__init__(model_name, base_url, api_key, context, status_queue)
+    def __init__(self, model_name, base_url, api_key, context, event_bus: EventBus):
+        super().__init__(model_name, base_url, api_key, context, event_bus)
 
         try:
             # GPT4o has Assistant Mode enabled that we can utilize to make Open Interface be more contextually aware
@@ -31,14 +60,8 @@ class GPT4o(Model):
                 model=model_name,
             )
             logging.info(f'Assistant created successfully, id: {self.assistant.id}')
-        except openai.error.APIError as e: # import openai
-            logging.error(f'API Error creating assistant: {e}')
-            raise
-        except openai.error.AuthenticationError as e: # import openai
-            logging.error(f'Authentication Error creating assistant: {e}')
-            raise
         except OpenAIError as e:
-            logging.error(f'Other OpenAI Error creating assistant: {e}')
+            logging.error(f'{type(e).__name__} creating assistant: {e}')
             raise
 
         try:
@@ -49,43 +72,126 @@ class GPT4o(Model):
         except OpenAIError as e:
             logging.error(f"Error creating thread: {e}")
             raise
+        self._thread_used = False
+        self._last_run_id: Optional[str] = None
+        # Threads given up by reset_thread(), deleted at clean up
+        self.retired_thread_ids = []
 
         # IDs of images uploaded to OpenAI for use with the assistants API, can be cleaned up once thread is no longer needed
         self.list_of_image_ids = []
 
-    def get_instructions_for_objective(self, original_user_request: str, step_num: int = 0) -> dict[str, Any]:
-        logging.info("Getting a screenshot to send to the AI model")
-        # Upload screenshot to OpenAI - Note: Don't delete files from openai while the thread is active
-        try:
-            photo_image_filepath = Screen().get_screenshot_file()
-        except Exception as e:
-            logging.error(f"Error capturing screenshot: {e}")
-            raise
-
-        try:
-            openai_screenshot_file_id = self.upload_screenshot_and_get_file_id(photo_image_filepath)
-        except Exception as e:
-            logging.error(f"Error uploading screenshot: {e}")
-            raise
-
-        logging.info("Screenshot obtained, file_id: " + str(openai_screenshot_file_id))
-        
-        self.status_queue.put(("I took a screenshot and sent it to the AI model", photo_image_filepath))
-
+        # Structured outputs make the model answer with JSON matching the interpreter's actions, so there's nothing
+        # to parse out of free text and no retry for malformed JSON. Turned off if the endpoint doesn't support them.
+        self.use_structured_outputs = bool(Settings().get_dict().get('structured_outputs', True))
+        self.response_format = {
+            'type': 'json_schema',
+            'json_schema': {'name': 'instructions', 'schema': get_instructions_json_schema(), 'strict': True},
+        }
+
+    def get_instructions_for_objective(self, original_user_request: str, step_num: int = 0,
+                                       cancel_event: Optional[threading.Event] = None) -> dict[str, Any]:
+        return self.send_prepared_request(self.prepare_request(original_user_request, step_num), cancel_event)
+
+    def prepare_request(self, original_user_request: str, step_num: int = 0) -> PreparedRequest:
+        """Captures and uploads what the model gets to see this round and formats the request, without sending it."""
+        settings_dict = Settings().get_dict()
+        screen_elements = None
+        screenshot_max_width = None
+        if settings_dict.get('screen_observation') == ACCESSIBILITY_OBSERVATION:
+            # The element list replaces the full screenshot, a small thumbnail (if any) just gives visual context.
+            screen_elements = AccessibilityObserver().snapshot()
+            if screen_elements is not None:
+                screenshot_max_width = int(settings_dict.get('accessibility_thumbnail_width',
+                                                             DEFAULT_ACCESSIBILITY_THUMBNAIL_WIDTH))
+
+        openai_screenshot_file_id = None
+        frame = None
+        png = None
+        if screen_elements is None or screenshot_max_width:
+            logging.info("Getting a screenshot to send to the AI model")
+            # Upload screenshot to OpenAI - Note: Don't delete files from openai while the thread is active
+            try:
+                screen = Screen()
+                frame, png = screen.get_model_screenshot(max_width=screenshot_max_width)
+                # The upload and the UI work from memory, files are only written for those who want to keep them.
+                photo_image_filepath = screen.save_screenshot(png) if settings_dict.get('save_screenshots') else None
+            except Exception as e:
+                logging.error(f"Error capturing screenshot: {e}")
+                raise
 
-        self.list_of_image_ids.append(openai_screenshot_file_id)
+            try:
+                openai_screenshot_file_id = self.upload_screenshot_and_get_file_id(png)
+            except Exception as e:
+                logging.error(f"Error uploading screenshot: {e}")
+                raise
+
+            logging.info("Screenshot obtained, file_id: " + str(openai_screenshot_file_id))
+
+            self.event_bus.publish(ScreenshotEvent("I took a screenshot and sent it to the AI model",
+                                                   photo_image_filepath, frame))
+
+            self.list_of_image_ids.append(openai_screenshot_file_id)
+            if screen_elements is not None:
+                # Boxes in the thumbnail's pixels, the space the model's click coordinates are read in. The snapshot
+                # AccessibilityObserver keeps for click_element stays in screen coordinates.
+                screen_elements = [{**element, 'box': Screen.screen_box_to_model(element['box'])}
+                                   for element in screen_elements]
+        else:
+            # No screenshot this round, coordinates the model gives are screen coordinates, not a stale screenshot's.
+            Screen.set_model_frame(None)
+            self.event_bus.publish(StatusEvent("I read the window's accessibility tree and sent it to the AI model"))
 
         # Format user request to send to LLM
         formatted_user_request = self.format_user_request_for_llm(original_user_request, step_num,
-                                                                  openai_screenshot_file_id)
+                                                                  openai_screenshot_file_id, screen_elements)
+        return PreparedRequest(step_num, formatted_user_request, self.base_url, frame,
+                               Screen.get_model_frame() if frame else None, png, openai_screenshot_file_id)
+
+    def send_prepared_request(self, prepared: PreparedRequest,
+                              cancel_event: Optional[threading.Event] = None) -> dict[str, Any]:
+        """
+        Sends a request prepared by this model or, for hedging, by another instance of it. A screenshot uploaded to a
+        different endpoint is uploaded here again, from the same bytes.
+        """
+        formatted_user_request = prepared.formatted_user_request
+        if prepared.file_id and prepared.base_url != self.base_url:
+            file_id = self.upload_screenshot_and_get_file_id(prepared.png)
+            self.list_of_image_ids.append(file_id)
+            formatted_user_request = [{**content, 'image_file': {'file_id': file_id}}
+                                      if content.get('type') == 'image_file' else content
+                                      for content in formatted_user_request]
 
         # Read response
-        llm_response = self.send_message_to_llm(formatted_user_request)
+        start_time = time.monotonic()
+        llm_response = self.send_message_to_llm(formatted_user_request, cancel_event)
+        self._publish_model_call(prepared.step_num, formatted_user_request, llm_response,
+                                 time.monotonic() - start_time, prepared.frame, prepared.model_frame)
         json_instructions: dict[str, Any] = self.convert_llm_response_to_json_instructions(llm_response)
 
         return json_instructions
 
-    def send_message_to_llm(self, formatted_user_request) -> Message:
+    def get_text_only_instructions(self, original_user_request: str, step_num: int = 0) -> Optional[dict[str, Any]]:
+        logging.info("Asking the AI model without a screenshot")
+        Screen.set_model_frame(None)
+        formatted_user_request = self.format_user_request_for_llm(original_user_request, step_num, None)
+        start_time = time.monotonic()
+        llm_response = self.send_message_to_llm(formatted_user_request)
+        self._publish_model_call(step_num, formatted_user_request, llm_response, time.monotonic() - start_time)
+        return self.convert_llm_response_to_json_instructions(llm_response)
+
+    def _publish_model_call(self, step_num: int, formatted_user_request: list[dict[str, Any]], llm_response: Message,
+                            latency: float, frame: Optional[Frame] = None, model_frame: Optional[tuple] = None) -> None:
+        """Lets recorders see exactly what was sent and what came back."""
+        try:
+            response_text = llm_response.content[0].text.value
+        except (AttributeError, IndexError):
+            response_text = str(llm_response)
+        self.event_bus.publish(ModelCallEvent(self.model_name, step_num, formatted_user_request, response_text, latency,
+                                              frame, model_frame))
+
+    def send_message_to_llm(self, formatted_user_request, cancel_event: Optional[threading.Event] = None) -> Message:
+         self._thread_used = True
+         self._last_run_id = None
          try:
            message = self.client.beta.threads.messages.create(
                thread_id=self.thread.id,
@@ -93,27 +199,29 @@ class GPT4o(Model):
                content=formatted_user_request
            )
            logging.info("Sending message to the ai model...")
-           run = self.client.beta.threads.runs.create(
-               thread_id=self.thread.id,
-               assistant_id=self.assistant.id,
-               instructions=''
-           )
+           run = self._create_run()
+           self._last_run_id = run.id
            run = self.client.beta.threads.runs.retrieve(thread_id = self.thread.id, run_id = run.id)
 
            wait_time = 1
            max_wait_time = 60
            while run.status != 'completed':
                logging.info(f'Waiting for response, sleeping for {wait_time}. run.status={run.status}')
-               time.sleep(wait_time)
+               if cancel_event is None:
+                   time.sleep(wait_time)
+               elif cancel_event.wait(wait_time):
+                   self._cancel_run(run.id)
+                   raise RequestCancelled(f'Run {run.id} cancelled')
                wait_time = min(wait_time * 2, max_wait_time)  # Exponential backoff with a maximum wait time
 
                run = self.client.beta.threads.runs.retrieve(thread_id = self.thread.id, run_id = run.id) #check the status.
 
 
-               if run.status == 'failed':
-                  error_message = f'Failed run. Required action: {run.required_action}. Last error: {run.last_error}'
+               if run.status in ('failed', 'expired', 'cancelled', 'incomplete'):
+                  error_message = f'{run.status.capitalize()} run. Required action: {run.required_action}. Last error: {run.last_error}'
                   logging.error(error_message)
-                  raise Exception(error_message)
+                  error_code = run.last_error.code if run.last_error else None
+                  raise RunFailedError(error_message, error_code or (run.status if run.status == 'expired' else None))
 
 
            if run.status == 'completed':
@@ -123,22 +231,84 @@ class GPT4o(Model):
            else:
               error_message = 'Run did not complete successfully.'
               logging.error(error_message)
-              raise Exception(error_message)
+              raise RunFailedError(error_message)
          except OpenAIError as e:
              logging.error(f"OpenAI Error in send_message_to_llm {e}")
              raise
 
 
-    def upload_screenshot_and_get_file_id(self,filepath) -> str:
+    def _create_run(self):
+        if self.use_structured_outputs:
+            try:
+                return self.client.beta.threads.runs.create(
+                    thread_id=self.thread.id,
+                    assistant_id=self.assistant.id,
+                    instructions='',
+                    response_format=self.response_format
+                )
+            except BadRequestError as e:
+                logging.warning(f'{self.model_name} at {self.base_url} rejected structured outputs, '
+                                f'falling back to free-form JSON: {e}')
+                self.use_structured_outputs = False
+        return self.client.beta.threads.runs.create(
+            thread_id=self.thread.id,
+            assistant_id=self.assistant.id,
+            instructions=''
+        )
+
+    def reset_thread(self) -> None:
+        """Continues on a new, empty thread, unless nothing was sent on the current one yet."""
+        if not self._thread_used:
+            return
+        thread = self.client.beta.threads.create()
+        logging.info(f'Started thread {thread.id} in place of {self.thread.id}')
+        self.retired_thread_ids.append(self.thread.id)
+        self.thread, self._thread_used = thread, False
+
+    def add_answer(self, instructions: dict[str, Any]) -> None:
+        """
+        Adds instructions, which a hedge answered, to this thread as the answer to its last message once the run that
+        was cancelled for the hedge has stopped, so the next round sees the exchange like any other.
+        """
+        try:
+            deadline = time.monotonic() + CANCELLED_RUN_TIMEOUT
+            while self._last_run_id:
+                run = self.client.beta.threads.runs.retrieve(thread_id=self.thread.id, run_id=self._last_run_id)
+                if run.status == 'completed':
+                    return  # It answered after all, the thread already has an answer
+                if run.status in FINISHED_RUN_STATUSES:
+                    break
+                if time.monotonic() >= deadline:
+                    logging.warning(f'Run {run.id} has not stopped, the hedged answer is not added to the thread')
+                    return
+                time.sleep(self.POLL_INTERVAL)
+            self.client.beta.threads.messages.create(thread_id=self.thread.id, role='assistant',
+                                                     content=json.dumps(instructions))
+        except OpenAIError as e:
+            logging.error(f'Error adding the hedged answer to thread {self.thread.id}: {e}')
+
+    def _cancel_run(self, run_id: str) -> None:
+        # Stops the run server side too, so an abandoned run doesn't keep generating tokens.
+        try:
+            self.client.beta.threads.runs.cancel(thread_id=self.thread.id, run_id=run_id)
+            logging.info(f'Cancelled run {run_id}')
+        except OpenAIError as e:
+            logging.warning(f'Could not cancel run {run_id}: {e}')
+
+    def upload_screenshot_and_get_file_id(self, screenshot: Union[str, memoryview]) -> str:
         # Files are used to upload documents like images that can be used with features like Assistants
         # Assistants API cannot take base64 images like chat.completions API
+        # screenshot is a file path or an encoded PNG
         logging.info("Uploading screenshot to AI model...")
         try:
-            with open(filepath, 'rb') as file:
-                response = self.client.files.create(
-                    file=file,
-                    purpose='vision'
-                )
+            if isinstance(screenshot, str):
+                with open(screenshot, 'rb') as file:
+                    response = self.client.files.create(
+                        file=file,
+                        purpose='vision'
+                    )
+            else:
+                response = self.client.files.create(file=('screenshot.png', bytes(screenshot)), purpose='vision')
             return response.id
         except FileNotFoundError as e:
             logging.error(f"File not found error: {e}")
@@ -151,34 +321,66 @@ class GPT4o(Model):
             logging.exception("Detailed traceback:")
             raise
 
-    def format_user_request_for_llm(self, original_user_request, step_num, openai_screenshot_file_id) -> list[
+    def format_user_request_for_llm(self, original_user_request, step_num, openai_screenshot_file_id,
+                                    screen_elements: Optional[list[dict[str, Any]]] = None) -> list[
 
         dict[str, Any]]:
-        request_data: str = json.dumps({
+        request = {
             'original_user_request': original_user_request,
             'step_num': step_num
-        })
+        }
+        if screen_elements is not None:
+            request['screen_elements'] = screen_elements
+            if openai_screenshot_file_id:
+                request['screenshot_is_thumbnail'] = True
+        elif not openai_screenshot_file_id:
+            # Lets the model ask for the screen (by replying with steps) instead of guessing.
+            request['screenshot_attached'] = False
+        if Settings().get_dict().get('template_cache', True):
+            template_cache = get_template_cache()
+            application = template_cache.start_round()
+            remembered_targets = template_cache.get_labels(application)[:MAX_REMEMBERED_TARGETS] if application else []
+            if remembered_targets:
+                request['remembered_targets'] = remembered_targets
+        request_data: str = json.dumps(request)
 
         content = [
             {
                 'type': 'text',
                 'text': request_data
-            },
-            {
+            }
+        ]
+        if openai_screenshot_file_id:
+            content.append({
                 'type': 'image_file',
                 'image_file': {
                     'file_id': openai_screenshot_file_id
                 }
-            }
-        ]
+            })
 
         return content
 
     def convert_llm_response_to_json_instructions(self, llm_response: Message) -> dict[str, Any]:
         try:
-            llm_response_data: str = llm_response.content[0].text.value.strip()
+            response_text: str = llm_response.content[0].text.value
+        except Exception as e:
+            logging.error(f'Error while parsing JSON response - {e}')
+            return {}
+        return self.parse_response_text(response_text, self.use_structured_outputs)
+
+    @staticmethod
+    def parse_response_text(response_text: str, structured_outputs: bool = True) -> dict[str, Any]:
+        """The instructions in the text of a model's answer, replays parse recorded answers with it too."""
+        try:
+            llm_response_data: str = response_text.strip()
 
-            # Our current LLM model does not guarantee a JSON response hence we use regex to extract JSON
+            if structured_outputs:
+                try:
+                    return json.loads(llm_response_data)
+                except json.JSONDecodeError:
+                    pass  # e.g. a refusal, or an answer cut off at the token limit
+
+            # Without structured outputs the model does not guarantee a JSON response hence we use regex to extract JSON
             import re # import re
             json_match = re.search(r'\{.*\}', llm_response_data, re.DOTALL)
             if json_match:
@@ -188,8 +390,8 @@ class GPT4o(Model):
                 raise ValueError("No JSON object found in the response")
 
         except json.JSONDecodeError as e:
-            logging.error(f"JSONDecodeError: {e}, response received: {llm_response.content[0].text.value}")
-            return {"error": "JSONDecodeError", "message": str(e), "raw_data": llm_response.content[0].text.value}
+            logging.error(f"JSONDecodeError: {e}, response received: {response_text}")
+            return {"error": "JSONDecodeError", "message": str(e), "raw_data": response_text}
 
         except Exception as e:
             logging.error(f'Error while parsing JSON response - {e}')
@@ -197,6 +399,11 @@ class GPT4o(Model):
 
 
     def cleanup(self):
+        # Clean up never holds up a user's request for a rate limit slot.
+        with request_priority(BACKGROUND_PRIORITY):
+            self._cleanup()
+
+    def _cleanup(self):
         # Note: Cannot delete screenshots while the thread is active. Cleanup during shut down.
         logging.info(f"Cleaning up model {self.model_name}")
         for id in self.list_of_image_ids:
@@ -206,8 +413,9 @@ class GPT4o(Model):
             except OpenAIError as e:
                 logging.error(f"Error deleting file {id}: {e}")
 
-        try:
-            logging.info(f"Deleting thread with id: {self.thread.id}")
-            self.client.beta.threads.delete(self.thread.id)
-        except OpenAIError as e:
-            logging.error(f"Error deleting thread {self.thread.id}: {e}")
\ No newline at end of file
+        for thread_id in [*self.retired_thread_ids, self.thread.id]:
+            try:
+                logging.info(f"Deleting thread with id: {thread_id}")
+                self.client.beta.threads.delete(thread_id)
+            except OpenAIError as e:
+                logging.error(f"Error deleting thread {thread_id}: {e}")
\ No newline at end of file
@@ -1,10 +1,13 @@
 import os
 import json
 import logging
+import threading
 from abc import ABC, abstractmethod
-from queue import Queue
-from typing import Any, Dict, List
-from openai import OpenAI, OpenAIError
+from typing import Any, Dict, List, Optional
+from openai import DefaultHttpxClient, OpenAI, OpenAIError
+
+from event_bus import EventBus
+from models.rate_limiter import get_rate_limiter, make_rate_limit_hook
 
 class Model(ABC):
     """Abstract base class for all models"""
@@ -13,23 +16,33 @@ class Model(ABC):
     RATE_LIMIT_DELAY = 20  # seconds
     POLL_INTERVAL = 1  # seconds
 
-    def __init__(self, model_name: str, base_url: str, api_key: str, context: str, status_queue: Queue):
+    def __init__(self, model_name: str, base_url: str, api_key: str, context: str, event_bus: EventBus):
         self.model_name = model_name
         self.base_url = base_url
         self.api_key = api_key
         self.context = context
-        self.status_queue = status_queue
+        self.event_bus = event_bus
         try:
-            self.client = OpenAI(api_key=api_key, base_url=base_url)
+            # Every request waits its turn with the process-wide rate limiter.
+            self.rate_limiter = get_rate_limiter(api_key)
+            http_client = DefaultHttpxClient(event_hooks={'request': [make_rate_limit_hook(self.rate_limiter)]})
+            # Core's RetryPolicy is the only retry layer, so the circuit breaker sees every failed attempt.
+            self.client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
             logging.info(f"OpenAI client initialized successfully for model: {model_name}")
         except OpenAIError as e:
             logging.error(f"Error initializing OpenAI client for model {model_name}: {e}")
             raise
 
     @abstractmethod
-    def get_instructions_for_objective(self, original_user_request: str, step_num: int = 0) -> dict[str, Any]:
+    def get_instructions_for_objective(self, original_user_request: str, step_num: int = 0,
+                                       cancel_event: Optional[threading.Event] = None) -> dict[str, Any]:
+        """Raises hedging.RequestCancelled if cancel_event gets set before the model has answered."""
         pass
 
+    def get_text_only_instructions(self, original_user_request: str, step_num: int = 0) -> Optional[dict[str, Any]]:
+        """Answers without a screenshot. Returns None when the model has no text-only path."""
+        return None
+
     @abstractmethod
     def format_user_request_for_llm(self, original_user_request: str, step_num: int = 0) -> List[Dict[str, Any]]:
         """Format user request in the expected format for the LLM."""
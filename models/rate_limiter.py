@@ -0,0 +1,209 @@
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import re
+import threading
+import time
+from typing import Callable, Optional
+
+from hedging import RequestCancelled
+from settings import Settings, SettingsChange
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Lower runs first
+INTERACTIVE_PRIORITY = 0
+BACKGROUND_PRIORITY = 10
+
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 30000
+RATE_LIMIT_SETTINGS_KEYS = frozenset({'rate_limit_rpm', 'rate_limit_tpm'})
+
+# Rough token costs for requests whose real cost is only known to the provider
+IMAGE_TOKEN_ESTIMATE = 1100  # A high detail 1080p screenshot
+RUN_OUTPUT_TOKEN_ESTIMATE = 500
+CHARS_PER_TOKEN = 4
+TOKEN_CONSUMING_PATHS = re.compile(r'/(chat/completions|threads/[^/]+/messages|threads/[^/]+/runs)$')
+CANCEL_POLL_INTERVAL = 0.1  # seconds
+
+_request_priority = contextvars.ContextVar('request_priority', default=INTERACTIVE_PRIORITY)
+_request_cancel_event: contextvars.ContextVar[Optional[threading.Event]] = contextvars.ContextVar(
+    'request_cancel_event', default=None)
+
+
+@contextlib.contextmanager
+def request_priority(priority: int):
+    """API calls made inside this block, on this thread, queue with the given priority."""
+    token = _request_priority.set(priority)
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+
+@contextlib.contextmanager
+def request_cancel_event(cancel_event: threading.Event):
+    """API calls made inside this block, on this thread, stop waiting for the rate limiter once cancel_event is set."""
+    token = _request_cancel_event.set(cancel_event)
+    try:
+        yield
+    finally:
+        _request_cancel_event.reset(token)
+
+
+class TokenBucket:
+    """Holds up to capacity units and refills at capacity per minute. A capacity of 0 means unlimited."""
+
+    def __init__(self, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self.capacity = capacity
+        self.available = capacity
+        self._clock = clock
+        self._updated_at = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self.available = min(self.capacity, self.available + (now - self._updated_at) * self.capacity / 60)
+        self._updated_at = now
+
+    def time_until_available(self, amount: float) -> float:
+        if not self.capacity:
+            return 0.0
+        self._refill()
+        # Something bigger than the whole bucket waits for a full bucket and then drives it negative.
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.available) * 60 / self.capacity)
+
+    def consume(self, amount: float) -> None:
+        if self.capacity:
+            self.available -= amount
+
+    def set_capacity(self, capacity: float) -> None:
+        self._refill()
+        self.capacity = capacity
+        self.available = min(self.available, capacity)
+
+
+class RateLimiter:
+    """
+    Keeps every API call made with one API key in this process under its requests and tokens per minute.
+
+    Callers block in acquire() until both buckets have room, and waiting callers are served by priority, then in
+    arrival order, so an interactive round never queues behind background clean up. Token costs are estimated before
+    the request is sent, which is enough to stay clear of the provider's limits instead of bouncing off them with 429s.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float,
+                 clock: Callable[[], float] = time.monotonic):
+        self._requests = TokenBucket(requests_per_minute, clock)
+        self._tokens = TokenBucket(tokens_per_minute, clock)
+        self._condition = threading.Condition()
+        self._waiters: list[tuple[int, int]] = []
+        self._sequence = itertools.count()
+
+    def configure(self, requests_per_minute: float, tokens_per_minute: float) -> None:
+        with self._condition:
+            self._requests.set_capacity(requests_per_minute)
+            self._tokens.set_capacity(tokens_per_minute)
+            self._condition.notify_all()
+
+    def acquire(self, tokens: float = 0, priority: Optional[int] = None,
+                cancel_event: Optional[threading.Event] = None) -> None:
+        """Raises hedging.RequestCancelled if cancel_event gets set while waiting."""
+        if priority is None:
+            priority = _request_priority.get()
+        if cancel_event is None:
+            cancel_event = _request_cancel_event.get()
+        waiter = (priority, next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._waiters, waiter)
+            waited = False
+            try:
+                while True:
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise RequestCancelled('Cancelled while waiting for the rate limiter')
+                    if self._waiters[0] == waiter:
+                        delay = max(self._requests.time_until_available(1), self._tokens.time_until_available(tokens))
+                        if delay == 0:
+                            self._requests.consume(1)
+                            self._tokens.consume(tokens)
+                            break
+                    else:
+                        delay = None  # Wait for the callers ahead of us
+                    if not waited:
+                        logging.info(f'Rate limiter holding a request (priority {priority}, ~{tokens:.0f} tokens)')
+                        waited = True
+                    if cancel_event is not None:
+                        # Nothing notifies the condition when cancel_event is set, so look at it now and then.
+                        delay = CANCEL_POLL_INTERVAL if delay is None else min(delay, CANCEL_POLL_INTERVAL)
+                    self._condition.wait(delay)
+            finally:
+                self._waiters.remove(waiter)
+                heapq.heapify(self._waiters)
+                self._condition.notify_all()
+
+
+def estimate_request_tokens(path: str, body: bytes) -> int:
+    """Rough token cost of a POST to the OpenAI API, zero for requests that don't use the model."""
+    if not TOKEN_CONSUMING_PATHS.search(path):
+        return 0
+    image_count = body.count(b'"image_file"') + body.count(b'"image_url"')
+    tokens = len(body) // CHARS_PER_TOKEN + image_count * IMAGE_TOKEN_ESTIMATE
+    if path.endswith('/runs') or path.endswith('/chat/completions'):
+        tokens += RUN_OUTPUT_TOKEN_ESTIMATE
+    return tokens
+
+
+_rate_limiters: dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+_rate_limit_share = 1.0
+
+
+def set_rate_limit_share(share: float) -> None:
+    """
+    This process only gets share of the configured limits, for when several processes (e.g. worker pool workers) use
+    the same API key. Must be called before the first get_rate_limiter().
+    """
+    global _rate_limit_share
+    _rate_limit_share = share
+
+
+def _get_configured_limits(settings_dict: dict) -> tuple[float, float]:
+    return (float(settings_dict.get('rate_limit_rpm', DEFAULT_REQUESTS_PER_MINUTE)) * _rate_limit_share,
+            float(settings_dict.get('rate_limit_tpm', DEFAULT_TOKENS_PER_MINUTE)) * _rate_limit_share)
+
+
+def _on_settings_changed(change: SettingsChange) -> None:
+    if change.affects(RATE_LIMIT_SETTINGS_KEYS):
+        limits = _get_configured_limits(change.settings)
+        logging.info(f'Rate limits changed to {limits[0]:.0f} requests and {limits[1]:.0f} tokens per minute')
+        with _rate_limiters_lock:
+            for rate_limiter in _rate_limiters.values():
+                rate_limiter.configure(*limits)
+
+
+def get_rate_limiter(api_key: Optional[str]) -> RateLimiter:
+    """The limiter shared by every client in this process that uses api_key, since provider limits are per key."""
+    # Read outside the lock, get_dict() may call _on_settings_changed.
+    limits = _get_configured_limits(Settings().get_dict())
+    with _rate_limiters_lock:
+        if not _rate_limiters:
+            Settings().subscribe(_on_settings_changed)
+        key = api_key or ''
+        if key not in _rate_limiters:
+            _rate_limiters[key] = RateLimiter(*limits)
+        return _rate_limiters[key]
+
+
+def make_rate_limit_hook(rate_limiter: RateLimiter):
+    """httpx request hook that waits for the rate limiter before every request, retries included."""
+    def wait_for_rate_limiter(request) -> None:
+        tokens = 0
+        # Only JSON requests can use tokens. Uploads are streamed and their content can't be read here.
+        if request.method == 'POST' and TOKEN_CONSUMING_PATHS.search(request.url.path):
+            tokens = estimate_request_tokens(request.url.path, request.content)
+        rate_limiter.acquire(tokens)
+
+    return wait_for_rate_limiter
@@ -0,0 +1,61 @@
+import logging
+import re
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+TEXT_ONLY = 'text_only'
+NEEDS_SCREEN = 'needs_screen'
+
+QUESTION_STARTERS = (
+    'what', 'who', 'whom', 'whose', 'why', 'when', 'where', 'which', 'how', 'is', 'are', 'was', 'were', 'do', 'does',
+    'did', 'can', 'could', 'should', 'would', 'will', 'explain', 'define', 'describe', 'tell me', 'calculate',
+    'translate', 'summarize', 'give me', 'list',
+)
+
+# Verbs that mean "do something on this computer". Questions about them ("how do I open ...") are still questions.
+ACTION_VERBS = {
+    'open', 'close', 'launch', 'start', 'quit', 'exit', 'click', 'double', 'type', 'write', 'press', 'scroll', 'drag',
+    'select', 'go', 'navigate', 'search', 'play', 'pause', 'stop', 'send', 'reply', 'download', 'upload', 'save',
+    'delete', 'remove', 'move', 'copy', 'paste', 'install', 'uninstall', 'log', 'sign', 'fill', 'submit', 'show',
+    'find', 'create', 'make', 'set', 'turn', 'switch', 'enable', 'disable', 'minimize', 'maximize', 'resize',
+    'refresh', 'reload', 'take', 'book', 'buy', 'order', 'compose', 'edit', 'rename', 'run', 'visit', 'browse',
+}
+
+# Anything pointing at what's currently on screen needs a screenshot, even when phrased as a question.
+SCREEN_REFERENCES = re.compile(
+    r"\b(screen|screenshot|window|tab|desktop|this|that|these|those|here|current(ly)?|open(ed)?|visible|"
+    r"button|page|cursor|mouse|icon|menu|dialog|popup|app|application|browser|file|folder)\b",
+    re.IGNORECASE,
+)
+
+
+def classify_request(user_request: str, step_num: int = 0) -> str:
+    """
+    Decides whether a request can be answered without looking at the screen.
+
+    Deliberately conservative: only plain knowledge questions are routed TEXT_ONLY, and anything that looks like a
+    command, mentions what's on screen, or is a follow up step of a running request NEEDS_SCREEN. A wrong TEXT_ONLY
+    guess costs one cheap text call before escalating, a wrong NEEDS_SCREEN guess just costs the old screenshot.
+    """
+    if step_num > 0:
+        return NEEDS_SCREEN
+
+    text = user_request.strip().lower()
+    if not text or SCREEN_REFERENCES.search(text):
+        return NEEDS_SCREEN
+
+    words = re.findall(r"[a-z']+", text)
+    if not words:
+        return NEEDS_SCREEN
+    if words[0] in {'please', 'can', 'could', 'would'} and len(words) > 2 and words[1] == 'you':
+        # "Can you open Spotify" is a command, "can you explain recursion" is a question.
+        return TEXT_ONLY if words[2] not in ACTION_VERBS else NEEDS_SCREEN
+    if words[0] == 'please':
+        words = words[1:]
+    if not words or words[0] in ACTION_VERBS:
+        return NEEDS_SCREEN
+
+    if text.endswith('?') or text.startswith(QUESTION_STARTERS):
+        return TEXT_ONLY
+    return NEEDS_SCREEN
@@ -0,0 +1,267 @@
+import email.utils
+import logging
+import random
+import re
+import threading
+import time
+from typing import Callable, Optional, TypeVar
+
+from openai import (APIConnectionError, APIStatusError, APITimeoutError, AuthenticationError, BadRequestError,
+                    PermissionDeniedError, RateLimitError)
+
+from hedging import RequestCancelled
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+T = TypeVar('T')
+
+# Error classes
+RATE_LIMITED = 'rate_limited'
+SERVER_ERROR = 'server_error'
+TIMEOUT = 'timeout'
+CONNECTION_ERROR = 'connection_error'
+AUTH_ERROR = 'auth_error'
+BAD_REQUEST = 'bad_request'
+MALFORMED_OUTPUT = 'malformed_output'
+CANCELLED = 'cancelled'
+UNKNOWN_ERROR = 'unknown_error'
+
+RETRYABLE_ERRORS = frozenset({RATE_LIMITED, SERVER_ERROR, TIMEOUT, CONNECTION_ERROR, MALFORMED_OUTPUT, UNKNOWN_ERROR})
+# Unknown errors are as likely to be bugs (a TypeError formatting the request) or a broken screen capture as anything
+# transient, so they only get one more try.
+MAX_UNKNOWN_ERROR_RETRIES = 1
+# Errors that say the endpoint itself is unhealthy. A 429 means it's up and answering, so it doesn't count.
+ENDPOINT_FAILURES = frozenset({SERVER_ERROR, TIMEOUT, CONNECTION_ERROR})
+
+# What the user sees when a request finally fails with each class
+ERROR_MESSAGES = {
+    RATE_LIMITED: 'The AI service is rate limiting requests, please try again in a minute.',
+    SERVER_ERROR: 'The AI service is having problems, please try again later.',
+    TIMEOUT: 'The AI service did not respond in time, please try again.',
+    CONNECTION_ERROR: 'Could not reach the AI service, please check your connection and the base URL in Settings.',
+    AUTH_ERROR: 'The AI service rejected the API key, please check it in Settings.',
+    BAD_REQUEST: 'The AI service rejected the request, please check the model in Settings.',
+    MALFORMED_OUTPUT: 'Failed to fetch valid instructions after multiple retries.',
+}
+
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 30
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+
+
+class MalformedResponseError(Exception):
+    """The model answered, but not with instructions that can be used."""
+
+
+class RunFailedError(Exception):
+    """An Assistants run ended without completing. code is the run's last_error code, if it has one."""
+
+    def __init__(self, message: str, code: Optional[str] = None):
+        super().__init__(message)
+        self.code = code
+
+
+class CircuitOpenError(Exception):
+    """The endpoint failed repeatedly, requests fail fast until the circuit breaker lets a trial request through."""
+
+
+def classify_error(error: Exception) -> str:
+    # Errors that already know their class, e.g. replayed ones, carry it with them.
+    if isinstance(getattr(error, 'error_class', None), str):
+        return error.error_class
+    # The OpenAI client wraps what goes wrong while sending, e.g. the rate limiter giving up on Stop, in
+    # APIConnectionError.
+    if isinstance(error, RequestCancelled) or isinstance(error.__cause__, RequestCancelled):
+        return CANCELLED
+    if isinstance(error, MalformedResponseError):
+        return MALFORMED_OUTPUT
+    if isinstance(error, RunFailedError):
+        return {
+            'rate_limit_exceeded': RATE_LIMITED,
+            'server_error': SERVER_ERROR,
+            'invalid_prompt': BAD_REQUEST,
+            'expired': TIMEOUT,
+        }.get(error.code, UNKNOWN_ERROR)
+    if isinstance(error, APITimeoutError):
+        return TIMEOUT
+    if isinstance(error, APIConnectionError):
+        return CONNECTION_ERROR
+    if isinstance(error, RateLimitError):
+        return RATE_LIMITED
+    if isinstance(error, (AuthenticationError, PermissionDeniedError)):
+        return AUTH_ERROR
+    if isinstance(error, BadRequestError):
+        return BAD_REQUEST
+    if isinstance(error, APIStatusError):
+        if error.status_code == 408:
+            return TIMEOUT
+        if error.status_code >= 500:
+            return SERVER_ERROR
+        return BAD_REQUEST
+    if isinstance(error, TimeoutError):
+        return TIMEOUT
+    if isinstance(error, ConnectionError):
+        return CONNECTION_ERROR
+    return UNKNOWN_ERROR
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Seconds the server asked us to wait, from Retry-After(-Ms) headers or an Assistants run error message."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry_after)
+                return max(0.0, retry_at.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    # Run errors only carry a message, e.g. "Rate limit reached ... Please try again in 6.5s."
+    match = re.search(r'try again in (\d+(?:\.\d+)?)\s*(ms|s)', str(error))
+    if match:
+        return float(match.group(1)) / (1000 if match.group(2) == 'ms' else 1)
+    return None
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to an endpoint that keeps failing.
+
+    After failure_threshold consecutive endpoint failures the circuit opens and requests fail with CircuitOpenError
+    straight away. Once reset_timeout has passed, one trial request is let through: success closes the circuit,
+    failure opens it for another reset_timeout.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT, clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    def before_request(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.reset_timeout - self._clock()
+            if remaining > 0 or self._trial_in_flight:
+                raise CircuitOpenError(f'{self.name} is failing, not retrying for another {max(remaining, 0):.0f}s')
+            self._trial_in_flight = True
+            logging.info(f'Circuit for {self.name} half open, sending a trial request')
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                logging.info(f'Circuit for {self.name} closed again')
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def abandon_trial(self) -> None:
+        """The trial request was cancelled before it said anything about the endpoint, let the next one try."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._trial_in_flight or self._consecutive_failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_in_flight:
+                    logging.warning(f'Circuit for {self.name} opened after {self._consecutive_failures} failures')
+                self._opened_at = self._clock()
+                self._trial_in_flight = False
+
+
+_circuit_breakers: dict[str, CircuitBreaker] = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(endpoint: str) -> CircuitBreaker:
+    """The circuit breaker shared by everything in this process that talks to endpoint."""
+    with _circuit_breakers_lock:
+        if endpoint not in _circuit_breakers:
+            _circuit_breakers[endpoint] = CircuitBreaker(endpoint)
+        return _circuit_breakers[endpoint]
+
+
+class RetryPolicy:
+    """
+    Retries a call according to what went wrong.
+
+    Auth errors, bad requests and cancellations are not retried, and unknown errors only once. Rate limits wait for
+    Retry-After when the server sends it and rate_limit_delay otherwise. Everything else backs off exponentially with
+    full jitter, so clients that failed together don't retry together. Malformed output is retried right away, the
+    model is simply asked again.
+    """
+
+    def __init__(self, max_retries: int, rate_limit_delay: float, base_delay: float = DEFAULT_BASE_DELAY,
+                 max_delay: float = DEFAULT_MAX_DELAY, sleep: Callable[[float], None] = time.sleep):
+        self.max_retries = max_retries
+        self.rate_limit_delay = rate_limit_delay
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._sleep = sleep
+
+    def get_delay(self, error_class: str, attempt: int, retry_after: Optional[float] = None) -> float:
+        if error_class == MALFORMED_OUTPUT:
+            return 0.0
+        if error_class == RATE_LIMITED:
+            delay = retry_after if retry_after is not None else self.rate_limit_delay
+            return delay + random.uniform(0, min(1.0, delay * 0.1))
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, function: Callable[[], T], circuit_breaker: Optional[CircuitBreaker] = None,
+             interrupt_event: Optional[threading.Event] = None) -> T:
+        """
+        Calls function until it succeeds or the retries run out, and re-raises the last error then.
+        Waiting between attempts stops early, raising RequestCancelled, when interrupt_event is set.
+        """
+        attempt = 0
+        while True:
+            if circuit_breaker:
+                circuit_breaker.before_request()
+            try:
+                result = function()
+            except Exception as e:
+                error_class = classify_error(e)
+                if circuit_breaker:
+                    if error_class in ENDPOINT_FAILURES:
+                        circuit_breaker.record_failure()
+                    elif error_class == CANCELLED:
+                        circuit_breaker.abandon_trial()
+                    else:
+                        circuit_breaker.record_success()  # It answered, even if not the way we wanted
+                if error_class == CANCELLED and not isinstance(e, RequestCancelled):
+                    raise RequestCancelled(str(e.__cause__ or e)) from e
+                max_retries = MAX_UNKNOWN_ERROR_RETRIES if error_class == UNKNOWN_ERROR else self.max_retries
+                if error_class not in RETRYABLE_ERRORS or attempt >= max_retries:
+                    raise
+
+                delay = self.get_delay(error_class, attempt, get_retry_after(e))
+                attempt += 1
+                logging.warning(f'{error_class}: {e}. Retrying {attempt}/{self.max_retries} in {delay:.1f}s')
+                if interrupt_event is not None and interrupt_event.wait(delay):
+                    raise RequestCancelled('Interrupted while waiting to retry')
+                elif interrupt_event is None:
+                    self._sleep(delay)
+                continue
+
+            if circuit_breaker:
+                circuit_breaker.record_success()
+            return result
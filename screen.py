@@ -1,39 +1,230 @@
 import base64
+import difflib
+import hashlib
+import importlib.util
 import io
 import os
+import platform
+import re
 import tempfile
 import logging
+import threading
+import time
 import tkinter as tk
+from collections import OrderedDict
+from typing import Any, Optional
 
 import pyautogui
 from PIL import Image, ImageTk
+
+from frame_buffer import DEFAULT_CAPTURE_INTERVAL, DEFAULT_MAX_FRAME_AGE, Frame, FrameBuffer
 from settings import Settings  # Updated import
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Which monitor get_screenshot captures, the capture_monitor setting: one of these or a 1 based monitor number
+CAPTURE_ACTIVE_MONITOR = 'active'  # The monitor with the mouse pointer
+CAPTURE_ALL_MONITORS = 'all'  # Every monitor, stitched and scaled down to an overview
+DEFAULT_OVERVIEW_MAX_WIDTH = 1920
+
+TEXT_INDEX_CACHE_SIZE = 4
+MIN_OCR_CONFIDENCE = 30  # Tesseract reports 0-100, -1 for non-word boxes
+MIN_TEXT_MATCH_SCORE = 0.8
+
+DEFAULT_MAX_ACCESSIBILITY_ELEMENTS = 150
+DEFAULT_MAX_ACCESSIBILITY_NODES = 3000
+DEFAULT_ACCESSIBILITY_TIMEOUT = 1.5  # seconds
+MAX_ACCESSIBLE_NAME_LENGTH = 80
+# AT-SPI role names worth sending to the model
+INTERACTIVE_ROLES = frozenset({
+    'push button', 'toggle button', 'check box', 'radio button', 'menu item', 'check menu item', 'radio menu item',
+    'menu', 'combo box', 'entry', 'password text', 'text', 'spin button', 'slider', 'link', 'page tab', 'list item',
+    'table cell', 'tree item', 'icon', 'toolbar button', 'scroll bar',
+})
+LABEL_ROLES = frozenset({'label', 'heading', 'static', 'paragraph', 'status bar', 'image', 'frame', 'dialog', 'alert'})
+TEXT_INPUT_ROLES = frozenset({'entry', 'text', 'spin button'})  # Never 'password text'
+
 class Screen:
+    # Recent frames captured by any Screen instance, shared by the model, the UI and live previews.
+    frame_buffer = FrameBuffer()
+    # Shared so concurrent requests (e.g. a hedged one) never write the same screenshot file at once.
+    _screenshot_counter = 0
+    _screenshot_counter_lock = threading.Lock()
+    # (capture region, image size) of the last screenshot sent to the model, whose pixels its coordinates refer to
+    _model_frame: Optional[tuple[tuple[int, int, int, int], tuple[int, int]]] = None
+
     def __init__(self):
           self.settings = Settings()
-          self.settings_directory = self.settings.get_settings_directory_path()
+          self.settings_directory = self.settings.get_data_directory_path()
           self.screenshot_counter = 0
           self.screenshot_filepath = os.path.join(self.settings_directory, f'screenshot_{self.screenshot_counter}.png')
 
 
     def get_size(self) -> tuple[int, int]:
-        screen_width, screen_height = pyautogui.size()  # Get the size of the primary monitor.
-        return screen_width, screen_height
+        """Size of what get_screenshot captures, the active monitor by default."""
+        (_, _, width, height), _ = self.get_capture_target()
+        return width, height
 
-    def get_screenshot(self) -> Image.Image:
-        # Enable screen recording from settings
-        logging.info("Taking a screenshot using pyautogui")
+    @staticmethod
+    def get_monitors() -> list[dict[str, int]]:
+        """Monitors in desktop coordinates, primary first. Without mss installed only the primary monitor is known."""
         try:
-            img = pyautogui.screenshot()  # Takes roughly 100ms # img.show()
-            return img
+            import mss
+        except ImportError:
+            screen_width, screen_height = pyautogui.size()
+            return [{'left': 0, 'top': 0, 'width': screen_width, 'height': screen_height}]
+
+        with mss.mss() as sct:
+            monitors = [{key: monitor[key] for key in ('left', 'top', 'width', 'height')} for monitor in sct.monitors[1:]]
+        # The primary monitor is the one at the desktop origin.
+        monitors.sort(key=lambda monitor: (monitor['left'], monitor['top']) != (0, 0))
+        return monitors
+
+    def get_capture_target(self, monitor: Optional[str] = None) -> tuple[tuple[int, int, int, int], bool]:
+        """
+        ((left, top, width, height), is_overview): the region in desktop coordinates to capture, per the
+        capture_monitor setting or monitor, and whether it spans several monitors.
+        """
+        target = str(monitor or self.settings.get_dict().get('capture_monitor', CAPTURE_ACTIVE_MONITOR)).lower()
+        monitors = self.get_monitors()
+        if target == CAPTURE_ALL_MONITORS and len(monitors) > 1:
+            left = min(m['left'] for m in monitors)
+            top = min(m['top'] for m in monitors)
+            right = max(m['left'] + m['width'] for m in monitors)
+            bottom = max(m['top'] + m['height'] for m in monitors)
+            return (left, top, right - left, bottom - top), True
+
+        chosen = monitors[0]
+        if target.isdigit() and 1 <= int(target) <= len(monitors):
+            chosen = monitors[int(target) - 1]
+        elif len(monitors) > 1:
+            pointer_x, pointer_y = pyautogui.position()
+            for candidate in monitors:
+                if candidate['left'] <= pointer_x < candidate['left'] + candidate['width'] and \
+                        candidate['top'] <= pointer_y < candidate['top'] + candidate['height']:
+                    chosen = candidate
+                    break
+        return (chosen['left'], chosen['top'], chosen['width'], chosen['height']), False
+
+    def get_screenshot(self, monitor: Optional[str] = None) -> Image.Image:
+        return self.capture_frame(monitor).image
+
+    def capture_frame(self, monitor: Optional[str] = None) -> Frame:
+        """
+        Captures the monitor chosen by the capture_monitor setting, or by monitor, into the frame buffer. The captured
+        region, in desktop coordinates, is kept in the image's info as 'capture_region' so frame pixels can be mapped
+        back to the desktop.
+        """
+        region, is_overview = self.get_capture_target(monitor)
+        left, top, width, height = region
+        captured_at = time.monotonic()
+        try:
+            try:
+                import mss
+            except ImportError:
+                # Without mss, get_monitors only knows the primary monitor, which is what pyautogui captures.
+                logging.debug("Taking a screenshot using pyautogui")
+                img = pyautogui.screenshot()  # Takes roughly 100ms # img.show()
+            else:
+                logging.debug(f"Taking a screenshot of {width}x{height} at ({left}, {top}) using mss")
+                with mss.mss() as sct:
+                    shot = sct.grab({'left': left, 'top': top, 'width': width, 'height': height})
+                img = Image.frombytes('RGB', shot.size, shot.bgra, 'raw', 'BGRX')
         except Exception as e:
             logging.error(f"Error taking screenshot: {e}")
             raise
 
+        overview_max_width = int(self.settings.get_dict().get('overview_max_width', DEFAULT_OVERVIEW_MAX_WIDTH))
+        if is_overview and img.width > overview_max_width:
+            # Pixels sent should follow what's worth seeing, not total desk area, so the overview stays compact.
+            img = img.resize((overview_max_width, round(img.height * overview_max_width / img.width)),
+                             Image.Resampling.BOX, reducing_gap=2.0)
+        img.info['capture_region'] = region
+        return Screen.frame_buffer.publish(img, captured_at)
+
+    def get_frame(self, max_age: float = DEFAULT_MAX_FRAME_AGE) -> Frame:
+        """The current screen: the buffered frame when it's recent and no input was sent since, a new capture if not."""
+        return Screen.frame_buffer.get_current(self.capture_frame, max_age)
+
+    @classmethod
+    def start_capture_service(cls) -> None:
+        """Keeps the frame buffer filled in the background, every frame_capture_interval seconds (0 turns it off)."""
+        interval = float(Settings().get_dict().get('frame_capture_interval', DEFAULT_CAPTURE_INTERVAL))
+        cls.frame_buffer.start(lambda: cls().capture_frame(), interval)
+
+    @classmethod
+    def stop_capture_service(cls) -> None:
+        cls.frame_buffer.stop()
+
+    @staticmethod
+    def get_capture_region(frame: Image.Image) -> tuple[int, int, int, int]:
+        """(left, top, width, height) in desktop coordinates that frame shows, the primary monitor if it doesn't say."""
+        region = frame.info.get('capture_region')
+        if region is None:
+            screen_width, screen_height = pyautogui.size()
+            return 0, 0, screen_width, screen_height
+        return region
+
+    @classmethod
+    def frame_to_screen(cls, frame: Image.Image, x: float, y: float) -> tuple[int, int]:
+        """Desktop coordinates, as pyautogui uses them, of a pixel in frame."""
+        return cls._region_to_screen(cls.get_capture_region(frame), frame.size, x, y)
+
+    @classmethod
+    def screen_to_frame(cls, frame: Image.Image, x: float, y: float) -> tuple[float, float]:
+        left, top, width, height = cls.get_capture_region(frame)
+        return (x - left) * frame.width / width, (y - top) * frame.height / height
+
+    @classmethod
+    def get_model_frame(cls) -> Optional[tuple[tuple[int, int, int, int], tuple[int, int]]]:
+        """(capture region, image size) of the last screenshot sent to the model, None before the first."""
+        return cls._model_frame
+
+    @classmethod
+    def set_model_frame(cls, model_frame: Optional[tuple[tuple[int, int, int, int], tuple[int, int]]]) -> None:
+        cls._model_frame = model_frame
+
+    @classmethod
+    def model_to_screen(cls, x: float, y: float) -> tuple[int, int]:
+        """Desktop coordinates of a point the model gave in pixels of the last screenshot it was sent."""
+        if cls._model_frame is None:
+            return round(x), round(y)
+        region, size = cls._model_frame
+        return cls._region_to_screen(region, size, x, y)
+
+    @classmethod
+    def screen_box_to_model(cls, box: list[int]) -> list[int]:
+        """A desktop [x, y, width, height] box in pixels of the last screenshot the model was sent."""
+        if cls._model_frame is None:
+            return list(box)
+        (left, top, width, height), size = cls._model_frame
+        x_scale, y_scale = size[0] / width, size[1] / height
+        return [round((box[0] - left) * x_scale), round((box[1] - top) * y_scale), round(box[2] * x_scale),
+                round(box[3] * y_scale)]
+
+    @classmethod
+    def model_box_to_screen(cls, box: list[int],
+                            model_frame: Optional[tuple[tuple[int, int, int, int], tuple[int, int]]]) -> list[int]:
+        """The desktop box of a box in pixels of the screenshot with model_frame, see screen_box_to_model."""
+        if model_frame is None:
+            return list(box)
+        region, size = model_frame
+        left, top = cls._region_to_screen(region, size, box[0], box[1])
+        right, bottom = cls._region_to_screen(region, size, box[0] + box[2], box[1] + box[3])
+        return [left, top, right - left, bottom - top]
+
+    @staticmethod
+    def _region_to_screen(region: tuple[int, int, int, int], size: tuple[int, int], x: float,
+                          y: float) -> tuple[int, int]:
+        left, top, width, height = region
+        return round(left + x * width / size[0]), round(top + y * height / size[1])
+
+    @classmethod
+    def get_latest_frame(cls) -> tuple[int, Optional[Image.Image]]:
+        frame = cls.frame_buffer.latest()
+        return (frame.frame_id, frame.image) if frame else (0, None)
+
     def get_screenshot_as_photo_image(self, max_height=150) -> ImageTk.PhotoImage:
         """Captures the screenshot and returns it as a PhotoImage"""
         try:
@@ -50,17 +241,11 @@ class Screen:
 
     def get_screenshot_in_base64(self) -> str:
         # Base64 images work with ChatCompletions API but not Assistants API
-        img_bytes = self.get_screenshot_as_file_object()
-        encoded_image = base64.b64encode(img_bytes.read()).decode('utf-8')
-        return encoded_image
+        return base64.b64encode(self.get_frame().encode('PNG')).decode('utf-8')
 
     def get_screenshot_as_file_object(self) -> io.BytesIO:
-         """Captures the screenshot and returns it as an in-memory file object"""
-         img_bytes = io.BytesIO()
-         img = self.get_screenshot()
-         img.save(img_bytes, format='PNG')  # Save the screenshot to an in-memory file.
-         img_bytes.seek(0)
-         return img_bytes
+         """Returns the current screen as an in-memory PNG file object"""
+         return io.BytesIO(self.get_frame().encode('PNG'))
 
     def get_temp_filename_for_current_screenshot(self) -> str:
         """Saves screenshot to a temp file, returns the path"""
@@ -75,16 +260,292 @@ class Screen:
             raise
 
 
-    def get_screenshot_file(self) -> str:
-        """Saves the screenshot to the settings directory and returns the file path"""
+    def get_model_screenshot(self, max_width: Optional[int] = None) -> tuple[Frame, memoryview]:
+        """
+        The current frame and its PNG encoding, scaled down to max_width, to send to the model. The model's coordinates
+        refer to pixels of that PNG from now on.
+        """
+        frame = self.get_frame()
+        png = frame.encode('PNG', max_width=max_width)
+        Screen._model_frame = (self.get_capture_region(frame.image), frame.resized(max_width).size)
+        return frame, png
+
+    def get_screenshot_file(self, max_width: Optional[int] = None) -> str:
+        """Saves the screenshot to the settings directory and returns the file path. max_width saves a thumbnail."""
+        _, png = self.get_model_screenshot(max_width)
+        return self.save_screenshot(png)
+
+    def save_screenshot(self, png: memoryview) -> str:
+        """Writes an encoded screenshot to the next of the settings directory's screenshot files, returns its path."""
+        with Screen._screenshot_counter_lock:
+            self.screenshot_counter = Screen._screenshot_counter
+            Screen._screenshot_counter = (Screen._screenshot_counter + 1) % 10
         filename = f'screenshot_{self.screenshot_counter}.png'
-        self.screenshot_filepath = os.path.join(self.settings_directory, filename)
-        logging.info(f"Saving screenshot to file: {self.screenshot_filepath}")
+        screenshot_filepath = os.path.join(self.settings_directory, filename)
+        self.screenshot_filepath = screenshot_filepath
+        logging.info(f"Saving screenshot to file: {screenshot_filepath}")
         try:
-            img = self.get_screenshot()
-            img.save(self.screenshot_filepath)
-            self.screenshot_counter = (self.screenshot_counter + 1) % 10
-            return self.screenshot_filepath
+            with open(screenshot_filepath, 'wb') as screenshot_file:
+                screenshot_file.write(png)
+            return screenshot_filepath
         except Exception as e:
              logging.error(f"Error saving screenshot to file: {e}")
-             raise
\ No newline at end of file
+             raise
+
+
+class TextIndex:
+    """
+    Words visible in a frame, found with a local OCR engine (Tesseract through pytesseract), with their boxes and
+    confidence.
+
+    OCR takes around a second for a full screen, so indexes are cached by a hash of the frame's pixels: finding
+    several phrases in an unchanged screen costs one OCR pass. Boxes are in frame pixels, see to_screen_coordinates.
+    """
+
+    _cache: OrderedDict[str, 'TextIndex'] = OrderedDict()
+    _cache_lock = threading.Lock()
+
+    def __init__(self, words: list[dict[str, Any]], frame_size: tuple[int, int],
+                 capture_region: tuple[int, int, int, int]):
+        self.words = words
+        self.frame_size = frame_size
+        self.capture_region = capture_region
+
+    @classmethod
+    def for_frame(cls, frame: Image.Image) -> 'TextIndex':
+        capture_region = Screen.get_capture_region(frame)
+        frame_hash = hashlib.blake2b(frame.tobytes() + repr(capture_region).encode(), digest_size=16).hexdigest()
+        with cls._cache_lock:
+            if frame_hash in cls._cache:
+                cls._cache.move_to_end(frame_hash)
+                return cls._cache[frame_hash]
+
+        index = cls(cls._recognize(frame), frame.size, capture_region)
+        with cls._cache_lock:
+            cls._cache[frame_hash] = index
+            while len(cls._cache) > TEXT_INDEX_CACHE_SIZE:
+                cls._cache.popitem(last=False)
+        return index
+
+    @staticmethod
+    def _recognize(frame: Image.Image) -> list[dict[str, Any]]:
+        try:
+            import pytesseract
+        except ImportError as e:
+            raise RuntimeError(f'Finding text on screen needs pytesseract and Tesseract installed: {e}')
+
+        start_time = time.monotonic()
+        data = pytesseract.image_to_data(frame.convert('L'), output_type=pytesseract.Output.DICT)
+        words = []
+        for i, text in enumerate(data['text']):
+            confidence = float(data['conf'][i])
+            if not text.strip() or confidence < MIN_OCR_CONFIDENCE:
+                continue
+            words.append({
+                'text': text.strip(),
+                'box': [data['left'][i], data['top'][i], data['width'][i], data['height'][i]],
+                'confidence': confidence,
+                'line': (data['block_num'][i], data['par_num'][i], data['line_num'][i]),
+            })
+        logging.info(f'OCR found {len(words)} words in {time.monotonic() - start_time:.2f}s')
+        return words
+
+    def find(self, phrase: str) -> list[dict[str, Any]]:
+        """
+        Places where phrase appears, best match first. A match is a run of consecutive words on one line, compared
+        ignoring case and punctuation, and fuzzily so OCR slips like 'Exp0rt' still match.
+        Each match has the text, the union box of its words, a similarity score and the mean confidence.
+        """
+        target = _normalize_text(phrase)
+        if not target:
+            return []
+        target_word_count = len(target.split())
+
+        lines: dict[tuple, list[dict[str, Any]]] = {}
+        for word in self.words:
+            lines.setdefault(word['line'], []).append(word)
+
+        matches = []
+        for line_words in lines.values():
+            for start in range(len(line_words)):
+                # Allow one word more or less than the phrase, OCR sometimes splits or joins words.
+                for length in range(max(1, target_word_count - 1), target_word_count + 2):
+                    run = line_words[start:start + length]
+                    if len(run) < length:
+                        break
+                    candidate = _normalize_text(' '.join(word['text'] for word in run))
+                    score = difflib.SequenceMatcher(None, target, candidate).ratio()
+                    if score >= MIN_TEXT_MATCH_SCORE:
+                        matches.append({
+                            'text': ' '.join(word['text'] for word in run),
+                            'box': _union_box([word['box'] for word in run]),
+                            'score': score,
+                            'confidence': sum(word['confidence'] for word in run) / len(run),
+                        })
+
+        # Overlapping runs of the same text compete, keep the best one per location.
+        matches.sort(key=lambda match: (-match['score'], -match['confidence']))
+        best_matches = []
+        for match in matches:
+            if not any(_boxes_overlap(match['box'], kept['box']) for kept in best_matches):
+                best_matches.append(match)
+        return best_matches
+
+    def to_screen_coordinates(self, x: float, y: float) -> tuple[int, int]:
+        """Maps frame pixels to the desktop coordinates pyautogui uses, which differ on HiDPI and secondary screens."""
+        return Screen._region_to_screen(self.capture_region, self.frame_size, x, y)
+
+
+def _normalize_text(text: str) -> str:
+    return ' '.join(re.sub(r'[^\w\s]', ' ', text.casefold()).split())
+
+
+def _union_box(boxes: list[list[int]]) -> list[int]:
+    left = min(box[0] for box in boxes)
+    top = min(box[1] for box in boxes)
+    right = max(box[0] + box[2] for box in boxes)
+    bottom = max(box[1] + box[3] for box in boxes)
+    return [left, top, right - left, bottom - top]
+
+
+def _boxes_overlap(a: list[int], b: list[int]) -> bool:
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+class AccessibilityObserver:
+    """
+    Describes the focused window from the AT-SPI accessibility tree (Linux), as a compact list of elements.
+
+    Each element has an id, role, name, and bounding box in screen coordinates, which is a few KB of JSON instead of a
+    full screenshot. The tree is pruned while it is walked: hidden, zero sized and off screen subtrees are skipped,
+    layout containers are flattened into their children, and the walk stops at max_nodes or max_seconds since every
+    node is an IPC round trip. If there are still more than max_elements elements, interactive ones are kept first.
+
+    The last snapshot is kept so the model's element ids can be resolved to click targets.
+    """
+
+    _last_elements: dict[int, dict[str, Any]] = {}
+    _last_elements_lock = threading.Lock()
+
+    def __init__(self, max_elements: int = DEFAULT_MAX_ACCESSIBILITY_ELEMENTS,
+                 max_nodes: int = DEFAULT_MAX_ACCESSIBILITY_NODES, max_seconds: float = DEFAULT_ACCESSIBILITY_TIMEOUT):
+        self.max_elements = max_elements
+        self.max_nodes = max_nodes
+        self.max_seconds = max_seconds
+
+    @staticmethod
+    def is_available() -> bool:
+        return platform.system() == 'Linux' and importlib.util.find_spec('pyatspi') is not None
+
+    def snapshot(self) -> Optional[list[dict[str, Any]]]:
+        """Elements of the focused window, or None if there is no accessibility tree to read."""
+        if not self.is_available():
+            return None
+        import pyatspi
+
+        try:
+            window = self._find_active_window(pyatspi)
+            if window is None:
+                logging.info('No active window in the accessibility tree')
+                return None
+            candidates = self._collect(pyatspi, window)
+        except Exception as e:
+            logging.error(f'Error reading the accessibility tree: {e}')
+            return None
+        if not candidates:
+            return None
+
+        if len(candidates) > self.max_elements:
+            label_budget = max(0, self.max_elements - sum(c['role'] in INTERACTIVE_ROLES for c in candidates))
+            pruned = []
+            for candidate in candidates:
+                if candidate['role'] in INTERACTIVE_ROLES:
+                    pruned.append(candidate)
+                elif label_budget > 0:
+                    pruned.append(candidate)
+                    label_budget -= 1
+            candidates = pruned[:self.max_elements]
+
+        elements = []
+        for element_id, candidate in enumerate(candidates, start=1):
+            elements.append({'id': element_id, **candidate})
+        self.remember_elements(elements)
+        logging.info(f'Accessibility snapshot has {len(elements)} elements')
+        return elements
+
+    @staticmethod
+    def _find_active_window(pyatspi):
+        desktop = pyatspi.Registry.getDesktop(0)
+        for app in desktop:
+            if app is None:
+                continue
+            for window in app:
+                if window is not None and window.getState().contains(pyatspi.STATE_ACTIVE):
+                    return window
+        return None
+
+    def _collect(self, pyatspi, window) -> list[dict[str, Any]]:
+        # Windows can be on any monitor, so on screen means anywhere on the desktop.
+        monitors = Screen.get_monitors()
+        desktop_left = min(monitor['left'] for monitor in monitors)
+        desktop_top = min(monitor['top'] for monitor in monitors)
+        desktop_right = max(monitor['left'] + monitor['width'] for monitor in monitors)
+        desktop_bottom = max(monitor['top'] + monitor['height'] for monitor in monitors)
+        deadline = time.monotonic() + self.max_seconds
+        candidates = []
+        visited = 0
+        stack = [window]
+        while stack:
+            if visited >= self.max_nodes or time.monotonic() > deadline:
+                logging.info(f'Accessibility walk stopped after {visited} nodes')
+                break
+            node = stack.pop()
+            visited += 1
+            try:
+                state = node.getState()
+                if not (state.contains(pyatspi.STATE_SHOWING) and state.contains(pyatspi.STATE_VISIBLE)):
+                    continue
+                x, y, width, height = node.queryComponent().getExtents(pyatspi.DESKTOP_COORDS)
+                if width <= 0 or height <= 0 or x + width <= desktop_left or y + height <= desktop_top or \
+                        x >= desktop_right or y >= desktop_bottom:
+                    continue
+
+                role = node.getRoleName()
+                name = (node.name or '').strip()
+                if role in INTERACTIVE_ROLES or (name and role in LABEL_ROLES):
+                    candidate = {'role': role, 'name': name[:MAX_ACCESSIBLE_NAME_LENGTH],
+                                 'box': [x, y, width, height]}
+                    if state.contains(pyatspi.STATE_FOCUSED):
+                        candidate['focused'] = True
+                    if state.contains(pyatspi.STATE_CHECKED) or state.contains(pyatspi.STATE_SELECTED):
+                        candidate['selected'] = True
+                    if not state.contains(pyatspi.STATE_SENSITIVE):
+                        candidate['disabled'] = True
+                    if role in TEXT_INPUT_ROLES:
+                        candidate['text'] = self._get_text(node)
+                    candidates.append(candidate)
+
+                # Children are pushed in reverse so the walk visits them, and emits elements, in reading order.
+                stack.extend(node[i] for i in reversed(range(node.childCount)))
+            except Exception as e:
+                logging.debug(f'Skipping accessibility node: {e}')
+        return candidates
+
+    @staticmethod
+    def _get_text(node) -> str:
+        try:
+            return node.queryText().getText(0, MAX_ACCESSIBLE_NAME_LENGTH)
+        except Exception:
+            return ''
+
+    @classmethod
+    def remember_elements(cls, elements: list[dict[str, Any]]) -> None:
+        """Makes elements the ones the model's element ids refer to."""
+        with cls._last_elements_lock:
+            cls._last_elements = {element['id']: element for element in elements}
+
+    @classmethod
+    def get_element(cls, element_id: int) -> Optional[dict[str, Any]]:
+        """An element from the last snapshot."""
+        with cls._last_elements_lock:
+            return cls._last_elements.get(element_id)
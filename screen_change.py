@@ -0,0 +1,23 @@
+from PIL import Image
+
+# Each signature cell averages about 12x12 pixels of a 1080p screen, so a caret, a focus ring or a ticked checkbox
+# still moves the cell it's in by several gray levels.
+CHANGE_SIGNATURE_SIZE = (160, 90)
+# Largest difference of any one signature cell below which the screen counts as unchanged. Captures of an unchanged
+# screen are pixel identical, so this only has to absorb rounding.
+SCREEN_CHANGE_THRESHOLD = 2 / 255
+
+
+def get_change_signature(img: Image.Image) -> bytes:
+    """A tiny grayscale thumbnail of img, enough to tell whether anything on screen changed between two frames."""
+    return img.convert('L').resize(CHANGE_SIGNATURE_SIZE, Image.Resampling.BOX, reducing_gap=2.0).tobytes()
+
+
+def signature_difference(signature_a: bytes, signature_b: bytes) -> float:
+    """
+    Largest difference of any one cell between two change signatures, from 0.0 (identical) to 1.0. The largest
+    rather than the mean, so a small change in one place isn't averaged away by the rest of the screen.
+    """
+    if len(signature_a) != len(signature_b) or not signature_a:
+        return 1.0
+    return max(abs(a - b) for a, b in zip(signature_a, signature_b)) / 255
@@ -0,0 +1,182 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+from event_bus import (Event, EventBus, ModelCallEvent, RequestFinishedEvent, RequestStartedEvent, RoundEvent,
+                       ScreenChangeEvent, StepEvent)
+from frame_buffer import Frame
+from model_tiers import TIERED_MODEL_MODE
+from settings import Settings
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+SESSION_FILE_NAME = 'session.json'
+FRAMES_DIRECTORY = 'frames'
+DEFAULT_MAX_RECORDINGS = 50
+SESSION_FORMAT_VERSION = 1
+
+
+def get_recordings_directory_path() -> str:
+    return os.path.join(Settings().get_data_directory_path(), 'recordings')
+
+
+class SessionRecorder:
+    """
+    Records every request Core runs to a zip archive, for replaying it offline with session_replay.
+
+    An archive holds session.json, with each round's formatted request, raw model response, parsed instructions and
+    timings, the steps that were executed and what Core found when it checked whether they changed the screen, and
+    the screenshots the model was sent under frames/, named by the hash of their pixels so a screen that didn't
+    change between rounds is stored once. Frames stay in memory until the request finishes and the archive is
+    written on a background thread, so recording never slows a request down.
+
+    Recording is off unless the record_sessions setting is on.
+    """
+
+    def __init__(self, event_bus: EventBus, directory: Optional[str] = None):
+        self.directory = directory or get_recordings_directory_path()
+        self._lock = threading.Lock()  # Hedged model calls are published from other threads
+        self._session: Optional[dict[str, Any]] = None
+        self._frames: dict[int, Frame] = {}  # By frame id until the archive is written
+        self._pending_calls: list[dict[str, Any]] = []
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='session-recorder')
+        event_bus.subscribe(self.handle_event, (RequestStartedEvent, RequestFinishedEvent, ModelCallEvent, RoundEvent,
+                                                StepEvent, ScreenChangeEvent))
+
+    def handle_event(self, event: Event) -> None:
+        if isinstance(event, RequestStartedEvent):
+            self._start(event)
+            return
+        with self._lock:
+            if self._session is None:
+                return
+            if isinstance(event, ModelCallEvent):
+                self._pending_calls.append(self._record_call(event))
+            elif isinstance(event, RoundEvent):
+                self._session['rounds'].append({
+                    'step_num': event.step_num,
+                    'tier': event.tier,
+                    'instructions': event.instructions,
+                    'latency': event.latency,
+                    'error': event.error,
+                    'error_class': event.error_class,
+                    'calls': self._pending_calls,
+                })
+                self._pending_calls = []
+            elif isinstance(event, StepEvent):
+                self._session['steps'].append({
+                    'step_num': event.step_num,
+                    'step': event.step,
+                    'success': event.success,
+                    'duration': event.duration,
+                })
+            elif isinstance(event, ScreenChangeEvent):
+                self._session['screen_changes'].append({
+                    'step_num': event.step_num,
+                    'step': event.step,
+                    'changed': event.changed,
+                })
+            elif isinstance(event, RequestFinishedEvent):
+                session, frames = self._session, self._frames
+                session['result'] = event.result
+                session['duration'] = event.duration
+                self._session, self._frames, self._pending_calls = None, {}, []
+                self._writer.submit(self._write, session, frames)
+
+    def _start(self, event: RequestStartedEvent) -> None:
+        settings_dict = Settings().get_dict()
+        with self._lock:
+            self._session, self._frames, self._pending_calls = None, {}, []
+            if not settings_dict.get('record_sessions', False):
+                return
+            self._session = {
+                'version': SESSION_FORMAT_VERSION,
+                'request': event.request,
+                'started_at': time.time(),
+                'tiered': settings_dict.get('model_mode') == TIERED_MODEL_MODE,
+                'model': settings_dict.get('model'),
+                'rounds': [],
+                'steps': [],
+                'screen_changes': [],
+            }
+
+    def _record_call(self, event: ModelCallEvent) -> dict[str, Any]:
+        """
+        Must be called with _lock held. The frame is noted by its id, and hashed on the writer thread rather than on the
+        model's.
+        """
+        frame_id = None
+        if event.frame is not None:
+            frame_id = event.frame.frame_id
+            self._frames.setdefault(frame_id, event.frame)
+        return {
+            'model_name': event.model_name,
+            'step_num': event.step_num,
+            'request': event.request,
+            'response': event.response,
+            'latency': event.latency,
+            'frame': frame_id,
+            'capture_region': event.frame.capture_region if event.frame is not None else None,
+            'model_frame': event.model_frame,
+        }
+
+    def _write(self, session: dict[str, Any], frames: dict[int, Frame]) -> None:
+        # Frames are stored by the hash of their pixels, so the same screen captured twice is stored once.
+        frame_hashes = {frame_id: hashlib.sha256(frame.pixels()).hexdigest() for frame_id, frame in frames.items()}
+        for recorded in session['rounds']:
+            for call in recorded['calls']:
+                if call['frame'] is not None:
+                    call['frame'] = frame_hashes[call['frame']]
+        frames = {frame_hashes[frame_id]: frame for frame_id, frame in frames.items()}
+        slug = re.sub(r'[^a-z0-9]+', '-', session['request'].lower()).strip('-')[:40] or 'request'
+        file_name = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(session['started_at']))}-{slug}.zip"
+        path = os.path.join(self.directory, file_name)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with zipfile.ZipFile(path + '.tmp', 'w') as archive:
+                archive.writestr(SESSION_FILE_NAME, json.dumps(session, default=str), zipfile.ZIP_DEFLATED)
+                for frame_hash, frame in frames.items():
+                    # PNGs are already compressed
+                    archive.writestr(f'{FRAMES_DIRECTORY}/{frame_hash}.png', bytes(frame.encode('PNG')),
+                                     zipfile.ZIP_STORED)
+            os.replace(path + '.tmp', path)
+            logging.info(f"Recorded session with {len(session['rounds'])} rounds and {len(frames)} frames to {path}")
+        except Exception as e:
+            logging.error(f'Error writing session recording {path}: {e}')
+            return
+        self._prune()
+
+    def _prune(self) -> None:
+        max_recordings = int(Settings().get_dict().get('max_recordings', DEFAULT_MAX_RECORDINGS))
+        recordings = sorted(name for name in os.listdir(self.directory) if name.endswith('.zip'))
+        for name in recordings[:max(0, len(recordings) - max_recordings)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError as e:
+                logging.error(f'Error removing old session recording {name}: {e}')
+
+    def close(self) -> None:
+        """Waits for archives still being written."""
+        self._writer.shutdown(wait=True)
+
+
+def read_frame(archive: zipfile.ZipFile, frame_hash: str) -> bytes:
+    with archive.open(f'{FRAMES_DIRECTORY}/{frame_hash}.png') as frame_file:
+        return frame_file.read()
+
+
+def load_session(path: str) -> tuple[dict[str, Any], zipfile.ZipFile]:
+    """The session.json of a recording and the open archive its frames can be read from."""
+    archive = zipfile.ZipFile(path)
+    with archive.open(SESSION_FILE_NAME) as session_file:
+        session = json.load(io.TextIOWrapper(session_file, encoding='utf-8'))
+    return session, archive
@@ -0,0 +1,340 @@
+import argparse
+import io
+import json
+import logging
+import time
+from typing import Any, Optional
+
+from PIL import Image
+
+from core import Core
+from event_bus import EventBus, ScreenChangeEvent, StepEvent
+from frame_buffer import DEFAULT_MAX_FRAME_AGE, Frame
+from interpreter import Interpreter
+from model_tiers import SMALL_TIER, TierStats
+from models.gpt4o import GPT4o
+from screen import AccessibilityObserver, Screen
+from session_recorder import load_session, read_frame
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class RecordedRoundError(Exception):
+    """A round that failed when it was recorded, raised again with the same error class so retries play out the same."""
+
+    def __init__(self, message: str, error_class: Optional[str]):
+        super().__init__(message)
+        self.error_class = error_class
+
+
+class RecordedSession:
+    """A recording made by SessionRecorder. Frames are decoded when they're first needed."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.session, self._archive = load_session(path)
+        self._frames: dict[str, Image.Image] = {}
+
+    @property
+    def request(self) -> str:
+        return self.session['request']
+
+    @property
+    def rounds(self) -> list[dict[str, Any]]:
+        return self.session['rounds']
+
+    def get_frame(self, frame_hash: str, capture_region: Optional[list[int]] = None) -> Image.Image:
+        if frame_hash not in self._frames:
+            image = Image.open(io.BytesIO(read_frame(self._archive, frame_hash)))
+            image.load()
+            if capture_region:
+                image.info['capture_region'] = tuple(capture_region)
+            self._frames[frame_hash] = image
+        return self._frames[frame_hash]
+
+    def close(self) -> None:
+        self._archive.close()
+
+
+class VirtualInputBackend:
+    """
+    Stands in for pyautogui during replays: records the input it's asked to send, sends nothing and doesn't sleep.
+    Applications are "opened" and "closed" here too, the interpreter would otherwise really start and stop them.
+    """
+
+    def __init__(self, screen_size: tuple[int, int]):
+        self.screen_size = screen_size
+        self.pointer = (screen_size[0] // 2, screen_size[1] // 2)
+        self.calls: list[tuple[str, tuple, dict[str, Any]]] = []
+
+    def _record(self, function_name: str, *args, **kwargs) -> None:
+        self.calls.append((function_name, args, kwargs))
+
+    def click(self, x=None, y=None, *args, **kwargs):
+        if x is not None and y is not None:
+            self.pointer = (x, y)
+        self._record('click', x, y, *args, **kwargs)
+
+    def doubleClick(self, x=None, y=None, *args, **kwargs):
+        if x is not None and y is not None:
+            self.pointer = (x, y)
+        self._record('doubleClick', x, y, *args, **kwargs)
+
+    def rightClick(self, x=None, y=None, *args, **kwargs):
+        if x is not None and y is not None:
+            self.pointer = (x, y)
+        self._record('rightClick', x, y, *args, **kwargs)
+
+    def moveTo(self, x=None, y=None, *args, **kwargs):
+        if x is not None and y is not None:
+            self.pointer = (x, y)
+        self._record('moveTo', x, y, *args, **kwargs)
+
+    def dragTo(self, x=None, y=None, *args, **kwargs):
+        if x is not None and y is not None:
+            self.pointer = (x, y)
+        self._record('dragTo', x, y, *args, **kwargs)
+
+    def mouseDown(self, *args, **kwargs):
+        self._record('mouseDown', *args, **kwargs)
+
+    def mouseUp(self, *args, **kwargs):
+        self._record('mouseUp', *args, **kwargs)
+
+    def scroll(self, *args, **kwargs):
+        self._record('scroll', *args, **kwargs)
+
+    def write(self, *args, **kwargs):
+        self._record('write', *args, **kwargs)
+
+    def press(self, *args, **kwargs):
+        self._record('press', *args, **kwargs)
+
+    def hotkey(self, *args, **kwargs):
+        self._record('hotkey', *args, **kwargs)
+
+    def keyDown(self, *args, **kwargs):
+        self._record('keyDown', *args, **kwargs)
+
+    def keyUp(self, *args, **kwargs):
+        self._record('keyUp', *args, **kwargs)
+
+    def open_application(self, application_name: str):
+        self._record('open_application', application_name)
+
+    def close_application(self, application_name: str):
+        self._record('close_application', application_name)
+
+    def sleep(self, secs):
+        self._record('sleep', secs)
+
+    def size(self) -> tuple[int, int]:
+        return self.screen_size
+
+    def position(self) -> tuple[int, int]:
+        return self.pointer
+
+
+class ReplayScreen(Screen):
+    """The screen as it was recorded: whatever frame the current round was sent, however often it's captured."""
+
+    def __init__(self):
+        super().__init__()
+        self._frame: Optional[Frame] = None
+
+    def set_frame(self, image: Image.Image) -> None:
+        if self._frame is None or self._frame.image is not image:
+            self._frame = Screen.frame_buffer.publish(image)
+
+    def capture_frame(self, monitor: Optional[str] = None) -> Frame:
+        if self._frame is None:
+            raise ValueError('No recorded frame to replay yet')
+        return self._frame
+
+    def get_frame(self, max_age: float = DEFAULT_MAX_FRAME_AGE) -> Frame:
+        return self.capture_frame()
+
+
+class ReplayLLM:
+    """
+    Answers Core with the recorded rounds, in order, instead of asking a model.
+
+    Each round restores what the model saw when it was recorded (the frame, where that frame was on the desktop and
+    the accessibility elements) so coordinates and element ids resolve exactly as they did, and its instructions are
+    parsed again from the model's raw answer, the last one if the round asked more than once. Rounds that failed fail
+    again with the same error class. When Core asks for a round the recording doesn't have, or for a different step
+    or tier than was recorded, that's noted in divergences.
+    """
+
+    def __init__(self, session: RecordedSession, screen: ReplayScreen, simulate_latency: bool = False):
+        self.session = session
+        self.screen = screen
+        self.simulate_latency = simulate_latency
+        self.is_tiered = session.session.get('tiered', False)
+        self.tier_stats = TierStats()
+        self.base_url = None  # No circuit breaker, nothing is sent anywhere
+        self.divergences: list[str] = []
+        self._next_round = 0
+
+    def get_instructions_for_objective(self, original_user_request: str, step_num: int = 0,
+                                       tier: str = SMALL_TIER) -> dict[str, Any]:
+        if self._next_round >= len(self.session.rounds):
+            self.divergences.append(f'Round {self._next_round} (step {step_num}, {tier}) was not recorded')
+            return {'steps': [], 'done': 'The recording has no more rounds'}
+        recorded = self.session.rounds[self._next_round]
+        self._next_round += 1
+        if (recorded['step_num'], recorded['tier']) != (step_num, tier):
+            self.divergences.append(f"Round {self._next_round - 1} was step {recorded['step_num']} on the "
+                                    f"{recorded['tier']} model, replayed as step {step_num} on the {tier} model")
+
+        self._restore_screen(recorded)
+        if self.simulate_latency:
+            time.sleep(recorded['latency'])
+        if recorded.get('error'):
+            raise RecordedRoundError(recorded['error'], recorded.get('error_class'))
+        instructions = recorded['instructions']
+        if recorded['calls']:
+            instructions = GPT4o.parse_response_text(recorded['calls'][-1]['response'])
+            if instructions != recorded['instructions']:
+                self.divergences.append(f'Round {self._next_round - 1} parsed to different instructions than were '
+                                        f'recorded')
+        self.tier_stats.record_round(tier, recorded['latency'])
+        return instructions
+
+    def begin_request(self) -> None:
+        pass
+
+    def end_request(self) -> None:
+        pass
+
+    @property
+    def replayed_rounds(self) -> int:
+        return self._next_round
+
+    def _restore_screen(self, recorded: dict[str, Any]) -> None:
+        calls = [call for call in recorded['calls'] if call.get('frame')]
+        if calls:
+            call = calls[-1]
+            self.screen.set_frame(self.session.get_frame(call['frame'], call.get('capture_region')))
+            Screen.set_model_frame(call.get('model_frame'))
+        else:
+            Screen.set_model_frame(None)
+        for call in recorded['calls']:
+            elements = self._get_screen_elements(call.get('request'))
+            if elements is not None:
+                # Elements sent with a thumbnail have boxes in its pixels, click_element needs screen coordinates.
+                AccessibilityObserver.remember_elements([
+                    {**element, 'box': Screen.model_box_to_screen(element['box'], call.get('model_frame'))}
+                    for element in elements])
+
+    @staticmethod
+    def _get_screen_elements(request: Any) -> Optional[list[dict[str, Any]]]:
+        """The accessibility elements in a formatted request, if it had any."""
+        for content in request if isinstance(request, list) else []:
+            if isinstance(content, dict) and content.get('type') == 'text':
+                try:
+                    return json.loads(content['text']).get('screen_elements')
+                except (ValueError, AttributeError):
+                    return None
+        return None
+
+    def cleanup(self) -> None:
+        pass
+
+
+class ReplayCore(Core):
+    """
+    Core that answers its screen change checks with what was found when the session was recorded. The recorded
+    screen only changes between rounds, so checking it would abort every verified plan and escalate every tiered
+    round. Actions are verified when the recording verified any.
+    """
+
+    def __init__(self, event_bus: EventBus, session: RecordedSession, llm: ReplayLLM, interpreter: Interpreter):
+        self._screen_changes = session.session.get('screen_changes', [])
+        self._next_screen_change = 0
+        super().__init__(event_bus, llm=llm, interpreter=interpreter,
+                         verify_actions=any(check['step'] is not None for check in self._screen_changes))
+
+    def play_ding_on_completion(self):
+        pass  # The replay report goes to stdout, where the bell would end up
+
+    def _screen_changed(self, step_num: int, signature_before: bytes, step: Optional[dict[str, Any]] = None) -> bool:
+        if self._next_screen_change >= len(self._screen_changes):
+            self.llm.divergences.append(f'Screen change check {self._next_screen_change} (step {step_num}, after '
+                                        f'{step or "the plan"}) was not recorded')
+            changed = True  # Like a check that can't tell, it mustn't abort the plan
+        else:
+            recorded = self._screen_changes[self._next_screen_change]
+            if (recorded['step_num'], recorded['step']) != (step_num, step):
+                self.llm.divergences.append(f"Screen change check {self._next_screen_change} was step "
+                                            f"{recorded['step_num']} after {recorded['step'] or 'the plan'}, "
+                                            f"replayed as step {step_num} after {step or 'the plan'}")
+            changed = recorded['changed']
+        self._next_screen_change += 1
+        self.event_bus.publish(ScreenChangeEvent(step_num, step, changed))
+        return changed
+
+    @property
+    def unreplayed_screen_changes(self) -> int:
+        return max(0, len(self._screen_changes) - self._next_screen_change)
+
+
+def replay_session(path: str, simulate_latency: bool = False) -> dict[str, Any]:
+    """
+    Runs a recorded request through Core again, with the recorded model responses and a virtual input backend, and
+    returns how the replay compared to the recording.
+
+    Steps run against the frame their round was sent, since frames taken in the middle of a plan aren't recorded.
+    Whether a step or a plan changed the screen is answered from the recording too (see ReplayCore), so aborted plans
+    and escalations to the large model happen where they did and tiered sessions replay the same rounds.
+    """
+    session = RecordedSession(path)
+    try:
+        event_bus = EventBus()
+        screen = ReplayScreen()
+        first_frame = next((call for recorded in session.rounds for call in recorded['calls'] if call.get('frame')),
+                           None)
+        screen_size = tuple(first_frame['capture_region'][2:]) if first_frame and first_frame.get('capture_region') \
+            else (1920, 1080)
+        input_backend = VirtualInputBackend(screen_size)
+        interpreter = Interpreter(event_bus, input_backend=input_backend, screen=screen, remember_click_targets=False)
+        llm = ReplayLLM(session, screen, simulate_latency)
+        core = ReplayCore(event_bus, session, llm, interpreter)
+
+        step_durations = []
+        event_bus.subscribe(lambda event: step_durations.append(event.duration), (StepEvent,))
+        start_time = time.monotonic()
+        result = core.execute(session.request)
+        duration = time.monotonic() - start_time
+
+        recorded_steps = session.session.get('steps', [])
+        if llm.replayed_rounds < len(session.rounds):
+            llm.divergences.append(f'{len(session.rounds) - llm.replayed_rounds} recorded rounds were not replayed')
+        if core.unreplayed_screen_changes:
+            llm.divergences.append(f'{core.unreplayed_screen_changes} recorded screen change checks were not replayed')
+        return {
+            'request': session.request,
+            'recorded_result': session.session.get('result'),
+            'result': result,
+            'recorded_duration': session.session.get('duration'),
+            'duration': duration,
+            'recorded_model_latency': sum(recorded['latency'] for recorded in session.rounds),
+            'recorded_step_time': sum(step['duration'] for step in recorded_steps),
+            'step_time': sum(step_durations),
+            'rounds': len(session.rounds),
+            'steps': len(step_durations),
+            'recorded_steps': len(recorded_steps),
+            'input': [f'{name}{args}{kwargs or ""}' for name, args, kwargs in input_backend.calls],
+            'divergences': llm.divergences,
+        }
+    finally:
+        session.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays a recorded session against a virtual input backend.')
+    parser.add_argument('recording', help='Path to a recording zip, see the record_sessions setting')
+    parser.add_argument('--simulate-latency', action='store_true', help='Wait as long as the model took to answer')
+    args = parser.parse_args()
+    print(json.dumps(replay_session(args.recording, args.simulate_latency), indent=2, default=str))
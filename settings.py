@@ -1,72 +1,122 @@
 import base64
 import json
 import os
+import tempfile
 from pathlib import Path
 import logging
 import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-class Settings:
-    def __init__(self):
-        self.settings_file_path = os.path.join(self.get_settings_directory_path(), 'settings.json')
-        os.makedirs(os.path.dirname(self.settings_file_path), exist_ok=True)
-        self.settings = self.load_settings_from_file()
-        self._settings_change_event = threading.Event()
 
-    def get_settings_directory_path(self) -> str:
-        return str(Path.home()) + '/.open-interface/'
+@dataclass(frozen=True)
+class SettingsChange:
+    """Published to settings subscribers whenever stored settings change."""
+    changed_keys: frozenset[str]
+    settings: dict[str, Any] = field(hash=False)
 
-    def get_dict(self) -> dict[str, str]:
-        return self.settings
+    def affects(self, keys) -> bool:
+        return not self.changed_keys.isdisjoint(keys)
 
-    def save_settings_to_file(self, settings_dict: dict[str, str]) -> None:
-        logging.info(f"Saving settings to file: {self.settings_file_path}")
+
+class SettingsStore:
+    """
+    Process-wide cache of settings.json.
+
+    The file is parsed (and the API key decoded) once, and only parsed again when its modification time, size or inode
+    changes, so constructing Settings() or calling get_dict() on a hot path costs a stat() call. Writes go to a
+    temporary file that is renamed over settings.json, so no reader, in this process or another one, ever sees a
+    half-written file.
+
+    Subscribers are called with a SettingsChange listing the changed keys, whether the change was saved from this
+    process or picked up from the file. They run on the thread that saved or noticed the change, so they should hand
+    slow work off to another thread.
+    """
+
+    def __init__(self, settings_file_path: str):
+        self.settings_file_path = settings_file_path
+        os.makedirs(os.path.dirname(self.settings_file_path), exist_ok=True)
+        self._lock = threading.RLock()
+        self._settings: dict[str, str] = {}
+        self._file_signature: Optional[tuple[int, int, int]] = None
+        self._loaded = False
+        self._subscribers: list[Callable[[SettingsChange], None]] = []
+
+    def _get_file_signature(self) -> Optional[tuple[int, int, int]]:
         try:
-            settings: dict[str, str] = {}
+            stat = os.stat(self.settings_file_path)
+            return stat.st_mtime_ns, stat.st_size, stat.st_ino
+        except FileNotFoundError:
+            return None
 
-            # Preserve previous settings in case new dict doesn't contain them
-            if os.path.exists(self.settings_file_path):
-                with open(self.settings_file_path, 'r') as file:
-                    try:
-                        settings = json.load(file)
-                    except json.JSONDecodeError:
-                         logging.warning(f"Settings file is empty or not valid JSON, ignoring existing settings.")
-                         settings = {}
-                    except Exception as e:
-                         logging.error(f"Unexpected error while reading settings file: {e}")
-                         settings = {}
+    def subscribe(self, callback: Callable[[SettingsChange], None]) -> None:
+        with self._lock:
+            self._subscribers.append(callback)
 
+    def unsubscribe(self, callback: Callable[[SettingsChange], None]) -> None:
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
 
-            updated_settings = False
+    def get_dict(self) -> dict[str, str]:
+        settings, change = self._refresh()
+        self._publish(change)
+        return settings
+
+    def update(self, settings_dict: dict[str, str]) -> bool:
+        """Merges settings_dict into the stored settings and writes them atomically. Returns whether anything changed."""
+        with self._lock:
+            settings, external_change = self._refresh()
+            previous_settings = dict(settings)
             for setting_name, setting_val in settings_dict.items():
                 if setting_val is not None:
-                    if setting_name == "api_key":
-                        encoded_api_key = base64.b64encode(setting_val.encode()).decode()
-                        if settings.get(setting_name) != encoded_api_key:
-                            settings[setting_name] = encoded_api_key
-                            updated_settings = True
-                    elif settings.get(setting_name) != setting_val:
-                        settings[setting_name] = setting_val
-                        updated_settings = True
-
-
-            if updated_settings:
-              with open(self.settings_file_path, 'w+') as file:
-                   json.dump(settings, file, indent=4)
-              logging.info(f'Settings saved correctly.')
-              self._settings_change_event.set() # set event
-              self._settings_change_event.clear() # clear event for next update.
-            else:
-              logging.info(f'No settings changed, skipping saving.')
-
-
-        except Exception as e:
-             logging.error(f"Error saving settings to file: {e}")
-             raise
+                    settings[setting_name] = setting_val
+
+            change = self._diff(previous_settings, settings)
+            if change:
+                self._write_file(settings)
+                self._settings = settings
+                self._file_signature = self._get_file_signature()
+
+        self._publish(external_change)
+        self._publish(change)
+        return change is not None
+
+    def _refresh(self) -> tuple[dict[str, str], Optional[SettingsChange]]:
+        """Re-reads the file if it changed since it was last read. Returns a copy of the settings and the change."""
+        signature = self._get_file_signature()
+        with self._lock:
+            change = None
+            if not self._loaded or signature != self._file_signature:
+                settings = self._read_file()
+                if self._loaded:
+                    change = self._diff(self._settings, settings)
+                self._settings = settings
+                self._file_signature = signature
+                self._loaded = True
+            return dict(self._settings), change
+
+    @staticmethod
+    def _diff(old: dict[str, Any], new: dict[str, Any]) -> Optional[SettingsChange]:
+        changed_keys = frozenset(key for key in old.keys() | new.keys() if old.get(key) != new.get(key))
+        return SettingsChange(changed_keys, dict(new)) if changed_keys else None
+
+    def _publish(self, change: Optional[SettingsChange]) -> None:
+        if not change:
+            return
+        logging.info(f'Settings changed: {sorted(change.changed_keys)}')
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(change)
+            except Exception as e:
+                logging.error(f'Error in settings change subscriber {callback}: {e}')
 
-    def load_settings_from_file(self) -> dict[str, str]:
+    def _read_file(self) -> dict[str, str]:
          logging.info(f'Loading settings from file: {self.settings_file_path}')
          settings = {}
          if os.path.exists(self.settings_file_path):
@@ -87,19 +137,102 @@ class Settings:
             except Exception as e:
                  logging.error(f"Unexpected error while reading settings file: {e}")
                  return {}
-            logging.info(f'Settings loaded correctly: {settings}')
+            logging.info(f'Settings loaded correctly: {sorted(settings.keys())}')
          else:
              logging.info(f"Settings file not found, returning empty settings")
 
          return settings
+
+    def _write_file(self, settings: dict[str, str]) -> None:
+        settings_to_write = dict(settings)
+        if settings_to_write.get('api_key'):
+            settings_to_write['api_key'] = base64.b64encode(settings_to_write['api_key'].encode()).decode()
+
+        directory = os.path.dirname(self.settings_file_path)
+        fd, temp_path = tempfile.mkstemp(prefix='.settings-', suffix='.json', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(settings_to_write, file, indent=4)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.settings_file_path)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+
+
+_store: Optional[SettingsStore] = None
+_store_lock = threading.Lock()
+_data_directory_path: Optional[str] = None
+
+
+def get_settings_directory_path() -> str:
+    return str(Path.home()) + '/.open-interface/'
+
+
+def get_data_directory_path() -> str:
+    """Where this process keeps screenshots, templates and recordings, the settings directory unless it was set."""
+    return _data_directory_path or get_settings_directory_path()
+
+
+def set_data_directory_path(path: str) -> None:
+    """Keeps this process's files apart from other processes' that share the settings, e.g. worker pool workers."""
+    global _data_directory_path
+    os.makedirs(path, exist_ok=True)
+    _data_directory_path = path
+
+
+def get_settings_store() -> SettingsStore:
+    """The SettingsStore shared by every Settings instance in this process."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SettingsStore(os.path.join(get_settings_directory_path(), 'settings.json'))
+        return _store
+
+
+class Settings:
+    def __init__(self):
+        self._store = get_settings_store()
+        self.settings_file_path = self._store.settings_file_path
+
+    @property
+    def settings(self) -> dict[str, str]:
+        return self._store.get_dict()
+
+    def get_settings_directory_path(self) -> str:
+        return get_settings_directory_path()
+
+    def get_data_directory_path(self) -> str:
+        return get_data_directory_path()
+
+    def get_dict(self) -> dict[str, str]:
+        return self._store.get_dict()
+
+    def save_settings_to_file(self, settings_dict: dict[str, str]) -> None:
+        logging.info(f"Saving settings to file: {self.settings_file_path}")
+        try:
+            if self._store.update(settings_dict):
+              logging.info(f'Settings saved correctly.')
+            else:
+              logging.info(f'No settings changed, skipping saving.')
+        except Exception as e:
+             logging.error(f"Error saving settings to file: {e}")
+             raise
+
+    def load_settings_from_file(self) -> dict[str, str]:
+         return self._store.get_dict()
+
     def notify_settings_changed(self):
-         """Notifies all the threads that the settings have been changed."""
-         self._settings_change_event.set()
-         self._settings_change_event.clear()
-    def wait_for_settings_change(self):
-        """Waits for a settings change event and loads the settings in a separate thread"""
-        def wait_and_load():
-           self._settings_change_event.wait()
-           self.settings = self.load_settings_from_file()
-
-        threading.Thread(target=wait_and_load, daemon=True).start()
\ No newline at end of file
+         """Picks up changes made to settings.json outside of save_settings_to_file and notifies subscribers."""
+         self._store.get_dict()
+
+    def subscribe(self, callback: Callable[[SettingsChange], None]) -> None:
+        """Calls callback with a SettingsChange every time settings change anywhere in the process."""
+        self._store.subscribe(callback)
+
+    def unsubscribe(self, callback: Callable[[SettingsChange], None]) -> None:
+        self._store.unsubscribe(callback)
@@ -0,0 +1,109 @@
+"""
+Startup profiling mode.
+
+Run the app with `--profile-startup` (or OPEN_INTERFACE_PROFILE_STARTUP=1) to log how long every module import and
+every named initialization step took, plus when the window became interactive. Only uses the standard library so
+that it can be enabled before any of the heavy imports happen.
+"""
+import builtins
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+PROFILE_FLAG = '--profile-startup'
+PROFILE_ENV_VAR = 'OPEN_INTERFACE_PROFILE_STARTUP'
+
+_enabled = False
+_process_start = time.perf_counter()
+_original_import = builtins.__import__
+_import_lock = threading.Lock()
+_import_stack: list[list] = []  # [module_name, start_time, time_spent_in_child_imports]
+_import_times: dict[str, tuple[float, float]] = {}  # module_name -> (self_time, total_time)
+_section_times: list[tuple[str, float]] = []
+
+
+def is_requested() -> bool:
+    return PROFILE_FLAG in sys.argv or bool(os.environ.get(PROFILE_ENV_VAR))
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def enable_if_requested() -> None:
+    if is_requested():
+        enable()
+
+
+def enable() -> None:
+    """Starts timing every first-time import made from the main thread."""
+    global _enabled
+    if _enabled:
+        return
+    _enabled = True
+    builtins.__import__ = _timed_import
+    logging.info('Startup profiling enabled')
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    # Only time imports that actually load something, and only on the main thread so the stack stays consistent.
+    if level != 0 or name in sys.modules or threading.current_thread() is not threading.main_thread():
+        return _original_import(name, globals, locals, fromlist, level)
+
+    frame = [name, time.perf_counter(), 0.0]
+    _import_stack.append(frame)
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _import_stack.pop()
+        total = time.perf_counter() - frame[1]
+        with _import_lock:
+            _import_times[name] = (total - frame[2], total)
+        if _import_stack:
+            _import_stack[-1][2] += total
+
+
+@contextmanager
+def section(name: str):
+    """Times a named initialization step. Does nothing unless profiling is enabled."""
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def record(name: str, seconds: float) -> None:
+    if _enabled:
+        with _import_lock:
+            _section_times.append((name, seconds))
+
+
+def mark(name: str) -> None:
+    """Records a milestone measured from process start, e.g. 'window interactive'."""
+    record(name, time.perf_counter() - _process_start)
+
+
+def report(top_n: int = 25) -> None:
+    if not _enabled:
+        return
+    with _import_lock:
+        imports = sorted(_import_times.items(), key=lambda item: item[1][0], reverse=True)
+        sections = list(_section_times)
+
+    lines = ['Startup profile', f'  {"module":<40} {"self ms":>10} {"total ms":>10}']
+    for module_name, (self_time, total_time) in imports[:top_n]:
+        lines.append(f'  {module_name:<40} {self_time * 1000:>10.1f} {total_time * 1000:>10.1f}')
+    lines.append(f'  {"step":<40} {"ms":>10}')
+    for name, seconds in sections:
+        lines.append(f'  {name:<40} {seconds * 1000:>10.1f}')
+    logging.info('\n'.join(lines))
@@ -0,0 +1,278 @@
+import ctypes
+import hashlib
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Any, Optional
+
+import psutil
+from PIL import Image
+
+from settings import Settings
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+DEFAULT_TEMPLATE_HALF_SIZE = (32, 20)  # Crop around a click without a known box, in frame pixels
+TEMPLATE_PADDING = 6  # Context kept around a known box, so plain labels still have an outline to match
+MIN_TEMPLATE_CONTRAST = 8.0  # Flat crops (empty background) would match anywhere
+MATCH_THRESHOLD = 0.9
+SEARCH_MARGIN = 2  # Template sizes around the last known position searched before the whole frame
+MATCH_SCALES = (1.0, 0.9, 1.1, 0.8, 1.25)
+MAX_TEMPLATES_PER_APP = 200
+UNKNOWN_APPLICATION = 'desktop'
+
+
+def get_foreground_application() -> str:
+    """Process name of the application with the focused window, best effort, UNKNOWN_APPLICATION if it can't be told."""
+    try:
+        pid = None
+        system = platform.system()
+        if system == 'Windows':
+            hwnd = ctypes.windll.user32.GetForegroundWindow()
+            process_id = ctypes.c_ulong()
+            ctypes.windll.user32.GetWindowThreadProcessId(hwnd, ctypes.byref(process_id))
+            pid = process_id.value
+        elif system == 'Darwin':
+            output = subprocess.run(['osascript', '-e', 'tell application "System Events" to get unix id of first '
+                                     'process whose frontmost is true'], capture_output=True, text=True, timeout=1)
+            pid = int(output.stdout.strip())
+        elif shutil.which('xdotool'):
+            output = subprocess.run(['xdotool', 'getactivewindow', 'getwindowpid'], capture_output=True, text=True,
+                                    timeout=1)
+            pid = int(output.stdout.strip())
+        if pid:
+            return os.path.splitext(psutil.Process(pid).name())[0].lower()
+    except Exception as e:
+        logging.debug(f'Could not tell the foreground application: {e}')
+    return UNKNOWN_APPLICATION
+
+
+def _normalize_label(label: str) -> str:
+    return ' '.join(label.casefold().split())
+
+
+class TemplateCache:
+    """
+    Small crops of UI elements that were clicked successfully, keyed by application and label, so later runs can find
+    the same toolbar button or menu item again by template matching instead of asking the model for coordinates.
+
+    Templates live under templates/ in the data directory, with an index.json of where each was last seen.
+    Matching uses OpenCV's normalized cross-correlation (imported lazily), first in a small window around the last
+    known position, which is where the element almost always still is and takes a few milliseconds, then over the
+    whole frame at a few scales in case the window moved or the UI was zoomed.
+    """
+
+    _lock = threading.RLock()
+
+    def __init__(self):
+        self.directory = os.path.join(Settings().get_data_directory_path(), 'templates')
+        self.index_path = os.path.join(self.directory, 'index.json')
+        self._index: Optional[dict[str, dict[str, dict[str, Any]]]] = None
+        self._templates: dict[str, Any] = {}  # file name -> grayscale numpy array
+        self._application: Optional[str] = None
+
+    def start_round(self) -> Optional[str]:
+        """
+        Looks up the foreground application once for a round's labels and clicks, and returns it. Returns None
+        without looking, which takes a subprocess on Linux and macOS, while no template has been saved.
+        """
+        with self._lock:
+            has_templates = any(self._load_index().values())
+        self._application = get_foreground_application() if has_templates else None
+        return self._application
+
+    def get_application(self) -> str:
+        """The foreground application as of start_round, looked up now if it wasn't then or was forgotten since."""
+        application = self._application
+        if application is None:
+            application = self._application = get_foreground_application()
+        return application
+
+    def forget_application(self) -> None:
+        """For after a step that likely changed the foreground application, e.g. opening one."""
+        self._application = None
+
+    def _load_index(self) -> dict[str, dict[str, dict[str, Any]]]:
+        if self._index is None:
+            try:
+                with open(self.index_path) as index_file:
+                    self._index = json.load(index_file)
+            except FileNotFoundError:
+                self._index = {}
+            except (OSError, ValueError) as e:
+                logging.error(f'Error reading the template index, starting a new one: {e}')
+                self._index = {}
+        return self._index
+
+    def _save_index(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        # A temporary file of its own, so concurrent saves (another process) never write into each other's.
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, prefix='index-', suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'w') as index_file:
+                json.dump(self._index, index_file)
+            os.replace(temp_path, self.index_path)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+
+    def get_labels(self, app: str) -> list[str]:
+        """Labels with a saved template for app, most used first."""
+        with self._lock:
+            entries = self._load_index().get(app, {})
+            return sorted(entries, key=lambda label: -entries[label].get('hits', 0))
+
+    def save(self, app: str, label: str, frame: Image.Image, point: tuple[float, float],
+             box: Optional[list[float]] = None) -> bool:
+        """
+        Saves the crop around a clicked point, or around box when the element's bounds are known, in frame pixels.
+        :return: False if the crop has too little detail to be found again reliably.
+        """
+        label = _normalize_label(label)
+        if not label:
+            return False
+        if box:
+            left, top = box[0] - TEMPLATE_PADDING, box[1] - TEMPLATE_PADDING
+            right, bottom = box[0] + box[2] + TEMPLATE_PADDING, box[1] + box[3] + TEMPLATE_PADDING
+        else:
+            half_width, half_height = DEFAULT_TEMPLATE_HALF_SIZE
+            left, top, right, bottom = point[0] - half_width, point[1] - half_height, point[0] + half_width, \
+                point[1] + half_height
+        left, top = max(0, round(left)), max(0, round(top))
+        right, bottom = min(frame.width, round(right)), min(frame.height, round(bottom))
+        if right - left < 8 or bottom - top < 8:
+            return False
+
+        crop = frame.crop((left, top, right, bottom)).convert('L')
+        contrast = _standard_deviation(crop)
+        if contrast < MIN_TEMPLATE_CONTRAST:
+            logging.info(f'Not saving a template for {label!r}, the crop is almost flat ({contrast:.1f})')
+            return False
+
+        # Named by a hash, labels that differ only in characters a file name can't have still get files of their own.
+        file_name = hashlib.blake2b(json.dumps([app, label]).encode(), digest_size=16).hexdigest() + '.png'
+        with self._lock:
+            index = self._load_index()
+            os.makedirs(self.directory, exist_ok=True)
+            crop.save(os.path.join(self.directory, file_name))
+            self._templates.pop(file_name, None)
+            entries = index.setdefault(app, {})
+            hits = entries.get(label, {}).get('hits', 0)
+            entries[label] = {
+                'file': file_name,
+                # Where the click landed inside the crop, which isn't the center when the crop hit a frame edge.
+                'offset': [point[0] - left, point[1] - top],
+                'position': [left, top],
+                'hits': hits,
+                'saved_at': time.time(),
+            }
+            if len(entries) > MAX_TEMPLATES_PER_APP:
+                least_used = min(entries, key=lambda name: (entries[name].get('hits', 0), entries[name]['saved_at']))
+                self._remove(entries, least_used)
+            self._save_index()
+        logging.info(f'Saved template for {label!r} in {app}')
+        return True
+
+    def _remove(self, entries: dict[str, dict[str, Any]], label: str) -> None:
+        file_name = entries.pop(label)['file']
+        self._templates.pop(file_name, None)
+        try:
+            os.remove(os.path.join(self.directory, file_name))
+        except OSError:
+            pass
+
+    def locate(self, app: str, label: str, frame: Image.Image) -> Optional[tuple[float, float]]:
+        """Frame pixel coordinates to click for label in app, or None if it has no template or isn't on screen."""
+        import cv2
+        import numpy as np
+
+        label = _normalize_label(label)
+        with self._lock:
+            entry = self._load_index().get(app, {}).get(label)
+            if entry is None:
+                return None
+            template = self._templates.get(entry['file'])
+            if template is None:
+                try:
+                    template = np.asarray(Image.open(os.path.join(self.directory, entry['file'])).convert('L'))
+                except OSError as e:
+                    logging.error(f"Error reading template {entry['file']}: {e}")
+                    return None
+                self._templates[entry['file']] = template
+
+        start_time = time.monotonic()
+        gray_frame = np.asarray(frame.convert('L'))
+        template_height, template_width = template.shape
+        left, top = entry['position']
+
+        # Where it was last time, at the same scale
+        region_left = max(0, left - SEARCH_MARGIN * template_width)
+        region_top = max(0, top - SEARCH_MARGIN * template_height)
+        region = gray_frame[region_top:top + (SEARCH_MARGIN + 1) * template_height,
+                            region_left:left + (SEARCH_MARGIN + 1) * template_width]
+        match = _best_match(cv2, region, template)
+        if match and match[0] >= MATCH_THRESHOLD:
+            score, (x, y), scale = match[0], (match[1][0] + region_left, match[1][1] + region_top), 1.0
+        else:
+            match = None
+            for scale in MATCH_SCALES:
+                scaled = template if scale == 1.0 else cv2.resize(template, None, fx=scale, fy=scale,
+                                                                  interpolation=cv2.INTER_AREA)
+                candidate = _best_match(cv2, gray_frame, scaled)
+                if candidate and (match is None or candidate[0] > match[0]):
+                    match = (candidate[0], candidate[1], scale)
+                    if candidate[0] >= MATCH_THRESHOLD:
+                        break
+            if match is None or match[0] < MATCH_THRESHOLD:
+                best_score = match[0] if match else 0.0
+                logging.info(f'Template for {label!r} not found (best match {best_score:.2f}) in '
+                             f'{(time.monotonic() - start_time) * 1000:.0f}ms')
+                return None
+            score, (x, y), scale = match
+
+        with self._lock:
+            entry['position'] = [int(x), int(y)]
+            entry['hits'] = entry.get('hits', 0) + 1
+            self._save_index()
+        logging.info(f'Found template for {label!r} at ({x}, {y}), match {score:.2f} at scale {scale}, in '
+                     f'{(time.monotonic() - start_time) * 1000:.0f}ms')
+        return x + entry['offset'][0] * scale, y + entry['offset'][1] * scale
+
+
+_template_cache: Optional[TemplateCache] = None
+_template_cache_lock = threading.Lock()
+
+
+def get_template_cache() -> TemplateCache:
+    """The TemplateCache shared by everything in this process, so the index is read once."""
+    global _template_cache
+    with _template_cache_lock:
+        if _template_cache is None:
+            _template_cache = TemplateCache()
+        return _template_cache
+
+
+def _best_match(cv2, image, template) -> Optional[tuple[float, tuple[int, int]]]:
+    """(score, top left corner) of the best match of template in image, None if it doesn't fit."""
+    if image.shape[0] < template.shape[0] or image.shape[1] < template.shape[1]:
+        return None
+    result = cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED)
+    _, score, _, location = cv2.minMaxLoc(result)
+    return score, location
+
+
+def _standard_deviation(image: Image.Image) -> float:
+    histogram = image.histogram()
+    count = sum(histogram)
+    mean = sum(value * n for value, n in enumerate(histogram)) / count
+    return (sum(n * (value - mean) ** 2 for value, n in enumerate(histogram)) / count) ** 0.5
@@ -0,0 +1,94 @@
+import importlib.util
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+if importlib.util.find_spec('pyatspi') is None or importlib.util.find_spec('gi') is None:
+    pytest.skip('needs pyatspi and PyGObject', allow_module_level=True)
+if not shutil.which('Xvfb') or not shutil.which('dbus-daemon'):
+    pytest.skip('needs Xvfb and dbus-daemon', allow_module_level=True)
+
+from worker_pool import VirtualDisplay
+
+SCREEN_SIZE = (1280, 800)
+SNAPSHOT_TIMEOUT = 15  # seconds for the window to appear in the accessibility tree
+
+# Tk doesn't implement AT-SPI, so the window under test is a GTK one.
+WINDOW_APP = '''
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gdk, Gtk
+
+window = Gtk.Window(title='Accessibility test')
+box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=8)
+box.pack_start(Gtk.Button(label='Save'), False, False, 0)
+entry = Gtk.Entry()
+entry.set_text('hello')
+box.pack_start(entry, False, False, 0)
+window.add(box)
+window.set_default_size(300, 120)
+window.connect('destroy', Gtk.main_quit)
+# There is no window manager on the virtual display to make the window active
+window.connect('map-event', lambda widget, event: widget.get_window().focus(Gdk.CURRENT_TIME))
+window.show_all()
+Gtk.main()
+'''
+
+
+@pytest.fixture(scope='module')
+def window():
+    """A GTK window on its own Xvfb display and accessibility bus."""
+    environ = dict(os.environ)
+    display = VirtualDisplay(f'{SCREEN_SIZE[0]}x{SCREEN_SIZE[1]}x24')
+    os.environ['DISPLAY'] = display.start()
+    bus = subprocess.run(['dbus-daemon', '--session', '--fork', '--print-address=1', '--print-pid=1'],
+                         capture_output=True, text=True, check=True)
+    address, pid = bus.stdout.split()[:2]
+    os.environ['DBUS_SESSION_BUS_ADDRESS'] = address
+    os.environ.pop('NO_AT_BRIDGE', None)
+    app = subprocess.Popen([sys.executable, '-c', WINDOW_APP])
+    try:
+        yield app
+    finally:
+        app.terminate()
+        app.wait()
+        os.kill(int(pid), signal.SIGTERM)
+        display.stop()
+        os.environ.clear()
+        os.environ.update(environ)
+
+
+def take_snapshot():
+    from screen import AccessibilityObserver  # pyautogui connects to $DISPLAY when it's imported
+
+    deadline = time.monotonic() + SNAPSHOT_TIMEOUT
+    while True:
+        elements = AccessibilityObserver().snapshot()
+        if elements or time.monotonic() >= deadline:
+            return elements
+        time.sleep(0.5)
+
+
+def test_snapshot_describes_the_focused_window(window):
+    from screen import AccessibilityObserver
+
+    elements = take_snapshot()
+    assert elements, 'the window never showed up in the accessibility tree'
+    by_role_and_name = {(element['role'], element['name']): element for element in elements}
+    assert ('frame', 'Accessibility test') in by_role_and_name
+
+    button = by_role_and_name[('push button', 'Save')]
+    left, top, width, height = button['box']
+    assert width > 0 and height > 0
+    assert 0 <= left and left + width <= SCREEN_SIZE[0] and 0 <= top and top + height <= SCREEN_SIZE[1]
+
+    entries = [element for element in elements if element['role'] == 'text']
+    assert [entry['text'] for entry in entries] == ['hello']
+
+    assert [element['id'] for element in elements] == list(range(1, len(elements) + 1))
+    assert AccessibilityObserver.get_element(button['id']) == button
@@ -0,0 +1,109 @@
+import builtins
+import os
+
+import pytest
+
+from message_store import MessageStore
+
+
+def ids(messages: list) -> list[int]:
+    return [message['id'] for message in messages]
+
+
+@pytest.fixture
+def store(tmp_path):
+    # Messages 1-7 are spilled to segments of two, 8-10 are in memory.
+    store = MessageStore(capacity=3, segment_size=2, spill_directory=str(tmp_path / 'spill'))
+    for number in range(1, 11):
+        store.append('user' if number % 2 else 'assistant', f'message {number}')
+    yield store
+    store.close()
+
+
+def test_messages_get_contiguous_ids(store):
+    assert store.last_id == 10
+    assert ids(store.recent(10)) == [8, 9, 10]
+    assert store.recent(2) == [{'id': 9, 'kind': 'user', 'text': 'message 9'},
+                               {'id': 10, 'kind': 'assistant', 'text': 'message 10'}]
+
+
+def test_spilled_messages_are_read_back(store):
+    assert sorted(os.listdir(store._spill_directory)) == [f'segment_{segment:06d}.jsonl' for segment in range(4)]
+    assert store.since(0) == [{'id': number, 'kind': 'user' if number % 2 else 'assistant', 'text': f'message {number}'}
+                              for number in range(1, 11)]
+
+
+@pytest.mark.parametrize('since_id, limit, expected', [
+    (0, None, list(range(1, 11))),
+    (0, 3, [1, 2, 3]),
+    (2, 5, [3, 4, 5, 6, 7]),  # All spilled, across segments
+    (5, 4, [6, 7, 8, 9]),  # Across the memory/spill boundary
+    (7, None, [8, 9, 10]),  # All in memory
+    (9, 5, [10]),
+    (10, None, []),
+    (12, None, []),
+])
+def test_since(store, since_id, limit, expected):
+    assert ids(store.since(since_id, limit)) == expected
+
+
+@pytest.mark.parametrize('before_id, limit, expected', [
+    (11, 3, [8, 9, 10]),
+    (10, 4, [6, 7, 8, 9]),  # Across the memory/spill boundary
+    (8, 2, [6, 7]),
+    (5, 10, [1, 2, 3, 4]),
+    (2, 1, [1]),
+    (1, 5, []),
+    (100, 2, [9, 10]),
+])
+def test_before(store, before_id, limit, expected):
+    assert ids(store.before(before_id, limit)) == expected
+
+
+def test_paging_back_through_the_whole_history(store):
+    pages = []
+    page = store.recent(3)
+    while page:
+        pages.append(ids(page))
+        page = store.before(page[0]['id'], 3)
+    assert pages == [[8, 9, 10], [5, 6, 7], [2, 3, 4], [1]]
+
+
+def test_close_deletes_the_spilled_history_it_created():
+    store = MessageStore(capacity=1)
+    store.append('user', 'first')
+    store.append('user', 'second')
+    spill_directory = store._spill_directory
+    assert os.path.isdir(spill_directory)
+    store.close()
+    assert not os.path.exists(spill_directory)
+
+
+def test_failed_spill_keeps_what_was_spilled_before_and_stops(tmp_path, monkeypatch):
+    store = MessageStore(capacity=2, segment_size=2, spill_directory=str(tmp_path))
+    for number in range(1, 5):
+        store.append('user', f'message {number}')  # 1 and 2 spill
+
+    def fail_once(*args, **kwargs):
+        monkeypatch.undo()
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(builtins, 'open', fail_once)
+    store.append('user', 'message 5')  # 3 fails to spill
+    for number in range(6, 9):
+        store.append('user', f'message {number}')  # 4-6 would land on the wrong lines, they aren't spilled
+
+    assert ids(store.since(0)) == [1, 2, 7, 8]
+    assert ids(store.before(7, 10)) == [1, 2]
+    assert ids(store.since(2, 5)) == [7]
+    assert [message['text'] for message in store.since(0)] == ['message 1', 'message 2', 'message 7', 'message 8']
+
+
+def test_unusable_spill_directory_keeps_the_newest_messages(tmp_path):
+    not_a_directory = tmp_path / 'file'
+    not_a_directory.write_text('')
+    store = MessageStore(capacity=2, spill_directory=str(not_a_directory))
+    for number in range(1, 6):
+        store.append('user', f'message {number}')
+    assert ids(store.since(0)) == [4, 5]
+    assert store.before(4, 10) == []
@@ -0,0 +1,162 @@
+import threading
+import time
+
+import pytest
+
+from hedging import RequestCancelled
+from models.rate_limiter import (BACKGROUND_PRIORITY, INTERACTIVE_PRIORITY, RateLimiter, request_cancel_event,
+                                 request_priority)
+
+WAIT_TIMEOUT = 5  # seconds, only reached when a test fails
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def start_acquire(rate_limiter: RateLimiter, results: list, name: str, **kwargs) -> threading.Thread:
+    """Calls acquire on a thread of its own and waits until it's queued, appending name to results once it gets through
+    or the exception if it fails."""
+    waiting = len(rate_limiter._waiters)
+
+    def acquire():
+        try:
+            rate_limiter.acquire(**kwargs)
+            results.append(name)
+        except Exception as e:
+            results.append(e)
+
+    thread = threading.Thread(target=acquire, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while len(rate_limiter._waiters) == waiting and thread.is_alive():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    return thread
+
+
+def wait_for(results: list, count: int) -> None:
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while len(results) < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_requests_within_the_limits_go_straight_through():
+    rate_limiter = RateLimiter(3, 1000, clock=FakeClock())
+    for _ in range(3):
+        rate_limiter.acquire(300)
+    assert rate_limiter._waiters == []
+
+
+def test_zero_disables_a_bucket():
+    rate_limiter = RateLimiter(0, 0, clock=FakeClock())
+    for _ in range(1000):
+        rate_limiter.acquire(100000)
+    rate_limiter = RateLimiter(1000, 0, clock=FakeClock())
+    rate_limiter.acquire(10 ** 9)
+    rate_limiter = RateLimiter(0, 100, clock=FakeClock())
+    for _ in range(1000):
+        rate_limiter.acquire(0)
+
+
+def test_the_buckets_refill_over_time():
+    clock = FakeClock()
+    rate_limiter = RateLimiter(60, 0, clock=clock)
+    for _ in range(60):
+        rate_limiter.acquire()
+    results = []
+    start_acquire(rate_limiter, results, 'late')
+    assert results == []
+    clock.now += 1  # One request per second
+    rate_limiter.configure(60, 0)  # Wakes the waiter up, the real wait is a second
+    wait_for(results, 1)
+    assert results == ['late']
+
+
+def test_waiting_requests_are_served_by_priority_then_in_arrival_order():
+    clock = FakeClock()
+    rate_limiter = RateLimiter(1, 0, clock=clock)
+    rate_limiter.acquire()
+    results = []
+    start_acquire(rate_limiter, results, 'background', priority=BACKGROUND_PRIORITY)
+    start_acquire(rate_limiter, results, 'first interactive', priority=INTERACTIVE_PRIORITY)
+    with request_priority(INTERACTIVE_PRIORITY):
+        start_acquire(rate_limiter, results, 'second interactive')
+
+    for served in range(1, 4):
+        clock.now += 60
+        rate_limiter.configure(1, 0)
+        wait_for(results, served)
+    assert results == ['first interactive', 'second interactive', 'background']
+
+
+def test_raising_the_limits_lets_waiting_requests_through_straight_away():
+    rate_limiter = RateLimiter(1, 0, clock=FakeClock())
+    rate_limiter.acquire()
+    results = []
+    start_acquire(rate_limiter, results, 'waiting')
+    rate_limiter.configure(0, 0)
+    wait_for(results, 1)
+    assert results == ['waiting']
+
+
+def test_lowering_the_token_limit_holds_requests_back():
+    clock = FakeClock()
+    rate_limiter = RateLimiter(0, 1000, clock=clock)
+    rate_limiter.acquire(1000)
+    rate_limiter.configure(0, 100)
+    results = []
+    start_acquire(rate_limiter, results, 'held', tokens=100)
+    clock.now += 6  # Enough at the old limit
+    rate_limiter.configure(0, 100)
+    time.sleep(0.1)
+    assert results == []
+    clock.now += 54
+    rate_limiter.configure(0, 100)
+    wait_for(results, 1)
+    assert results == ['held']
+
+
+def test_cancelling_stops_the_wait():
+    rate_limiter = RateLimiter(1, 0, clock=FakeClock())
+    rate_limiter.acquire()
+    cancel_event = threading.Event()
+    results = []
+    start_acquire(rate_limiter, results, 'cancelled', cancel_event=cancel_event)
+    cancel_event.set()
+    wait_for(results, 1)
+    assert isinstance(results[0], RequestCancelled)
+    assert rate_limiter._waiters == []
+
+
+def test_cancel_event_set_for_the_block():
+    rate_limiter = RateLimiter(1, 0, clock=FakeClock())
+    rate_limiter.acquire()
+    cancel_event = threading.Event()
+    cancel_event.set()
+    with request_cancel_event(cancel_event):
+        with pytest.raises(RequestCancelled):
+            rate_limiter.acquire()
+    assert rate_limiter._waiters == []
+
+
+def test_a_cancelled_request_doesnt_hold_up_the_ones_behind_it():
+    clock = FakeClock()
+    rate_limiter = RateLimiter(1, 0, clock=clock)
+    rate_limiter.acquire()
+    cancel_event = threading.Event()
+    results = []
+    start_acquire(rate_limiter, results, 'cancelled', cancel_event=cancel_event)
+    start_acquire(rate_limiter, results, 'next')
+    cancel_event.set()
+    wait_for(results, 1)
+    clock.now += 60
+    rate_limiter.configure(1, 0)
+    wait_for(results, 2)
+    assert isinstance(results[0], RequestCancelled)
+    assert results[1] == 'next'
@@ -0,0 +1,251 @@
+import email.utils
+import random
+import threading
+import time
+
+import pytest
+
+httpx = pytest.importorskip('httpx')
+openai = pytest.importorskip('openai')
+
+from hedging import RequestCancelled
+from retry_policy import (AUTH_ERROR, BAD_REQUEST, CANCELLED, CONNECTION_ERROR, MALFORMED_OUTPUT, RATE_LIMITED,
+                          SERVER_ERROR, TIMEOUT, UNKNOWN_ERROR, CircuitBreaker, CircuitOpenError,
+                          MalformedResponseError, RetryPolicy, RunFailedError, classify_error, get_retry_after)
+
+URL = 'https://api.example.com/v1/threads/runs'
+
+
+def status_error(error_type, status_code: int, headers=None):
+    response = httpx.Response(status_code, headers=headers or {}, request=httpx.Request('POST', URL))
+    return error_type('error', response=response, body=None)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class Flaky:
+    """A call that raises errors, in order, and then returns 'ok'."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+@pytest.mark.parametrize('make_error, error_class', [
+    (lambda: status_error(openai.RateLimitError, 429), RATE_LIMITED),
+    (lambda: status_error(openai.InternalServerError, 500), SERVER_ERROR),
+    (lambda: status_error(openai.APIStatusError, 503), SERVER_ERROR),
+    (lambda: status_error(openai.APIStatusError, 408), TIMEOUT),
+    (lambda: status_error(openai.APIStatusError, 404), BAD_REQUEST),
+    (lambda: status_error(openai.BadRequestError, 400), BAD_REQUEST),
+    (lambda: status_error(openai.AuthenticationError, 401), AUTH_ERROR),
+    (lambda: status_error(openai.PermissionDeniedError, 403), AUTH_ERROR),
+    (lambda: openai.APITimeoutError(request=httpx.Request('POST', URL)), TIMEOUT),
+    (lambda: openai.APIConnectionError(request=httpx.Request('POST', URL)), CONNECTION_ERROR),
+    (lambda: RunFailedError('Failed run', 'rate_limit_exceeded'), RATE_LIMITED),
+    (lambda: RunFailedError('Failed run', 'server_error'), SERVER_ERROR),
+    (lambda: RunFailedError('Failed run', 'invalid_prompt'), BAD_REQUEST),
+    (lambda: RunFailedError('Expired run', 'expired'), TIMEOUT),
+    (lambda: RunFailedError('Failed run'), UNKNOWN_ERROR),
+    (lambda: MalformedResponseError('No steps'), MALFORMED_OUTPUT),
+    (lambda: RequestCancelled('Hedge won'), CANCELLED),
+    (lambda: TimeoutError(), TIMEOUT),
+    (lambda: ConnectionResetError(), CONNECTION_ERROR),
+    (lambda: TypeError('bad argument'), UNKNOWN_ERROR),
+])
+def test_classify_error(make_error, error_class):
+    assert classify_error(make_error()) == error_class
+
+
+def test_classify_error_keeps_a_known_class():
+    error = Exception('replayed')
+    error.error_class = SERVER_ERROR
+    assert classify_error(error) == SERVER_ERROR
+
+
+@pytest.mark.parametrize('error, retry_after', [
+    (status_error(openai.RateLimitError, 429, {'retry-after-ms': '1500', 'retry-after': '9'}), 1.5),
+    (status_error(openai.RateLimitError, 429, {'retry-after': '7'}), 7.0),
+    (RunFailedError('Rate limit reached for gpt-4o. Please try again in 6.5s.', 'rate_limit_exceeded'), 6.5),
+    (RunFailedError('Rate limit reached for gpt-4o. Please try again in 250ms.', 'rate_limit_exceeded'), 0.25),
+    (status_error(openai.RateLimitError, 429), None),
+    (status_error(openai.RateLimitError, 429, {'retry-after': 'soon'}), None),
+])
+def test_get_retry_after(error, retry_after):
+    assert get_retry_after(error) == retry_after
+
+
+def test_get_retry_after_http_date():
+    in_the_past = email.utils.formatdate(time.time() - 60, usegmt=True)
+    error = status_error(openai.RateLimitError, 429, {'retry-after': in_the_past})
+    assert get_retry_after(error) == 0.0
+    in_a_minute = email.utils.formatdate(time.time() + 60, usegmt=True)
+    error = status_error(openai.RateLimitError, 429, {'retry-after': in_a_minute})
+    assert get_retry_after(error) == pytest.approx(60.0, abs=2.0)
+
+
+def test_malformed_output_is_retried_right_away():
+    assert RetryPolicy(3, 20).get_delay(MALFORMED_OUTPUT, 2) == 0.0
+
+
+def test_rate_limits_wait_for_retry_after_plus_a_little_jitter():
+    policy = RetryPolicy(3, rate_limit_delay=20)
+    for _ in range(100):
+        assert 10.0 <= policy.get_delay(RATE_LIMITED, 0, retry_after=10.0) <= 11.0
+        assert 20.0 <= policy.get_delay(RATE_LIMITED, 0) <= 21.0
+
+
+def test_backoff_is_exponential_with_full_jitter():
+    random.seed(1)
+    policy = RetryPolicy(5, 20, base_delay=0.5, max_delay=3)
+    for attempt, ceiling in enumerate([0.5, 1.0, 2.0, 3.0, 3.0]):
+        delays = [policy.get_delay(SERVER_ERROR, attempt) for _ in range(200)]
+        assert all(0.0 <= delay <= ceiling for delay in delays)
+        assert max(delays) > ceiling * 0.8  # Spread over the whole range, not bunched at the ceiling
+        assert min(delays) < ceiling * 0.2
+
+
+def test_transient_errors_are_retried_until_success():
+    sleeps = []
+    function = Flaky(TimeoutError(), status_error(openai.InternalServerError, 500))
+    assert RetryPolicy(3, 20, sleep=sleeps.append).call(function) == 'ok'
+    assert function.calls == 3
+    assert len(sleeps) == 2
+
+
+def test_retries_run_out():
+    sleeps = []
+    function = Flaky(*[TimeoutError()] * 10)
+    with pytest.raises(TimeoutError):
+        RetryPolicy(3, 20, sleep=sleeps.append).call(function)
+    assert function.calls == 4
+    assert len(sleeps) == 3
+
+
+@pytest.mark.parametrize('error', [
+    status_error(openai.AuthenticationError, 401),
+    status_error(openai.BadRequestError, 400),
+    RequestCancelled('Hedge won'),
+])
+def test_errors_that_are_not_retried(error):
+    sleeps = []
+    function = Flaky(error)
+    with pytest.raises(type(error)):
+        RetryPolicy(3, 20, sleep=sleeps.append).call(function)
+    assert function.calls == 1
+    assert sleeps == []
+
+
+def test_unknown_errors_are_retried_once():
+    function = Flaky(*[TypeError('bad argument')] * 10)
+    with pytest.raises(TypeError):
+        RetryPolicy(3, 20, sleep=lambda delay: None).call(function)
+    assert function.calls == 2
+
+
+def test_rate_limit_retry_waits_for_retry_after():
+    sleeps = []
+    function = Flaky(status_error(openai.RateLimitError, 429, {'retry-after': '7'}))
+    assert RetryPolicy(3, 20, sleep=sleeps.append).call(function) == 'ok'
+    assert 7.0 <= sleeps[0] <= 7.7
+
+
+def test_interrupt_stops_the_wait_for_a_retry():
+    interrupt_event = threading.Event()
+    interrupt_event.set()
+    function = Flaky(TimeoutError())
+    with pytest.raises(RequestCancelled):
+        RetryPolicy(3, 20).call(function, interrupt_event=interrupt_event)
+    assert function.calls == 1
+
+
+def test_cancellation_wrapped_by_the_client_is_not_retried():
+    sleeps = []
+    error = openai.APIConnectionError(request=httpx.Request('POST', URL))
+    error.__cause__ = RequestCancelled('Cancelled while waiting for the rate limiter')
+    function = Flaky(error)
+    with pytest.raises(RequestCancelled):
+        RetryPolicy(3, 20, sleep=sleeps.append).call(function)
+    assert function.calls == 1
+    assert sleeps == []
+
+
+def test_circuit_opens_after_consecutive_failures_and_half_opens_after_the_reset_timeout():
+    clock = FakeClock()
+    breaker = CircuitBreaker('endpoint', failure_threshold=3, reset_timeout=30, clock=clock)
+    for _ in range(3):
+        breaker.before_request()
+        breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+    clock.now += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+    clock.now += 1
+    breaker.before_request()  # The trial request
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()  # Only one at a time
+    breaker.record_success()
+    breaker.before_request()
+    breaker.before_request()
+
+
+def test_failed_trial_opens_the_circuit_for_another_reset_timeout():
+    clock = FakeClock()
+    breaker = CircuitBreaker('endpoint', failure_threshold=1, reset_timeout=30, clock=clock)
+    breaker.record_failure()
+    clock.now += 30
+    breaker.before_request()
+    breaker.record_failure()
+    clock.now += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    clock.now += 1
+    breaker.before_request()
+
+
+def test_abandoned_trial_lets_the_next_request_try():
+    clock = FakeClock()
+    breaker = CircuitBreaker('endpoint', failure_threshold=1, reset_timeout=30, clock=clock)
+    breaker.record_failure()
+    clock.now += 30
+    breaker.before_request()
+    breaker.abandon_trial()
+    breaker.before_request()
+
+
+def test_a_success_resets_the_failure_count():
+    breaker = CircuitBreaker('endpoint', failure_threshold=2, clock=FakeClock())
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.before_request()
+
+
+def test_only_endpoint_failures_count_against_the_circuit():
+    breaker = CircuitBreaker('endpoint', failure_threshold=1, clock=FakeClock())
+    policy = RetryPolicy(0, 20, sleep=lambda delay: None)
+    for error in (status_error(openai.RateLimitError, 429), status_error(openai.BadRequestError, 400),
+                  RequestCancelled('Hedge won')):
+        with pytest.raises(type(error)):
+            policy.call(Flaky(error), circuit_breaker=breaker)
+    breaker.before_request()
+
+    with pytest.raises(TimeoutError):
+        policy.call(Flaky(TimeoutError()), circuit_breaker=breaker)
+    with pytest.raises(CircuitOpenError):
+        policy.call(Flaky(), circuit_breaker=breaker)
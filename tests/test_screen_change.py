@@ -0,0 +1,48 @@
+import pytest
+
+Image = pytest.importorskip('PIL.Image')
+ImageDraw = pytest.importorskip('PIL.ImageDraw')
+from screen_change import SCREEN_CHANGE_THRESHOLD, get_change_signature, signature_difference
+
+BACKGROUND = (240, 240, 240)
+
+
+def make_window() -> Image.Image:
+    """A plain 1080p window with an unfocused text field and an unticked checkbox."""
+    window = Image.new('RGB', (1920, 1080), BACKGROUND)
+    draw = ImageDraw.Draw(window)
+    draw.rectangle((400, 300, 700, 330), fill='white', outline=(160, 160, 160))
+    draw.rectangle((400, 400, 412, 412), fill='white', outline=(120, 120, 120))
+    return window
+
+
+def difference(before: Image.Image, after: Image.Image) -> float:
+    return signature_difference(get_change_signature(before), get_change_signature(after))
+
+
+def test_unchanged_screen_is_unchanged():
+    assert difference(make_window(), make_window()) < SCREEN_CHANGE_THRESHOLD
+
+
+def test_focused_text_field_is_a_change():
+    focused = make_window()
+    draw = ImageDraw.Draw(focused)
+    draw.rectangle((400, 300, 700, 330), outline=(0, 120, 215))  # Focus ring
+    draw.line((405, 305, 405, 325), fill='black')  # Caret
+    assert difference(make_window(), focused) >= SCREEN_CHANGE_THRESHOLD
+
+
+def test_caret_alone_is_a_change():
+    with_caret = make_window()
+    ImageDraw.Draw(with_caret).line((405, 305, 405, 325), fill='black')
+    assert difference(make_window(), with_caret) >= SCREEN_CHANGE_THRESHOLD
+
+
+def test_ticked_checkbox_is_a_change():
+    ticked = make_window()
+    ImageDraw.Draw(ticked).line((402, 406, 405, 410, 411, 401), fill='black')
+    assert difference(make_window(), ticked) >= SCREEN_CHANGE_THRESHOLD
+
+
+def test_different_sizes_count_as_changed():
+    assert signature_difference(b'\x00' * 4, b'\x00' * 8) == 1.0
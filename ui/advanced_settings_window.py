@@ -9,6 +9,7 @@ import ttkbootstrap as ttk # type: ignore
 from PIL import Image, ImageTk # type: ignore
 
 from llm import DEFAULT_MODEL_NAME
+from model_tiers import TIERED_MODEL_MODE, SINGLE_MODEL_MODE
 from settings import Settings  # Updated import
 from version import version
 
@@ -46,6 +47,8 @@ class AdvancedSettingsWindow(ttk.Toplevel):
         if model not in [item[1] for item in self.models]:
             self.model_entry.insert(0, model)
 
+        self.tiered_var.set(settings_dict.get('model_mode') == TIERED_MODEL_MODE)
+
     def create_widgets(self) -> None:
         # Frame
         frame = ttk.Frame(self, padding='10 10 10 10')
@@ -86,6 +89,11 @@ class AdvancedSettingsWindow(ttk.Toplevel):
         self.model_entry = ttk.Entry(frame)
         self.model_entry.pack(fill=ttk.X, pady=5)
 
+        # Tiered mode
+        self.tiered_var = ttk.BooleanVar(value=False)
+        ttk.Checkbutton(frame, text='Tiered: try GPT-4o-mini first, retry hard rounds on GPT-4o',
+                        variable=self.tiered_var, bootstyle="round-toggle").pack(pady=10, fill=ttk.X)
+
         # Save Button
         save_button = ttk.Button(frame, text='Save Settings', bootstyle="success", command=self.save_button)
         save_button.pack(pady=20, fill = ttk.X)
@@ -102,6 +110,7 @@ class AdvancedSettingsWindow(ttk.Toplevel):
         settings_dict = {
             'base_url': base_url,
             'model': model,
+            'model_mode': TIERED_MODEL_MODE if self.tiered_var.get() else SINGLE_MODEL_MODE,
         }
         try:
            self.settings.save_settings_to_file(settings_dict)
@@ -0,0 +1,95 @@
+import logging
+import queue
+
+import ttkbootstrap as ttk
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+DEFAULT_FLUSH_INTERVAL_MS = 100
+DEFAULT_MAX_LINES = 1000
+
+
+class QueueLoggingHandler(logging.Handler):
+    """Formats records on the logging thread and only enqueues them, so it never touches Tk."""
+
+    def __init__(self, level=logging.INFO):
+        super().__init__(level)
+        self.queue = queue.SimpleQueue()
+        self.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    def emit(self, record):
+        try:
+            self.queue.put(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class TkLogSink:
+    """
+    Shows log records in a Text widget without calling Tk from other threads.
+
+    Core, LLM and web server threads log through a QueueLoggingHandler. The Tk main loop drains the queue every
+    flush_interval_ms and inserts the whole batch with one call. Only the newest max_lines lines are kept in the widget,
+    and if the UI falls further behind than that the older queued lines are dropped instead of being inserted.
+    """
+
+    def __init__(self, text_widget, newest_first: bool = False, level=logging.INFO,
+                 max_lines: int = DEFAULT_MAX_LINES, flush_interval_ms: int = DEFAULT_FLUSH_INTERVAL_MS):
+        self.text_widget = text_widget
+        self.newest_first = newest_first
+        self.max_lines = max_lines
+        self.flush_interval_ms = flush_interval_ms
+        self.handler = QueueLoggingHandler(level)
+        self._after_id = None
+
+    def start(self) -> None:
+        root_logger = logging.getLogger()
+        if self.handler not in root_logger.handlers:
+            root_logger.addHandler(self.handler)
+        if self._after_id is None:
+            self._after_id = self.text_widget.after(self.flush_interval_ms, self._drain)
+
+    def stop(self) -> None:
+        logging.getLogger().removeHandler(self.handler)
+        if self._after_id is not None:
+            try:
+                self.text_widget.after_cancel(self._after_id)
+            except Exception:
+                pass  # The widget is already gone
+            self._after_id = None
+
+    def _drain(self) -> None:
+        lines = []
+        backlog = self.handler.queue.qsize()
+        for _ in range(backlog):
+            try:
+                lines.append(self.handler.queue.get_nowait())
+            except queue.Empty:
+                break
+        lines = lines[-self.max_lines:]
+
+        if lines:
+            try:
+                self._insert(lines)
+            except Exception:
+                self._after_id = None  # The widget is gone, stop draining
+                return
+        self._after_id = self.text_widget.after(self.flush_interval_ms, self._drain)
+
+    def _insert(self, lines: list[str]) -> None:
+        if self.newest_first:
+            self.text_widget.insert('1.0', '\n'.join(reversed(lines)) + '\n')
+        else:
+            self.text_widget.insert(ttk.END, '\n'.join(lines) + '\n')
+
+        # Every insert ends with a newline, so the last line of the widget is always empty.
+        line_count = int(self.text_widget.index('end-1c').split('.')[0]) - 1
+        excess = line_count - self.max_lines
+        if excess > 0:
+            if self.newest_first:
+                self.text_widget.delete(f'{self.max_lines + 1}.0', 'end-1c')
+            else:
+                self.text_widget.delete('1.0', f'{excess + 1}.0')
+
+        self.text_widget.see('1.0' if self.newest_first else ttk.END)
@@ -1,19 +1,23 @@
 import threading
 import webbrowser
-from multiprocessing import Queue
+from collections import deque
 from pathlib import Path
 import logging
 import tkinter as tk
 
-import speech_recognition as sr
 import ttkbootstrap as ttk
 from PIL import Image, ImageTk
 
+from event_bus import (DoneEvent, Event, EventBus, ProgressEvent, ScreenshotEvent, StatusEvent, StopRequestEvent,
+                       UserRequestEvent)
+from frame_buffer import Frame
 from settings import Settings  # Updated import
+from ui.log_sink import TkLogSink, DEFAULT_MAX_LINES
+from ui.thumbnails import ThumbnailLoader
+from ui.voice_input import OfflineSpeechRecognizer, VoiceInputError
 from version import version
-from web_server import get_local_ip_address, start_web_server
-import qrcode
-import requests
+
+DEFAULT_MAX_MESSAGE_IMAGES = 5
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -26,7 +30,8 @@ class MainWindow(ttk.Window):
     def change_theme(self, theme_name: str) -> None:
         self.style.theme_use(theme_name)
 
-    def __init__(self):
+    def __init__(self, event_bus: EventBus):
+        self.event_bus = event_bus
         self.settings = Settings()
         settings_dict = self.settings.get_dict()
         theme = settings_dict.get('theme', 'superhero')
@@ -62,27 +67,36 @@ class MainWindow(ttk.Window):
                 with mic_image.resize((24, 24)).convert("RGBA") as resized_mic_image:
                     self.mic_icon = ImageTk.PhotoImage(resized_mic_image)
 
-                for x in range(mic_image.width):
-                    for y in range(mic_image.height):
-                        r, g, b, a = mic_image.getpixel((x, y))
-                        mic_image.putpixel((x, y), (255, 0, 0, a))
-
-                self.mic_icon_red = ImageTk.PhotoImage(mic_image)
+                    # Tint the icon red in one pass instead of pixel by pixel, it's on the startup path.
+                    red_mic_image = Image.new("RGBA", resized_mic_image.size, (255, 0, 0, 0))
+                    red_mic_image.putalpha(resized_mic_image.getchannel("A"))
+                    self.mic_icon_red = ImageTk.PhotoImage(red_mic_image)
         except Exception as e:
             logging.error(f'Error loading images: {e}')
 
         # This adds app icon in linux which pyinstaller can't
         self.tk.call('wm', 'iconphoto', self._w, self.logo_img)
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
-        # MP Queue to facilitate communication between UI and Core.
-        self.user_request_queue = Queue()
-
         self.is_mic_active = False
         self.is_technical_output_visible = False
-        self.local_ip = get_local_ip_address()
+        self.local_ip = None  # Resolved when mobile control is first turned on
         self.server_running = False
         self.api_key = self.settings.get_dict().get("api_key")
 
+        # Screenshot thumbnails are decoded off the Tk thread, and only the newest few stay embedded in the panel.
+        self.thumbnail_loader = ThumbnailLoader()
+        self.max_message_images = int(settings_dict.get('message_panel_max_images', DEFAULT_MAX_MESSAGE_IMAGES))
+        self.message_images: deque[tuple[str, ImageTk.PhotoImage]] = deque()
+        self._thumbnail_counter = 0
+
+        # Voice input runs offline when a local model is installed, otherwise it falls back to Google's recognizer.
+        self.voice_backend = settings_dict.get('voice_input_backend', 'offline')
+        self.voice_auto_submit = bool(settings_dict.get('voice_auto_submit', True))
+        self.offline_recognizer = OfflineSpeechRecognizer(settings_dict.get('voice_model_path'))
+        if self.voice_backend == 'offline':
+            self.offline_recognizer.warm_up()
+        self._ambient_energy_threshold = None  # Cached calibration for the Google fallback
+
         self.create_widgets()
         self._setup_logger()
 
@@ -160,7 +174,7 @@ class MainWindow(ttk.Window):
             self.technical_output_frame.grid_remove()
 
             # Server Address
-            self.server_address_label = ttk.Label(frame, text=f'http://{self.local_ip}:5000', font=('Helvetica', 8), bootstyle="secondary")
+            self.server_address_label = ttk.Label(frame, text='', font=('Helvetica', 8), bootstyle="secondary")
             self.server_address_label.grid(column=0, row=11, columnspan=3, sticky=ttk.W, pady=(0, 5))
             self.server_address_label.grid_remove()
 
@@ -171,12 +185,10 @@ class MainWindow(ttk.Window):
         """Toggles the visibility of the technical output section"""
         if self.is_technical_output_visible:
             self.technical_output_frame.grid_remove()
-            for handler in logging.getLogger().handlers[:]:  # make a copy of the list to avoid errors
-                if isinstance(handler, self.TkLoggingHandler):
-                    logging.getLogger().removeHandler(handler)
+            self.log_sink.stop()
         else:
             self.technical_output_frame.grid()
-            self._setup_logger()
+            self.log_sink.start()
 
         self.is_technical_output_visible = not self.is_technical_output_visible
 
@@ -186,14 +198,21 @@ class MainWindow(ttk.Window):
             self.server_address_label.grid_remove()
             self.server_running = False
         else:
+            # Flask is only imported once mobile control is actually used.
+            from web_server import get_local_ip_address, start_web_server
+            if self.local_ip is None:
+                self.local_ip = get_local_ip_address()
+            self.server_address_label.configure(text=f'http://{self.local_ip}:5000')
             self.server_address_label.grid()
             if not hasattr(self, 'web_server_thread') or not self.web_server_thread.is_alive():
-                self.web_server_thread = threading.Thread(target=start_web_server, args=(self.local_ip, 5000, self.user_request_queue), daemon=True)
+                self.web_server_thread = threading.Thread(target=start_web_server, args=(self.local_ip, 5000, self.event_bus), daemon=True)
                 self.web_server_thread.start()
             self.show_qr_code()
             self.server_running = True
 
     def show_qr_code(self):
+        import qrcode
+
         # Create QR Code
         qr = qrcode.QRCode(
             version=1,
@@ -224,8 +243,8 @@ class MainWindow(ttk.Window):
             logging.error(f'Error opening settings window: {e}')
 
     def stop_previous_request(self) -> None:
-        # Interrupt currently running request by queueing a stop signal.
-        self.user_request_queue.put('stop')
+        # Interrupt currently running request by publishing a stop signal.
+        self.event_bus.publish(StopRequestEvent())
 
     def on_focus_in(self, event):
         if self.entry.get() == "Input Command":
@@ -247,14 +266,14 @@ class MainWindow(ttk.Window):
 
     def execute_user_request(self, event=None) -> None:
         try:
-            # Puts the user request received from the UI into the MP queue being read in App to be sent to Core.
+            # Publishes the user request received from the UI, App hands it to Core.
             user_request = self.display_input()
 
             if user_request == '' or user_request is None:
                 return
             self.progress_bar.start()
             self.update_message('AI is processing your request...')
-            self.user_request_queue.put(user_request)
+            self.event_bus.publish(UserRequestEvent(user_request))
         except Exception as e:
             logging.error(f"Error executing user request: {e}")
 
@@ -266,30 +285,75 @@ class MainWindow(ttk.Window):
 
     def voice_input(self) -> None:
         # Function to handle voice input
-        recognizer = sr.Recognizer()
         try:
-            with sr.Microphone() as source:
-                self.update_message('Listening...')
-                # This might also help with asking for mic permissions on Macs
-                recognizer.adjust_for_ambient_noise(source)
+            if self.voice_backend == 'offline':
                 try:
-                    audio = recognizer.listen(source, timeout=4)
-                    try:
-                        text = recognizer.recognize_google(audio)
-                        self.entry.delete(0, ttk.END)
-                        self.entry.insert(0, text)
-                        self.update_message('')
-                    except sr.UnknownValueError:
-                        self.update_message('Could not understand audio')
-                    except sr.RequestError as e:
-                        self.update_message(f'Could not request results - {e}')
-                except sr.WaitTimeoutError:
-                    self.update_message('Didn\'t hear anything')
+                    self._offline_voice_input()
+                    return
+                except VoiceInputError as e:
+                    logging.info(f'Falling back to online voice input: {e}')
+            self._online_voice_input()
         except Exception as e:
             logging.error(f"Error during voice input: {e}")
         finally:
             self.is_mic_active = False
-            self.mic_button.configure(image=self.mic_icon)  # changed to configure
+            self.mic_button.after(0, lambda: self.mic_button.configure(image=self.mic_icon))
+
+    def _offline_voice_input(self) -> None:
+        self.update_message('Listening...')
+        text = self.offline_recognizer.listen(on_partial=lambda partial: self.after(0, self._set_entry_text, partial))
+        if text is None:
+            self.update_message('Didn\'t hear anything')
+        elif not text:
+            self.update_message('Could not understand audio')
+        else:
+            self.after(0, self._finish_voice_input, text)
+
+    def _online_voice_input(self) -> None:
+        import speech_recognition as sr
+
+        recognizer = sr.Recognizer()
+        with sr.Microphone() as source:
+            self.update_message('Listening...')
+            if self._ambient_energy_threshold is None:
+                # This might also help with asking for mic permissions on Macs
+                recognizer.adjust_for_ambient_noise(source)
+                self._ambient_energy_threshold = recognizer.energy_threshold
+            else:
+                recognizer.energy_threshold = self._ambient_energy_threshold
+            try:
+                audio = recognizer.listen(source, timeout=4)
+                try:
+                    text = recognizer.recognize_google(audio)
+                    self.after(0, self._set_entry_text, text)
+                    self.update_message('')
+                except sr.UnknownValueError:
+                    self.update_message('Could not understand audio')
+                except sr.RequestError as e:
+                    self.update_message(f'Could not request results - {e}')
+            except sr.WaitTimeoutError:
+                self.update_message('Didn\'t hear anything')
+
+    def _set_entry_text(self, text: str) -> None:
+        self.entry.delete(0, ttk.END)
+        self.entry.insert(0, text)
+
+    def _finish_voice_input(self, text: str) -> None:
+        self._set_entry_text(text)
+        if self.voice_auto_submit:
+            self.execute_user_request()
+        else:
+            self.update_message('')
+
+    def handle_event(self, event: Event) -> None:
+        """EventBus subscriber for what Core reports back. Called on Core's threads, update_message hands off to Tk."""
+        if isinstance(event, ScreenshotEvent):
+            source = event.frame or event.path
+            self.update_message((event.message, source) if source else event.message)
+        elif isinstance(event, DoneEvent):
+            self.update_message(('ai', event.message))
+        elif isinstance(event, (StatusEvent, ProgressEvent)):
+            self.update_message(event.message)
 
     def update_message(self, message: str, image: ImageTk.PhotoImage = None) -> None:
         # Update the message display with the provided text.
@@ -301,16 +365,18 @@ class MainWindow(ttk.Window):
         def insert_message():
             if isinstance(message, str):
                 self.message_display.insert(0.0, message + '\n')
-            elif isinstance(message, tuple) and len(message == 2) and isinstance(message[0], str) and isinstance(message[1], str):
-                try:
-                    with Image.open(message[1]) as img_file:
-                        img = ImageTk.PhotoImage(img_file)
-                        self.message_display.insert(0.0, message[0] + '\n')
-                        self.message_display.image_create(0.0, image=img)
-                        self.message_display.insert(0.0, '\n')
-                except Exception as e:
-                    logging.error(f"Error loading image from path {message[1]}: {e}")
-                    self.message_display.insert(0.0, f"Error loading image from path {message[1]}: {e}" + '\n')
+            elif isinstance(message, tuple) and len(message) == 2 and message[0] == 'ai':
+                # Final answer from the AI
+                self.message_display.insert(0.0, str(message[1]) + '\n')
+            elif isinstance(message, tuple) and len(message) == 2 and isinstance(message[0], str) and \
+                    isinstance(message[1], (str, Frame)):
+                self.message_display.insert(0.0, message[0] + '\n')
+                # The thumbnail goes above its message once it's ready, wherever newer messages have pushed it to.
+                self._thumbnail_counter += 1
+                mark = f'thumbnail_{self._thumbnail_counter}'
+                self.message_display.mark_set(mark, '1.0')
+                self.thumbnail_loader.load_async(
+                    message[1], lambda thumbnail: self.message_display.after(0, self._insert_thumbnail, mark, thumbnail))
             self.message_display.see(0.0)
 
         if threading.current_thread() == threading.main_thread():
@@ -324,33 +390,45 @@ class MainWindow(ttk.Window):
                 self.progress_bar.after(0, self.progress_bar.stop)
                 self.progress_bar.after(0, self.progress_bar.grid_remove)
 
-    # Redirect logging to text widget
-    class TkLoggingHandler(logging.Handler):
-        def __init__(self, text_widget):
-            super().__init__()
-            self.text_widget = text_widget
-
-        def emit(self, record):
-            msg = self.format(record)
-            self.text_widget.insert(0.0, msg + '\n')
-            self.text_widget.see(0.0)  # Scroll to the top
+    def _insert_thumbnail(self, mark: str, thumbnail: Image.Image) -> None:
+        """Embeds a thumbnail at mark and drops the oldest embedded images beyond max_message_images. Runs on Tk."""
+        try:
+            if thumbnail is None:
+                self.message_display.insert(mark, 'Error loading screenshot\n')
+                return
+            photo = ImageTk.PhotoImage(thumbnail)
+            image_name = self.message_display.image_create(mark, image=photo)
+            self.message_display.insert(mark, '\n')
+            self.message_images.append((image_name, photo))  # PhotoImages must stay referenced to stay visible
+
+            while len(self.message_images) > self.max_message_images:
+                old_image_name, _ = self.message_images.popleft()
+                self.message_display.delete(old_image_name, f'{old_image_name} +2c')
+        except Exception as e:
+            logging.error(f"Error showing screenshot thumbnail: {e}")
+        finally:
+            self.message_display.mark_unset(mark)
 
     def _setup_logger(self):
-        handler = self.TkLoggingHandler(self.technical_output_display)
-        logging.getLogger().addHandler(handler)
+        # Redirect logging to the technical output, newest first. Records from other threads are queued and inserted
+        # in batches by the Tk main loop.
+        settings_dict = self.settings.get_dict()
+        self.log_sink = TkLogSink(self.technical_output_display, newest_first=True,
+                                  level=settings_dict.get('log_panel_level', 'INFO'),
+                                  max_lines=int(settings_dict.get('log_panel_max_lines', DEFAULT_MAX_LINES)))
+        self.log_sink.start()
 
         # Log a message to show that the handler is working.
         logging.info("Starting to log messages...")
 
     def _cleanup_logger(self):
-        for handler in logging.getLogger().handlers[:]:  # make a copy of the list to avoid errors
-            if isinstance(handler, self.TkLoggingHandler):
-                logging.getLogger().removeHandler(handler)
+        if hasattr(self, 'log_sink'):
+            self.log_sink.stop()
         logging.info("Finished logging messages...")
 
     def on_closing(self):
         self._cleanup_logger()
-        self.user_request_queue.close()
+        self.thumbnail_loader.shutdown()
         if hasattr(self, 'web_server_thread') and self.web_server_thread.is_alive():
             self.web_server_thread.join(timeout=5)
         self.destroy()
@@ -11,6 +11,7 @@ from PIL import Image, ImageTk
 
 from llm import DEFAULT_MODEL_NAME
 from settings import Settings  # Updated import
+from ui.log_sink import TkLogSink, DEFAULT_MAX_LINES
 from version import version
 
 # Configure logging
@@ -46,18 +47,12 @@ class TechnicalOutputWindow(ttk.Toplevel):
             self.message_display = ttk.ScrolledText(frame, wrap=ttk.WORD, font=('Helvetica', 10),  height=15)
             self.message_display.grid(column=0, row=1, columnspan=3, sticky=(ttk.W, ttk.E, ttk.N, ttk.S), pady=(0, 5))
 
-            # Redirect logging to text widget
-            class TkLoggingHandler(logging.Handler):
-                def __init__(self, text_widget):
-                    super().__init__()
-                    self.text_widget = text_widget
-
-                def emit(self, record):
-                    msg = self.format(record)
-                    self.text_widget.insert(ttk.END, msg + '\n')
-                    self.text_widget.see(ttk.END)  # Scroll to end
-            handler = TkLoggingHandler(self.message_display)
-            logging.getLogger().addHandler(handler)
+            # Redirect logging to text widget, batched through the Tk main loop
+            settings_dict = Settings().get_dict()
+            self.log_sink = TkLogSink(self.message_display,
+                                      level=settings_dict.get('log_panel_level', 'INFO'),
+                                      max_lines=int(settings_dict.get('log_panel_max_lines', DEFAULT_MAX_LINES)))
+            self.log_sink.start()
             logging.info("Technical Output window created successfully")
         except Exception as e:
             logging.error(f'Error creating technical output window: {e}')
@@ -66,7 +61,6 @@ class TechnicalOutputWindow(ttk.Toplevel):
     def close_window(self):
         """Closes the window and removes the handler"""
         logging.info("Closing Technical Output window")
-        for handler in logging.getLogger().handlers[:]: #make a copy of the list to avoid errors
-            if isinstance(handler, TkLoggingHandler):
-                logging.getLogger().removeHandler(handler)
+        if hasattr(self, 'log_sink'):
+            self.log_sink.stop()
         self.destroy() # closes the window
\ No newline at end of file
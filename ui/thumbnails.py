@@ -0,0 +1,82 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Union
+
+from PIL import Image
+
+from frame_buffer import Frame
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+DEFAULT_THUMBNAIL_SIZE = (320, 180)
+
+
+class ThumbnailLoader:
+    """
+    Decodes and downsizes screenshots on a worker thread so the Tk thread only ever sees small images.
+
+    Image.draft lets JPEG decoders skip straight to a reduced scale, and reduce() does a cheap box downscale for other
+    formats before the final resize. Thumbnails are cached by path and modification time, since screenshot files are
+    reused round robin. Frames from the frame buffer are already in memory and cache their own thumbnails.
+    """
+
+    def __init__(self, max_size: tuple[int, int] = DEFAULT_THUMBNAIL_SIZE, cache_size: int = 16):
+        self.max_size = max_size
+        self.cache_size = cache_size
+        self._cache: OrderedDict[tuple[str, int], Image.Image] = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='thumbnails')
+
+    def load_async(self, source: Union[str, Frame], callback: Callable[[Optional[Image.Image]], None]) -> None:
+        """Calls callback on the worker thread with the thumbnail of a file or frame, or None if it couldn't be loaded."""
+        def load_and_call_back():
+            if isinstance(source, Frame):
+                try:
+                    callback(source.thumbnail(self.max_size))
+                except Exception as e:
+                    logging.error(f"Error making a thumbnail of frame {source.frame_id}: {e}")
+                    callback(None)
+            else:
+                callback(self.load(source))
+
+        self._executor.submit(load_and_call_back)
+
+    def load(self, path: str) -> Optional[Image.Image]:
+        try:
+            key = (path, os.stat(path).st_mtime_ns)
+        except OSError as e:
+            logging.error(f"Error loading image from path {path}: {e}")
+            return None
+
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        try:
+            thumbnail = self._make_thumbnail(path)
+        except Exception as e:
+            logging.error(f"Error loading image from path {path}: {e}")
+            return None
+
+        with self._lock:
+            self._cache[key] = thumbnail
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return thumbnail
+
+    def _make_thumbnail(self, path: str) -> Image.Image:
+        max_width, max_height = self.max_size
+        with Image.open(path) as img:
+            img.draft('RGB', self.max_size)
+            factor = min(img.width // max_width, img.height // max_height)
+            thumbnail = img.reduce(factor) if factor > 1 else img.copy()
+        thumbnail.thumbnail(self.max_size)
+        return thumbnail
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
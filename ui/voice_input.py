@@ -0,0 +1,210 @@
+import array
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from settings import get_settings_directory_path
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+SAMPLE_RATE = 16000
+FRAME_DURATION_MS = 30  # One of the frame sizes webrtcvad accepts
+FRAME_SAMPLES = SAMPLE_RATE * FRAME_DURATION_MS // 1000
+
+DEFAULT_MODEL_DIRECTORY_NAME = 'vosk-model'
+DEFAULT_LISTEN_TIMEOUT = 4  # Seconds to wait for speech to start, same as the old listen(timeout=4)
+DEFAULT_END_OF_SPEECH_SILENCE = 0.7  # Seconds of silence after speech that end the utterance
+DEFAULT_MAX_UTTERANCE_DURATION = 15
+CALIBRATION_DURATION = 0.3
+CALIBRATION_MAX_AGE = 10 * 60  # Recalibrate when the cached noise floor is older than this
+PRE_ROLL_FRAMES = 10  # Audio kept from before speech was detected, so the first syllable isn't cut off
+SPEECH_ENERGY_MULTIPLIER = 3.0
+MIN_SPEECH_ENERGY = 300
+
+
+class VoiceInputError(Exception):
+    """Offline voice input isn't available, e.g. vosk, pyaudio or the model is missing."""
+
+
+@dataclass
+class NoiseCalibration:
+    energy: float
+    measured_at: float
+
+    def is_fresh(self) -> bool:
+        return time.monotonic() - self.measured_at < CALIBRATION_MAX_AGE
+
+
+def frame_energy(frame: bytes) -> float:
+    """RMS of a frame of 16 bit mono PCM."""
+    samples = array.array('h', frame)
+    if not samples:
+        return 0.0
+    return math.sqrt(sum(sample * sample for sample in samples) / len(samples))
+
+
+class VoiceActivityDetector:
+    """
+    Decides per frame whether someone is speaking.
+
+    Uses webrtcvad when it's installed, and otherwise compares frame energy against the measured noise floor.
+    """
+
+    def __init__(self, noise_energy: float, aggressiveness: int = 2):
+        self.threshold = max(noise_energy * SPEECH_ENERGY_MULTIPLIER, MIN_SPEECH_ENERGY)
+        self._vad = None
+        try:
+            import webrtcvad
+            self._vad = webrtcvad.Vad(aggressiveness)
+        except ImportError:
+            pass
+
+    def is_speech(self, frame: bytes) -> bool:
+        # The energy gate keeps webrtcvad from triggering on quiet background chatter.
+        if frame_energy(frame) < self.threshold:
+            return False
+        return self._vad.is_speech(frame, SAMPLE_RATE) if self._vad else True
+
+
+class OfflineSpeechRecognizer:
+    """
+    Streaming, CPU-only speech recognition with a local Vosk model.
+
+    Audio is fed to the recognizer frame by frame while the user is speaking, so partial transcripts are available
+    immediately and the final one is ready a moment after the user stops, instead of after the whole utterance has been
+    recorded and sent off. The model is loaded once per process, and the noise floor is measured once and reused for
+    CALIBRATION_MAX_AGE instead of on every press.
+    """
+
+    _model = None
+    _model_path: Optional[str] = None
+    _model_lock = threading.Lock()
+    _calibration: Optional[NoiseCalibration] = None
+
+    def __init__(self, model_path: Optional[str] = None, listen_timeout: float = DEFAULT_LISTEN_TIMEOUT,
+                 end_of_speech_silence: float = DEFAULT_END_OF_SPEECH_SILENCE,
+                 max_utterance_duration: float = DEFAULT_MAX_UTTERANCE_DURATION):
+        self.model_path = model_path or os.path.join(get_settings_directory_path(), DEFAULT_MODEL_DIRECTORY_NAME)
+        self.listen_timeout = listen_timeout
+        self.end_of_speech_silence = end_of_speech_silence
+        self.max_utterance_duration = max_utterance_duration
+
+    @classmethod
+    def load_model(cls, model_path: str):
+        with cls._model_lock:
+            if cls._model is None or cls._model_path != model_path:
+                if not os.path.isdir(model_path):
+                    raise VoiceInputError(f'No speech recognition model found at {model_path}')
+                try:
+                    import vosk
+                except ImportError as e:
+                    raise VoiceInputError(f'vosk is not installed: {e}')
+                vosk.SetLogLevel(-1)
+                logging.info(f'Loading speech recognition model from {model_path}')
+                cls._model = vosk.Model(model_path)
+                cls._model_path = model_path
+            return cls._model
+
+    def warm_up(self) -> None:
+        """Loads the model in the background so the first press doesn't wait for it."""
+        def load():
+            try:
+                self.load_model(self.model_path)
+            except VoiceInputError as e:
+                logging.info(f'Offline voice input unavailable: {e}')
+
+        threading.Thread(target=load, daemon=True).start()
+
+    def listen(self, on_partial: Callable[[str], None] = None) -> Optional[str]:
+        """
+        Records one utterance and returns its transcript, or None if nobody spoke before listen_timeout.
+        on_partial is called on this thread with the transcript so far whenever it changes.
+        """
+        model = self.load_model(self.model_path)
+        try:
+            import pyaudio
+            import vosk
+        except ImportError as e:
+            raise VoiceInputError(f'Audio input is not available: {e}')
+
+        audio = pyaudio.PyAudio()
+        stream = None
+        try:
+            stream = audio.open(format=pyaudio.paInt16, channels=1, rate=SAMPLE_RATE, input=True,
+                                frames_per_buffer=FRAME_SAMPLES)
+
+            def read_frame() -> bytes:
+                return stream.read(FRAME_SAMPLES, exception_on_overflow=False)
+
+            vad = VoiceActivityDetector(self._get_noise_energy(read_frame))
+            recognizer = vosk.KaldiRecognizer(model, SAMPLE_RATE)
+            return self._recognize_utterance(read_frame, vad, recognizer, on_partial)
+        finally:
+            if stream is not None:
+                stream.stop_stream()
+                stream.close()
+            audio.terminate()
+
+    def _get_noise_energy(self, read_frame: Callable[[], bytes]) -> float:
+        calibration = OfflineSpeechRecognizer._calibration
+        if calibration and calibration.is_fresh():
+            return calibration.energy
+
+        frame_count = max(1, int(CALIBRATION_DURATION * 1000 / FRAME_DURATION_MS))
+        energies = sorted(frame_energy(read_frame()) for _ in range(frame_count))
+        energy = energies[len(energies) // 2]  # The median ignores a click or a cough during calibration
+        OfflineSpeechRecognizer._calibration = NoiseCalibration(energy, time.monotonic())
+        logging.info(f'Calibrated voice input noise floor: {energy:.0f}')
+        return energy
+
+    def _recognize_utterance(self, read_frame, vad: VoiceActivityDetector, recognizer,
+                             on_partial: Callable[[str], None] = None) -> Optional[str]:
+        frames_per_second = 1000 / FRAME_DURATION_MS
+        max_waiting_frames = int(self.listen_timeout * frames_per_second)
+        max_silent_frames = int(self.end_of_speech_silence * frames_per_second)
+        max_utterance_frames = int(self.max_utterance_duration * frames_per_second)
+
+        pre_roll = deque(maxlen=PRE_ROLL_FRAMES)
+        for _ in range(max_waiting_frames):
+            frame = read_frame()
+            pre_roll.append(frame)
+            if vad.is_speech(frame):
+                break
+        else:
+            return None
+
+        transcript_parts = []
+        last_partial = ''
+        silent_frames = 0
+        frames = list(pre_roll)
+        for _ in range(max_utterance_frames):
+            for frame in frames:
+                if recognizer.AcceptWaveform(frame):
+                    # Vosk detected the end of a phrase, keep listening in case the user continues.
+                    text = json.loads(recognizer.Result()).get('text', '')
+                    if text:
+                        transcript_parts.append(text)
+                else:
+                    partial = json.loads(recognizer.PartialResult()).get('partial', '')
+                    if on_partial and partial and partial != last_partial:
+                        last_partial = partial
+                        on_partial(' '.join(transcript_parts + [partial]))
+
+            frame = read_frame()
+            frames = [frame]
+            silent_frames = 0 if vad.is_speech(frame) else silent_frames + 1
+            if silent_frames >= max_silent_frames:
+                break
+
+        final_result = recognizer.Result() if recognizer.AcceptWaveform(frame) else recognizer.FinalResult()
+        text = json.loads(final_result).get('text', '')
+        if text:
+            transcript_parts.append(text)
+        return ' '.join(transcript_parts).strip()
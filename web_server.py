@@ -1,27 +1,75 @@
+import gzip
 import logging
 import secrets
+import threading
 from threading import Thread
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
+from werkzeug.serving import ThreadedWSGIServer, WSGIRequestHandler
+from event_bus import EventBus, UserRequestEvent
+from event_stream import conversation_events, format_server_sent_event
+from screen import Screen
 from settings import Settings
 import socket
 import ssl
 import os
+import time
+import urllib.parse
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Don't log every single request, several phones polling at once would flood the log.
+logging.getLogger('werkzeug').setLevel(logging.WARNING)
 
-app = Flask(__name__, template_folder='resources/templates')
+DEFAULT_SERVER_BACKEND = 'production'  # 'production' or 'development' (Flask's built-in server)
+DEFAULT_SERVER_THREADS = 8
+DEFAULT_CONNECTION_LIMIT = 32
+KEEP_ALIVE_TIMEOUT = 15  # seconds an idle keep-alive connection is kept open
+STATIC_MAX_AGE = 7 * 24 * 60 * 60  # seconds browsers may cache /static files for
+GZIP_MIN_SIZE = 512  # bytes, smaller responses aren't worth compressing
+GZIP_MIMETYPES = {'text/html', 'text/css', 'text/javascript', 'application/javascript', 'application/json'}
+SSE_HEARTBEAT_INTERVAL = 15  # seconds between keep-alive comments on an idle event stream
+SSE_STREAM_DURATION = 300  # seconds before a stream is closed, EventSource reconnects and resumes with Last-Event-ID
+SSE_RETRY_MS = 1000  # how long browsers wait before reconnecting
+MESSAGES_PAGE_SIZE = 100  # default and maximum number of messages returned by /get-messages
+PREVIEW_MAX_FPS = 2  # frames per second sent to each live screen preview
+PREVIEW_MAX_WIDTH = 640  # pixels
+PREVIEW_JPEG_QUALITY = 60
+MJPEG_BOUNDARY = 'frame'
+
+app = Flask(__name__, template_folder='resources/templates', static_folder='resources/static')
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = STATIC_MAX_AGE
 settings = Settings()
-app.user_and_ai_responses = [] # To store the responses for mobile view.
 app.server_active = False
 app.API_KEY = secrets.token_urlsafe(32)
 
 
 def check_api_key():
     auth_header = request.headers.get('Authorization')
-    if not auth_header or auth_header != f'Bearer {app.API_KEY}':
-        return False
-    return True
+    if auth_header and secrets.compare_digest(auth_header, f'Bearer {app.API_KEY}'):
+        return True
+    # EventSource can't set headers, so the event stream passes the key as a query parameter instead.
+    token = request.args.get('token')
+    return bool(token) and secrets.compare_digest(token, app.API_KEY)
+
+@app.after_request
+def compress_response(response):
+    """Gzips text responses for clients that accept it."""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code >= 300
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in GZIP_MIMETYPES
+            or 'gzip' not in request.headers.get('Accept-Encoding', '').lower()):
+        return response
+
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+
+    # zlib releases the GIL while compressing, so this doesn't hold up the Core thread.
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
@@ -33,13 +81,11 @@ def index():
         user_input = request.form.get('user_input')
         if user_input:
            logging.info(f"Received User Input via webserver: {urllib.parse.quote(user_input)}")
-           #import urllib
-           app.user_and_ai_responses.append(("user", user_input))
-           app.user_request_queue.put(user_input)
-        return render_template('index.html', settings=settings_dict, messages = app.user_and_ai_responses, api_key= app.API_KEY)
+           app.event_bus.publish(UserRequestEvent(user_input))
 
-    else:
-        return render_template('index.html', settings=settings_dict, messages = app.user_and_ai_responses, api_key= app.API_KEY)
+    messages, last_event_id = conversation_events.get_messages_and_last_event_id()
+    return render_template('index.html', settings=settings_dict, messages = messages,
+                           api_key= app.API_KEY, last_event_id = last_event_id)
 
 @app.route('/settings', methods = ['GET', 'POST'])
 def web_settings():
@@ -67,9 +113,7 @@ def web_settings():
         }
 
         settings.save_settings_to_file(settings_dict)
-        settings.notify_settings_changed()
         logging.info(f"Settings updated from web browser: {urllib.parse.quote(str(settings_dict))}")
-        #import urllib
 
         return jsonify(success=True, message="Settings saved successfully", settings=settings.get_dict())
     else:
@@ -78,16 +122,110 @@ def web_settings():
 
 @app.route('/get-messages', methods = ['GET'])
 def get_messages():
+    """
+    Pages through the conversation.
+    ?since=<id> returns messages newer than id, ?before=<id> returns older history, neither returns the latest page.
+    Responses carry an ETag of the newest message id, so an idle poll is answered with a 304 without serializing anything.
+    """
     if not check_api_key():
         return jsonify(success=False, message="Unauthorized Access"), 401
-    return jsonify(success = True, messages = app.user_and_ai_responses)
+
+    last_id = conversation_events.last_event_id
+    # Weak, because gzip changes the bytes but not the content.
+    etag = str(last_id)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    since = request.args.get('since', type=int)
+    before = request.args.get('before', type=int)
+    limit = max(1, min(request.args.get('limit', MESSAGES_PAGE_SIZE, type=int), MESSAGES_PAGE_SIZE))
+
+    if since is not None:
+        messages = conversation_events.events_since(since, limit)
+    else:
+        messages = conversation_events.events_before(before if before is not None else last_id + 1, limit)
+
+    response = jsonify(success = True, messages = messages, last_id = last_id)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/events', methods = ['GET'])
+def events():
+    """Server-Sent Events stream of user, ai and status events, resumable with Last-Event-ID."""
+    if not check_api_key():
+        return jsonify(success=False, message="Unauthorized Access"), 401
+
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        last_event_id = 0
+
+    def stream(last_event_id):
+        yield f'retry: {SSE_RETRY_MS}\n\n'
+        deadline = time.monotonic() + SSE_STREAM_DURATION
+        while app.server_active and time.monotonic() < deadline:
+            new_events = conversation_events.wait_for_events(last_event_id, timeout=SSE_HEARTBEAT_INTERVAL)
+            if not new_events:
+                yield ': keep-alive\n\n'
+                continue
+            for event in new_events:
+                yield format_server_sent_event(event)
+            last_event_id = new_events[-1]['id']
+
+    response = Response(stream(last_event_id), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/screen.mjpeg', methods = ['GET'])
+def screen_preview():
+    """
+    Live, downscaled MJPEG preview of what the agent sees.
+    Only frames that Screen already captured are sent, so watching never triggers extra captures. Clients that fall
+    behind skip straight to the newest frame.
+    """
+    if not check_api_key():
+        return jsonify(success=False, message="Unauthorized Access"), 401
+
+    settings_dict = settings.get_dict()
+    max_fps = float(settings_dict.get('preview_max_fps', PREVIEW_MAX_FPS))
+    max_width = int(settings_dict.get('preview_max_width', PREVIEW_MAX_WIDTH))
+    min_frame_interval = 1.0 / max_fps if max_fps > 0 else 0
+
+    def stream():
+        last_frame_id = 0
+        last_sent_at = 0.0
+        while app.server_active:
+            # Cap the frame rate before waiting, so a burst of captures collapses into the newest frame.
+            wait = min_frame_interval - (time.monotonic() - last_sent_at)
+            if wait > 0:
+                time.sleep(wait)
+            frame = Screen.frame_buffer.wait_for_new_frame(last_frame_id, timeout=SSE_HEARTBEAT_INTERVAL)
+            if frame is None or frame.frame_id == last_frame_id:
+                continue
+            # Encoded once per frame and size however many previews are open.
+            jpeg = frame.encode('JPEG', max_width=max_width, quality=PREVIEW_JPEG_QUALITY)
+            yield (f'--{MJPEG_BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n\r\n'.encode()
+                   + jpeg + b'\r\n')
+            last_frame_id = frame.frame_id
+            last_sent_at = time.monotonic()
+
+    response = Response(stream(), mimetype=f'multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 def get_local_ip_address():
         """Get the local IP address for the web server"""
         try:
+            # Connecting a UDP socket sends no packets, it only asks the OS which interface would route there.
             s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.settimeout(20)
+            s.settimeout(2)
             s.connect(("8.8.8.8", 80))
             local_ip = s.getsockname()[0]
             s.shutdown(socket.SHUT_RDWR)
@@ -99,38 +237,110 @@ def get_local_ip_address():
             logging.error(f"Error getting local IP address: {e}")
             return "127.0.0.1"
 
-def run_server(host, port, user_request_queue):
-        app.user_request_queue = user_request_queue
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """HTTP/1.1 request handler that keeps connections open between polls and doesn't log every hit."""
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEP_ALIVE_TIMEOUT
+
+    def log_request(self, code='-', size='-'):
+        pass
+
+
+class BoundedThreadedWSGIServer(ThreadedWSGIServer):
+    """Thread-per-connection server that caps how many connections are served at the same time."""
+
+    def __init__(self, host, port, wsgi_app, connection_limit=DEFAULT_CONNECTION_LIMIT, **kwargs):
+        super().__init__(host, port, wsgi_app, handler=KeepAliveRequestHandler, **kwargs)
+        self._connection_slots = threading.BoundedSemaphore(connection_limit)
+
+    def process_request(self, request, client_address):
+        # Wait a little for a free slot, then drop the connection rather than spawning unbounded threads.
+        if not self._connection_slots.acquire(timeout=KEEP_ALIVE_TIMEOUT):
+            logging.warning(f"Web server connection limit reached, dropping connection from {client_address[0]}")
+            self.shutdown_request(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self._connection_slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._connection_slots.release()
+
+
+def get_ssl_context():
+    """Returns an SSL context if a secure connection is enabled and the certificate files exist, else None."""
+    if not settings.get_dict().get('secure_connection'):
+        return None
+    cert_path = 'resources/cert.pem'
+    key_path = 'resources/key.pem'
+    if os.path.exists(cert_path) and os.path.exists(key_path):
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(cert_path, key_path)
+        return ssl_context
+    logging.info(f"SSL files not found, running in HTTP mode.")
+    return None
+
+
+def run_production_server(host, port, ssl_context):
         settings_dict = settings.get_dict()
-        if settings_dict.get('secure_connection'):
-            logging.info(f"Starting web server on https://{host}:{port}")
-            cert_path = 'resources/cert.pem'
-            key_path = 'resources/key.pem'
-            if os.path.exists(cert_path) and os.path.exists(key_path):
-                 ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-                 ssl_context.load_cert_chain(cert_path, key_path)
-                 app.run(host=host, port = port, debug=False, use_reloader=False, ssl_context = ssl_context)
-            else:
-                logging.info(f"SSL files not found, running in HTTP mode.")
-                app.run(host=host, port = port, debug=False, use_reloader=False)
+        threads = int(settings_dict.get('web_server_threads', DEFAULT_SERVER_THREADS))
+        connection_limit = int(settings_dict.get('web_server_connection_limit', DEFAULT_CONNECTION_LIMIT))
 
+        if ssl_context is None:
+            try:
+                import waitress
+            except ImportError:
+                waitress = None
+            if waitress:
+                # Waitress multiplexes keep-alive connections over a fixed thread pool, but every open event stream
+                # pins a worker thread, so there have to be enough of them to serve all connections at once.
+                threads = max(threads, connection_limit)
+                logging.info(f"Starting waitress web server on http://{host}:{port} with {threads} threads")
+                waitress.serve(app, host=host, port=port, threads=threads, connection_limit=connection_limit,
+                               channel_timeout=KEEP_ALIVE_TIMEOUT, ident=None, _quiet=True)
+                return
+
+        scheme = 'https' if ssl_context else 'http'
+        logging.info(f"Starting threaded web server on {scheme}://{host}:{port}, connection limit {connection_limit}")
+        server = BoundedThreadedWSGIServer(host, port, app, connection_limit=connection_limit, ssl_context=ssl_context)
+        server.serve_forever()
+
+
+def run_server(host, port, event_bus: EventBus):
+        app.event_bus = event_bus
+        if host is None:
+            host = get_local_ip_address()
+        ssl_context = get_ssl_context()
+
+        if settings.get_dict().get('web_server_backend', DEFAULT_SERVER_BACKEND) == 'development':
+            scheme = 'https' if ssl_context else 'http'
+            logging.info(f"Starting development web server on {scheme}://{host}:{port}")
+            app.run(host=host, port = port, debug=False, use_reloader=False, ssl_context = ssl_context)
         else:
-            logging.info(f"Starting web server on http://{host}:{port}")
-            app.run(host=host, port = port, debug=False, use_reloader=False)
+            run_production_server(host, port, ssl_context)
 
 
 
 
-def start_web_server(host = get_local_ip_address(), port = 5000, user_request_queue=None):
-     if not user_request_queue:
-           logging.error(f"Could not start web server, queue has not been set")
+def start_web_server(host = None, port = 5000, event_bus: EventBus = None):
+     """Starts the web server in a daemon thread. The host is resolved in that thread when not given."""
+     if not event_bus:
+           logging.error(f"Could not start web server, event bus has not been set")
+           return
+     if app.server_active:
+           logging.info("Web server is already running")
            return
      app.server_active = True
-     server_thread = Thread(target=run_server, args=(host,port,user_request_queue), daemon=True)
+     server_thread = Thread(target=run_server, args=(host,port,event_bus), daemon=True)
      server_thread.start()
 
 if __name__ == '__main__':
       #This is only used to run the web server in standalone mode for testing.
        #Should not be called when running from the app.py
-      #Dummy Queue to start the app.
-      start_web_server(user_request_queue = Queue())
\ No newline at end of file
+      #Dummy event bus to start the app.
+      start_web_server(event_bus = EventBus())
\ No newline at end of file
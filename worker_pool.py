@@ -0,0 +1,271 @@
+import argparse
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import select
+import shutil
+import subprocess
+import sys
+import time
+from collections import deque
+from typing import Any, Iterator, Optional
+
+from models.rate_limiter import set_rate_limit_share
+from settings import Settings, get_settings_directory_path, set_data_directory_path
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+DEFAULT_WORKER_SCREEN = '1920x1080x24'  # Xvfb -screen geometry, width x height x depth
+DISPLAY_START_TIMEOUT = 10  # seconds
+WORKER_STOP_TIMEOUT = 10  # seconds a worker gets to finish cleaning up before it's terminated
+RESULT_POLL_INTERVAL = 1.0  # seconds between checks that the workers are still alive
+WORKERS_DIRECTORY = 'workers'  # Workers' data directories, under the settings directory
+
+
+class VirtualDisplay:
+    """An Xvfb server. Xvfb picks a free display number itself and reports it once it accepts connections."""
+
+    def __init__(self, screen: str = DEFAULT_WORKER_SCREEN):
+        self.screen = screen
+        self.process: Optional[subprocess.Popen] = None
+        self.display: Optional[str] = None
+
+    def start(self) -> str:
+        """Starts Xvfb and returns its DISPLAY, e.g. ':99', when it's ready."""
+        read_fd, write_fd = os.pipe()
+        try:
+            self.process = subprocess.Popen(['Xvfb', '-displayfd', str(write_fd), '-screen', '0', self.screen,
+                                             '-nolisten', 'tcp'], pass_fds=(write_fd,),
+                                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        finally:
+            os.close(write_fd)
+
+        try:
+            ready, _, _ = select.select([read_fd], [], [], DISPLAY_START_TIMEOUT)
+            number = os.read(read_fd, 16).strip() if ready else b''  # Empty if Xvfb exited without a display
+        finally:
+            os.close(read_fd)
+        if not number:
+            self.stop()
+            raise RuntimeError(f'Xvfb did not start within {DISPLAY_START_TIMEOUT}s')
+        self.display = f':{number.decode()}'
+        logging.info(f'Started virtual display {self.display} ({self.screen})')
+        return self.display
+
+    def stop(self) -> None:
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+
+
+def _run_worker(worker_index: int, worker_count: int, display: str, jobs: multiprocessing.Queue,
+                results: multiprocessing.Queue) -> None:
+    """
+    Worker process: a Core of its own, with its own model session, Interpreter and Screen, on display. Runs the
+    requests the pool sends it until it gets None.
+    """
+    # pyautogui and mss connect to $DISPLAY when they're imported, so it's set before anything imports them.
+    os.environ['DISPLAY'] = display
+    # Every worker uses the same API key, together they stay within the configured rate limits.
+    set_rate_limit_share(1 / worker_count)
+    # Screenshots, templates and recordings of one worker never overwrite another's.
+    set_data_directory_path(os.path.join(get_settings_directory_path(), WORKERS_DIRECTORY, str(worker_index)))
+    from core import Core
+    from event_bus import EventBus, StatusEvent
+
+    event_bus = EventBus()
+    event_bus.subscribe(lambda event: logging.info(f'[worker {worker_index}] {event.message}'), (StatusEvent,))
+    core = Core(event_bus)
+    try:
+        for job_id, user_request in iter(jobs.get, None):
+            logging.info(f'[worker {worker_index}] Running job {job_id}: {user_request}')
+            start_time = time.monotonic()
+            try:
+                result = core.execute_user_request(user_request)
+            except Exception as e:
+                logging.error(f'[worker {worker_index}] Job {job_id} failed: {e}')
+                result = f'Exception Unable to execute the request - {e}'
+            results.put({
+                'job_id': job_id,
+                'request': user_request,
+                'result': result,
+                'worker': worker_index,
+                'display': display,
+                'duration': time.monotonic() - start_time,
+            })
+    finally:
+        core.cleanup()
+
+
+class _Worker:
+    """A worker process, its display, and the job it's running, as the pool sees them."""
+
+    def __init__(self, index: int, display: VirtualDisplay, process: multiprocessing.Process,
+                 jobs: multiprocessing.Queue):
+        self.index = index
+        self.display = display
+        self.process = process
+        self.jobs = jobs
+        self.job: Optional[tuple[int, str]] = None
+        self.job_started_at = 0.0
+        self.exited = False
+
+
+class WorkerPool:
+    """
+    Runs automation requests in parallel, each worker on its own Xvfb display (Linux only).
+
+    A worker is a separate process with DISPLAY pointing at its display, so its input, screenshots, frame buffer and
+    model session never touch another worker's. Requests are queued with submit() and the pool hands each one to the
+    next idle worker, one at a time, so it always knows which job a worker has. results() yields them as they finish,
+    in whatever order that is. A worker that dies (it couldn't connect to its display, ran out of memory, crashed)
+    fails the job it was running instead of leaving results() waiting for it, since the same job would most likely
+    take down the next worker too. Workers are started with the spawn method so each imports pyautogui fresh against
+    its own display.
+    """
+
+    def __init__(self, workers: Optional[int] = None, screen: Optional[str] = None):
+        if not shutil.which('Xvfb'):
+            raise RuntimeError('Xvfb was not found, install it (e.g. apt install xvfb) to run a worker pool')
+        settings_dict = Settings().get_dict()
+        self.worker_count = workers or int(settings_dict.get('worker_count', os.cpu_count() or 1))
+        self.screen = screen or settings_dict.get('worker_screen', DEFAULT_WORKER_SCREEN)
+        self._context = multiprocessing.get_context('spawn')
+        self._results = self._context.Queue()
+        self._job_ids = itertools.count(1)
+        self._queued_jobs: deque[tuple[int, str]] = deque()
+        self._workers: list[_Worker] = []
+        try:
+            for worker_index in range(self.worker_count):
+                self._workers.append(self._start_worker(worker_index))
+        except Exception:
+            self.close()
+            raise
+        logging.info(f'Worker pool started with {self.worker_count} workers')
+
+    def _start_worker(self, worker_index: int) -> _Worker:
+        display = VirtualDisplay(self.screen)
+        display_name = display.start()
+        jobs = self._context.Queue()
+        process = self._context.Process(target=_run_worker, name=f'automation-worker-{worker_index}',
+                                        args=(worker_index, self.worker_count, display_name, jobs, self._results),
+                                        daemon=True)
+        try:
+            process.start()
+        except Exception:
+            display.stop()
+            raise
+        return _Worker(worker_index, display, process, jobs)
+
+    def submit(self, user_request: str) -> int:
+        """Queues a request for the next idle worker, returns its job id."""
+        job_id = next(self._job_ids)
+        self._queued_jobs.append((job_id, user_request))
+        self._dispatch()
+        return job_id
+
+    def _dispatch(self) -> None:
+        for worker in self._workers:
+            if not self._queued_jobs:
+                return
+            if worker.job is None and not worker.exited:
+                worker.job = self._queued_jobs.popleft()
+                worker.job_started_at = time.monotonic()
+                worker.jobs.put(worker.job)
+
+    def results(self, timeout: Optional[float] = None) -> Iterator[dict[str, Any]]:
+        """Results of the submitted jobs as they finish. Stops early if none finishes within timeout seconds."""
+        last_result_at = time.monotonic()
+        while self._queued_jobs or any(worker.job for worker in self._workers):
+            self._dispatch()
+            try:
+                result = self._results.get(timeout=RESULT_POLL_INTERVAL)
+            except queue.Empty:
+                result = None
+            finished = [] if result is None else [result]
+            if result is not None:
+                worker = self._workers[result['worker']]
+                if worker.job and worker.job[0] == result['job_id']:
+                    worker.job = None
+                else:
+                    finished = []  # Its job was already failed when the worker was found dead
+            finished += self._fail_dead_workers()
+            for result in finished:
+                yield result
+            if finished:
+                last_result_at = time.monotonic()
+            elif timeout is not None and time.monotonic() - last_result_at >= timeout:
+                return
+
+    def _fail_dead_workers(self) -> list[dict[str, Any]]:
+        """Failed results for the jobs of workers that exited, and for every queued job if no worker is left."""
+        failed = []
+        for worker in self._workers:
+            if worker.exited or worker.process.is_alive():
+                continue
+            worker.exited = True
+            logging.error(f'Worker {worker.index} exited with code {worker.process.exitcode}')
+            worker.display.stop()
+            if worker.job:
+                failed.append(self._failed_result(worker.job, f'Worker {worker.index} exited with code '
+                                                              f'{worker.process.exitcode} while running the request',
+                                                  worker))
+                worker.job = None
+        if all(worker.exited for worker in self._workers):
+            while self._queued_jobs:
+                failed.append(self._failed_result(self._queued_jobs.popleft(), 'Every worker has exited'))
+        return failed
+
+    @staticmethod
+    def _failed_result(job: tuple[int, str], reason: str, worker: Optional[_Worker] = None) -> dict[str, Any]:
+        return {
+            'job_id': job[0],
+            'request': job[1],
+            'result': reason,
+            'worker': worker.index if worker else None,
+            'display': worker.display.display if worker else None,
+            'duration': time.monotonic() - worker.job_started_at if worker else 0.0,
+        }
+
+    def close(self) -> None:
+        """Stops the workers, each gets WORKER_STOP_TIMEOUT seconds to finish what it's doing, and their displays."""
+        for worker in self._workers:
+            if worker.process.is_alive():
+                worker.jobs.put(None)
+        for worker in self._workers:
+            worker.process.join(WORKER_STOP_TIMEOUT)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.display.stop()
+        self._workers = []
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs requests in parallel on isolated virtual displays.')
+    parser.add_argument('requests', nargs='*', help='Requests to run, one per line on stdin if none are given')
+    parser.add_argument('--workers', type=int, help='Number of workers (default: the worker_count setting or the '
+                                                    'number of CPUs)')
+    parser.add_argument('--screen', help=f'Xvfb screen geometry (default: {DEFAULT_WORKER_SCREEN})')
+    args = parser.parse_args()
+
+    user_requests = args.requests or [line.strip() for line in sys.stdin if line.strip()]
+    if not user_requests:
+        parser.error('no requests to run')
+    pool = WorkerPool(args.workers, args.screen)
+    try:
+        start_time = time.monotonic()
+        for user_request in user_requests:
+            pool.submit(user_request)
+        for finished in pool.results():
+            print(f"[{finished['job_id']}] worker {finished['worker']} took {finished['duration']:.1f}s: "
+                  f"{finished['request']} -> {finished['result']}", flush=True)
+        logging.info(f'Ran {len(user_requests)} requests in {time.monotonic() - start_time:.1f}s')
+    finally:
+        pool.close()